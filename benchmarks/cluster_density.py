@@ -0,0 +1,93 @@
+"""calculate_cluster_density のベンチマーク
+
+以前の実装（(階層, クラスタ) 毎にDataFrame全体を絞り込む）と、現在の実装（階層毎に np.bincount で集計する）の
+所要時間を比較し、密度の順位のパーセンタイルが一致することを確認する。density_method="knn" の所要時間も表示する。
+
+    python -m benchmarks.cluster_density [outputs/{dataset}] [--n 件数] [--cluster-nums 3 6 12 24 48 96]
+
+ディレクトリを指定すると、その hierarchical_clusters.csv を使う。指定しない場合は合成データを使う。
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from steps.hierarchical_merge_labelling import _filter_id_columns, calculate_cluster_density
+
+
+def _legacy_calculate_cluster_density(melted_df: pd.DataFrame, hierarchical_cluster_df: pd.DataFrame):
+    densities = []
+    for level, c_id in zip(melted_df["level"], melted_df["id"], strict=False):
+        cluster_embeds = hierarchical_cluster_df[hierarchical_cluster_df[f"cluster-level-{level}-id"] == c_id][
+            ["x", "y"]
+        ].values
+        center = np.mean(cluster_embeds, axis=0)
+        distances = np.linalg.norm(cluster_embeds - center, axis=1)
+        densities.append(1 / (np.mean(distances) + 1e-10))
+
+    melted_df["density"] = densities
+    melted_df["density_rank"] = melted_df.groupby("level")["density"].rank(ascending=False, method="first")
+    melted_df["density_rank_percentile"] = melted_df.groupby("level")["density_rank"].transform(lambda x: x / len(x))
+    return melted_df
+
+
+def _synthetic_clusters(n_samples: int, cluster_nums: list[int]) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    finest = cluster_nums[-1]
+    centers = rng.uniform(-10, 10, size=(finest, 2))
+    labels = rng.integers(0, finest, n_samples)
+    points = centers[labels] + rng.normal(scale=rng.uniform(0.1, 1.0, finest)[labels, None], size=(n_samples, 2))
+    clusters_df = pd.DataFrame({"x": points[:, 0], "y": points[:, 1]})
+    for level, n_clusters in enumerate(cluster_nums, start=1):
+        # 上位の階層は最下層のクラスタをまとめたもの
+        clusters_df[f"cluster-level-{level}-id"] = [f"{level}_{label}" for label in labels * n_clusters // finest]
+    return clusters_df
+
+
+def _melt(clusters_df: pd.DataFrame) -> pd.DataFrame:
+    rows = []
+    for column in _filter_id_columns(clusters_df.columns):
+        level = int(column.replace("cluster-level-", "").replace("-id", ""))
+        rows += [{"level": level, "id": cluster_id} for cluster_id in clusters_df[column].unique()]
+    return pd.DataFrame(rows)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", nargs="?")
+    parser.add_argument("--n", type=int, default=200000)
+    parser.add_argument("--cluster-nums", type=int, nargs="+", default=[3, 6, 12, 24, 48, 96])
+    args = parser.parse_args()
+
+    if args.directory:
+        clusters_df = pd.read_csv(os.path.join(args.directory, "hierarchical_clusters.csv"))
+    else:
+        clusters_df = _synthetic_clusters(args.n, sorted(args.cluster_nums))
+    melted_df = _melt(clusters_df)
+
+    start = time.perf_counter()
+    legacy = _legacy_calculate_cluster_density(melted_df.copy(), clusters_df)
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    current = calculate_cluster_density(melted_df.copy(), clusters_df)
+    current_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    calculate_cluster_density(melted_df.copy(), clusters_df, method="knn")
+    knn_time = time.perf_counter() - start
+
+    if not legacy["density_rank_percentile"].equals(current["density_rank_percentile"]):
+        raise AssertionError("density_rank_percentile differs from the legacy implementation")
+    print(f"{len(clusters_df)} arguments, {len(melted_df)} clusters")
+    print(
+        f"legacy: {legacy_time:.2f}s, current: {current_time:.3f}s (x{legacy_time / current_time:.0f}), "
+        f"percentile ranks identical; knn: {knn_time:.2f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""hierarchical_clustering.pre_reduction の効果を測るベンチマーク
+
+全次元のままUMAP + KMeansを実行した場合と、各方法で次元を落としてから実行した場合について、
+所要時間・Pythonヒープのピーク使用量（tracemalloc）・最下層のクラスタの一致度（ARI）を比較する。
+
+    python -m benchmarks.clustering_pre_reduction [outputs/{dataset}] [--n 件数] [--dim 次元数]
+
+ディレクトリを指定すると、その embeddings.npy を使う。指定しない場合は3072次元の合成データ
+（24個のガウス分布の混合）を使う。合成データは次元の重要度に偏りが無いため、truncate のARIは
+実際のMatryoshka型モデルの埋め込みより低く出る。
+"""
+
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+from sklearn.metrics import adjusted_rand_score
+
+from services.embedding_reduction import REDUCTION_METHODS, reduce_embeddings
+from services.embedding_store import load_embeddings
+from steps.hierarchical_clustering import hierarchical_clustering_embeddings, project_embeddings
+
+CLUSTER_NUMS = [3, 6, 12, 24]
+
+
+def _synthetic_embeddings(n_samples: int, dim: int = 3072, n_centers: int = 24) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(n_centers, dim))
+    points = centers[rng.integers(0, n_centers, n_samples)] + rng.normal(scale=1.5, size=(n_samples, dim))
+    points /= np.linalg.norm(points, axis=1, keepdims=True)
+    return points.astype(np.float32)
+
+
+def _run(matrix: np.ndarray, method: str | None, dim: int) -> tuple[np.ndarray, float, float]:
+    tracemalloc.start()
+    start = time.perf_counter()
+    if method:
+        matrix = reduce_embeddings(matrix, method, dim)
+    umap_embeds, _ = project_embeddings(matrix)
+    labels = hierarchical_clustering_embeddings(umap_embeds, list(CLUSTER_NUMS))[CLUSTER_NUMS[-1]]
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return labels, elapsed, peak / 2**20
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", nargs="?")
+    parser.add_argument("--n", type=int, default=4000)
+    parser.add_argument("--dim", type=int, default=256)
+    args = parser.parse_args()
+
+    if args.directory:
+        _, matrix = load_embeddings(args.directory)
+    else:
+        matrix = _synthetic_embeddings(args.n)
+
+    full_labels, full_time, full_peak = _run(matrix, None, args.dim)
+    print(f"{matrix.shape[0]} x {matrix.shape[1]} embeddings, cluster_nums={CLUSTER_NUMS}")
+    print(f"full ({matrix.shape[1]} dims): {full_time:.1f}s, peak {full_peak:.0f} MiB")
+    for method in REDUCTION_METHODS:
+        labels, elapsed, peak = _run(matrix, method, args.dim)
+        ari = adjusted_rand_score(full_labels, labels)
+        print(f"{method} ({args.dim} dims): {elapsed:.1f}s, peak {peak:.0f} MiB, ARI vs full {ari:.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""埋め込みバックエンドのスループット（テキスト/秒）を比較するベンチマーク
+
+合成した意見テキストを batch_size 件ずつ request_to_embed に渡し、全件のベクトル化にかかった時間を測る。
+APIのモデル（text-embedding-3-small 等）を指定する場合は .env の認証情報が必要で、料金が発生する。
+
+    python -m benchmarks.embedding_backends [モデル名 ...] [--texts 件数] [--batch-size 件数]
+"""
+
+import argparse
+import time
+
+from services.llm import LOCAL_HASHING_EMBEDDING_MODEL, request_to_embed
+
+TOPICS = ["AIの透明性", "雇用への影響", "教育への投資", "医療費の負担", "地方の交通手段", "子育て支援"]
+STANCES = ["を高めてほしいという要望がある", "に対する不安がある", "が不十分であることへの不満がある"]
+
+
+def _synthetic_texts(n_texts: int) -> list[str]:
+    return [f"{TOPICS[i % len(TOPICS)]}{STANCES[i % len(STANCES)]}（意見{i}）" for i in range(n_texts)]
+
+
+def benchmark(model: str, texts: list[str], batch_size: int) -> float:
+    # 初回呼び出しのモデル読み込み等を計測から除く
+    request_to_embed(texts[:1], model)
+    start = time.perf_counter()
+    for i in range(0, len(texts), batch_size):
+        request_to_embed(texts[i : i + batch_size], model)
+    return len(texts) / (time.perf_counter() - start)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("models", nargs="*", default=[LOCAL_HASHING_EMBEDDING_MODEL])
+    parser.add_argument("--texts", type=int, default=20000)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    texts = _synthetic_texts(args.texts)
+    for model in args.models:
+        print(f"{model}: {benchmark(model, texts, args.batch_size):.0f} texts/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""extraction の入力読み込み・結果組み立てのマイクロベンチマーク
+
+合成した50万件のコメントCSVに対して、以前の実装（行ごとの comments.loc 参照・Pythonループ）と
+現在の実装（列単位の処理）の所要時間を比較する。LLMは呼び出さず、抽出結果も合成する。
+
+    python -m benchmarks.extraction_assembly [コメント数]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from services.input_reader import read_unique_comments
+from steps.extraction import build_argument_tables
+
+
+def _write_synthetic_csv(path: str, n_comments: int) -> None:
+    rng = np.random.default_rng(0)
+    bodies = pd.Series([f"コメント本文 {i % (n_comments * 9 // 10)} の内容です" for i in range(n_comments)])
+    # 1%を空白のみの本文にする（重複は約10%）
+    bodies[rng.random(n_comments) < 0.01] = "   "
+    pd.DataFrame({"comment-id": np.arange(n_comments), "comment-body": bodies}).to_csv(path, index=False)
+
+
+def _synthetic_extracted_args(n_comments: int) -> list[list[str]]:
+    # 1コメントあたり0〜3件、意見の語彙は約5万種類（重複する意見が多い状態を再現する）
+    rng = np.random.default_rng(1)
+    counts = rng.integers(0, 4, n_comments)
+    vocabulary = rng.integers(0, 50000, counts.sum())
+    extracted_args_list = []
+    offset = 0
+    for count in counts:
+        extracted_args_list.append([f"意見{v}" for v in vocabulary[offset : offset + count]])
+        offset += count
+    return extracted_args_list
+
+
+def legacy_load(path: str, limit: int):
+    comments = pd.read_csv(path, usecols=["comment-id", "comment-body"])
+    comments["comment-body"] = comments["comment-body"].apply(
+        lambda x: x if not isinstance(x, str) or x.strip() else np.nan
+    )
+    comments = comments.dropna(subset="comment-body")
+    comments = comments.drop_duplicates("comment-body", keep="first")
+    comment_ids = (comments["comment-id"].values)[:limit]
+    comments.set_index("comment-id", inplace=True)
+    comment_bodies = [comments.loc[id]["comment-body"] for id in comment_ids]
+    return comment_ids, comment_bodies
+
+
+def current_load(path: str, limit: int):
+    comments = read_unique_comments(path, ["comment-id", "comment-body"], limit)
+    return comments["comment-id"].to_numpy(), comments["comment-body"].tolist()
+
+
+def legacy_build(comment_ids, extracted_args_list):
+    argument_map = {}
+    relation_rows = []
+    for comment_id, extracted_args in zip(comment_ids, extracted_args_list, strict=True):
+        for j, arg in enumerate(extracted_args):
+            if arg not in argument_map:
+                arg_id = f"A{comment_id}_{j}"
+                argument_map[arg] = {"arg-id": arg_id, "argument": arg}
+            else:
+                arg_id = argument_map[arg]["arg-id"]
+            relation_rows.append({"arg-id": arg_id, "comment-id": comment_id})
+    return pd.DataFrame(argument_map.values()), pd.DataFrame(relation_rows)
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main(n_comments: int = 500000) -> None:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "comments.csv")
+        _write_synthetic_csv(path, n_comments)
+
+        (legacy_ids, legacy_bodies), legacy_load_time = _timed(legacy_load, path, n_comments)
+        (ids, bodies), load_time = _timed(current_load, path, n_comments)
+        assert list(legacy_ids) == list(ids) and legacy_bodies == bodies
+
+        extracted_args_list = _synthetic_extracted_args(len(ids))
+        (legacy_results, legacy_relations), legacy_build_time = _timed(legacy_build, ids, extracted_args_list)
+        (results, relations), build_time = _timed(build_argument_tables, ids, extracted_args_list)
+        assert legacy_results.equals(results) and legacy_relations.astype(str).equals(relations.astype(str))
+
+    print(f"{n_comments} comments, {len(ids)} after dedup, {len(relations)} relations, {len(results)} arguments")
+    print(f"load:     {legacy_load_time:.2f}s -> {load_time:.2f}s ({legacy_load_time / load_time:.1f}x)")
+    print(f"assembly: {legacy_build_time:.2f}s -> {build_time:.2f}s ({legacy_build_time / build_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500000)
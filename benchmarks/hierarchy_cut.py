@@ -0,0 +1,75 @@
+"""KMeansの中心から各階層のクラスタを作る処理のベンチマーク
+
+以前の実装（階層毎に樹形図を計算し直し、意見毎のPythonのループでクラスタ番号を引き直す）と、
+現在の cut_hierarchy（樹形図を1回だけ計算し、配列の添字で引き直す）の所要時間を比較し、結果が一致することを確認する。
+
+    python -m benchmarks.hierarchy_cut [--n 件数] [--cluster-nums 3 6 12 24 48 96]
+"""
+
+import argparse
+import time
+
+import numpy as np
+import scipy.cluster.hierarchy as sch
+
+from steps.hierarchical_clustering import cut_hierarchy
+
+
+def _legacy_merge_clusters_with_hierarchy(cluster_centers, kmeans_labels, umap_array, n_cluster_cut):
+    Z = sch.linkage(cluster_centers, method="ward")
+    cluster_labels_merged = sch.fcluster(Z, t=n_cluster_cut, criterion="maxclust")
+
+    n_samples = umap_array.shape[0]
+    final_labels = np.zeros(n_samples, dtype=int)
+
+    for i in range(n_samples):
+        original_label = kmeans_labels[i]
+        final_labels[i] = cluster_labels_merged[original_label]
+
+    return final_labels
+
+
+def _legacy(cluster_centers, kmeans_labels, umap_array, cluster_nums):
+    results = {}
+    for n_cluster_cut in cluster_nums[:-1]:
+        results[n_cluster_cut] = _legacy_merge_clusters_with_hierarchy(
+            cluster_centers, kmeans_labels, umap_array, n_cluster_cut
+        )
+    results[cluster_nums[-1]] = kmeans_labels
+    return results
+
+
+def _current(cluster_centers, kmeans_labels, cluster_nums):
+    linkage = sch.linkage(cluster_centers, method="ward")
+    return cut_hierarchy(linkage, kmeans_labels, cluster_nums)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n", type=int, default=1_000_000)
+    parser.add_argument("--cluster-nums", type=int, nargs="+", default=[3, 6, 12, 24, 48, 96])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    cluster_nums = sorted(args.cluster_nums)
+    cluster_centers = rng.uniform(-10, 10, size=(cluster_nums[-1], 2)).astype(np.float32)
+    kmeans_labels = rng.integers(0, cluster_nums[-1], args.n).astype(np.int32)
+    umap_array = rng.normal(size=(args.n, 2)).astype(np.float32)
+
+    start = time.perf_counter()
+    legacy = _legacy(cluster_centers, kmeans_labels, umap_array, cluster_nums)
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    current = _current(cluster_centers, kmeans_labels, cluster_nums)
+    current_time = time.perf_counter() - start
+
+    for n_clusters in cluster_nums:
+        if not np.array_equal(legacy[n_clusters], current[n_clusters]):
+            raise AssertionError(f"Labels differ at {n_clusters} clusters")
+    print(f"{args.n} points x {len(cluster_nums)} levels {cluster_nums}")
+    print(f"legacy: {legacy_time:.2f}s, current: {current_time:.3f}s (x{legacy_time / current_time:.0f}), labels identical")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""hierarchical_clustering.kmeans_engine の比較ベンチマーク
+
+UMAPで射影した2次元座標に対して最下層のクラスタリングを行い、KMeans（現在の方法）と
+MiniBatchKMeansの所要時間・慣性（クラスタ内の二乗距離の和、小さいほど良い）を並べて表示する。
+
+    python -m benchmarks.kmeans_engines [outputs/{dataset}] [--n 件数] [--clusters 100 500] [--batch-size 4096]
+
+ディレクトリを指定すると、その hierarchical_clusters.csv の x, y を使う。指定しない場合は
+大きさの異なる多数のガウス分布を混ぜた2次元の合成データを使う。
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.metrics import adjusted_rand_score
+
+from steps.hierarchical_clustering import make_kmeans
+
+
+def _synthetic_umap_embeds(n_samples: int, n_centers: int = 300) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    centers = rng.uniform(-10, 10, size=(n_centers, 2))
+    scales = rng.uniform(0.05, 0.6, size=n_centers)
+    assignment = rng.integers(0, n_centers, n_samples)
+    points = centers[assignment] + rng.normal(size=(n_samples, 2)) * scales[assignment, None]
+    return points.astype(np.float32)
+
+
+def _inertia(points: np.ndarray, labels: np.ndarray, centers: np.ndarray) -> float:
+    return float(((points - centers[labels]) ** 2).sum())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", nargs="?")
+    parser.add_argument("--n", type=int, default=200000)
+    parser.add_argument("--clusters", type=int, nargs="+", default=[100, 500])
+    parser.add_argument("--batch-size", type=int, default=4096)
+    parser.add_argument("--n-init", default="auto")
+    args = parser.parse_args()
+    n_init = args.n_init if args.n_init == "auto" else int(args.n_init)
+
+    if args.directory:
+        points = pd.read_csv(os.path.join(args.directory, "hierarchical_clusters.csv"), usecols=["x", "y"]).to_numpy()
+    else:
+        points = _synthetic_umap_embeds(args.n)
+    print(f"{len(points)} points, batch_size={args.batch_size}, n_init={n_init}")
+
+    for n_clusters in args.clusters:
+        results = {}
+        for engine in ["kmeans", "minibatch"]:
+            model = make_kmeans(n_clusters, engine, args.batch_size, n_init)
+            start = time.perf_counter()
+            model.fit(points)
+            elapsed = time.perf_counter() - start
+            results[engine] = (model.labels_, _inertia(points, model.labels_, model.cluster_centers_), elapsed)
+
+        kmeans_labels, kmeans_inertia, kmeans_time = results["kmeans"]
+        minibatch_labels, minibatch_inertia, minibatch_time = results["minibatch"]
+        print(
+            f"k={n_clusters}: kmeans {kmeans_time:.1f}s inertia {kmeans_inertia:.4g} | "
+            f"minibatch {minibatch_time:.1f}s inertia {minibatch_inertia:.4g} "
+            f"(x{kmeans_time / minibatch_time:.1f} faster, inertia {minibatch_inertia / kmeans_inertia - 1:+.1%}, "
+            f"ARI vs kmeans {adjusted_rand_score(kmeans_labels, minibatch_labels):.3f})"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""ラベリングのステップでLLMに渡す入力を作る処理のベンチマーク
+
+以前の実装（クラスタ毎にDataFrame全体を絞り込む）と、現在の実装（build_cluster_index で作った
+クラスタID → 行番号 の索引を引く）で、全クラスタの意見のサンプリングと下位クラスタのラベルの取得に
+かかる時間を比較し、取得した下位クラスタのラベルが一致することを確認する。LLMは呼ばない。
+
+    python -m benchmarks.labelling_index [--n 件数] [--cluster-nums 10 100 1000] [--sampling-num 3]
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from services.cluster_index import build_cluster_index
+from services.representative_sampling import sample_cluster_rows
+from steps.hierarchical_merge_labelling import ClusterColumns, build_label_dependencies
+
+
+def _synthetic_labelled_clusters(n_samples: int, cluster_nums: list[int]) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    finest = cluster_nums[-1]
+    labels = rng.integers(0, finest, n_samples)
+    clusters_df = pd.DataFrame({"argument": [f"意見{i}" for i in range(n_samples)]})
+    for level, n_clusters in enumerate(cluster_nums, start=1):
+        # 上位の階層は最下層のクラスタをまとめたもの
+        cluster_ids = np.array([f"{level}_{label}" for label in range(n_clusters)])[labels * n_clusters // finest]
+        clusters_df[f"cluster-level-{level}-id"] = cluster_ids
+        clusters_df[f"cluster-level-{level}-label"] = np.char.add("ラベル", cluster_ids)
+        clusters_df[f"cluster-level-{level}-description"] = np.char.add("説明", cluster_ids)
+    return clusters_df
+
+
+def _legacy(clusters_df: pd.DataFrame, id_columns: list[str], sampling_num: int) -> dict:
+    previous = {}
+    finest_column = id_columns[-1]
+    for cluster_id in clusters_df[finest_column].unique():
+        cluster_data = clusters_df[clusters_df[finest_column] == cluster_id]
+        cluster_data.sample(min(sampling_num, len(cluster_data)))["argument"].tolist()
+    for previous_column, current_column in zip(id_columns[:0:-1], id_columns[-2::-1], strict=True):
+        previous_columns = ClusterColumns.from_id_column(previous_column)
+        for cluster_id in clusters_df[current_column].unique():
+            previous_records = clusters_df[clusters_df[current_column] == cluster_id][
+                [previous_columns.label, previous_columns.description]
+            ].drop_duplicates()
+            previous[cluster_id] = sorted(previous_records[previous_columns.label])
+            cluster_data = clusters_df[clusters_df[current_column] == cluster_id]
+            cluster_data.sample(min(sampling_num, len(cluster_data)))["argument"].tolist()
+    return previous
+
+
+def _current(clusters_df: pd.DataFrame, id_columns: list[str], sampling_num: int) -> dict:
+    previous = {}
+    cluster_index = build_cluster_index(clusters_df, id_columns)
+    arguments = clusters_df["argument"]
+    for column in id_columns:
+        for rows in sample_cluster_rows(cluster_index[column], sampling_num).values():
+            arguments.iloc[rows].tolist()
+    # merge_labelling と同じく、子クラスタのラベルはクラスタ毎に1つ持つ
+    labels = {
+        (column, cluster_id): clusters_df[ClusterColumns.from_id_column(column).label].iat[rows[0]]
+        for column in id_columns
+        for cluster_id, rows in cluster_index[column].items()
+    }
+    for (_, cluster_id), children in build_label_dependencies(clusters_df, id_columns[::-1]).items():
+        previous[cluster_id] = sorted(labels[child] for child in children)
+    return previous
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n", type=int, default=300000)
+    parser.add_argument("--cluster-nums", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--sampling-num", type=int, default=3)
+    args = parser.parse_args()
+
+    cluster_nums = sorted(args.cluster_nums)
+    clusters_df = _synthetic_labelled_clusters(args.n, cluster_nums)
+    id_columns = [f"cluster-level-{level}-id" for level in range(1, len(cluster_nums) + 1)]
+
+    start = time.perf_counter()
+    legacy = _legacy(clusters_df, id_columns, args.sampling_num)
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    current = _current(clusters_df, id_columns, args.sampling_num)
+    current_time = time.perf_counter() - start
+
+    if legacy != current:
+        raise AssertionError("Child cluster labels differ from the legacy implementation")
+    print(f"{args.n} arguments, clusters per level {cluster_nums}, sampling_num={args.sampling_num}")
+    print(
+        f"legacy: {legacy_time:.2f}s, current: {current_time:.3f}s (x{legacy_time / current_time:.0f}), "
+        "child cluster labels identical"
+    )
+
+
+if __name__ == "__main__":
+    main()
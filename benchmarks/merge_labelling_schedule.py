@@ -0,0 +1,133 @@
+"""merge_labelling のスケジューリングのベンチマーク
+
+応答時間がばらつくLLMを模した関数（実際のAPIは呼ばない）を使い、以前の方法（階層毎に全クラスタの応答を待ってから
+次の階層に進む）と、現在の merge_labelling（子クラスタが揃ったクラスタから順に送る）の所要時間を比較する。
+
+    python -m benchmarks.merge_labelling_schedule [--n 件数] [--cluster-nums 5 25 125 625] [--workers 8] [--repeats 5]
+"""
+
+import argparse
+import asyncio
+import json
+import time
+import zlib
+
+import numpy as np
+import pandas as pd
+
+import steps.hierarchical_merge_labelling as merge_step
+from services.async_llm import map_concurrently
+from services.cluster_index import build_cluster_index
+from steps.hierarchical_merge_labelling import ClusterColumns, ClusterValues, merge_labelling
+
+
+def _synthetic_clusters(n_samples: int, cluster_nums: list[int]) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    finest = cluster_nums[-1]
+    labels = rng.integers(0, finest, n_samples)
+    clusters_df = pd.DataFrame({"argument": [f"意見{i}" for i in range(n_samples)]})
+    for level, n_clusters in enumerate(cluster_nums, start=1):
+        # 上位の階層は最下層のクラスタをまとめたもの
+        clusters_df[f"cluster-level-{level}-id"] = [f"{level}_{label}" for label in labels * n_clusters // finest]
+    finest_id_column = f"cluster-level-{len(cluster_nums)}-id"
+    clusters_df[finest_id_column.replace("-id", "-label")] = "ラベル" + clusters_df[finest_id_column]
+    clusters_df[finest_id_column.replace("-id", "-description")] = "説明" + clusters_df[finest_id_column]
+    return clusters_df
+
+
+def _fake_llm(mean_latency: float, salt: int):
+    async def request(messages, model, is_json):
+        # 両方の方法で同じクラスタには同じ応答時間・ラベルを返すよう、子クラスタのラベルから決める
+        cluster_text = messages[1]["content"].split("クラスタの意見")[0]
+        seed = zlib.crc32(cluster_text.encode()) + salt
+        # 応答時間は対数正規分布（平均 mean_latency 秒、まれに数倍かかる）
+        await asyncio.sleep(np.random.default_rng(seed).lognormal(np.log(mean_latency) - 0.5, 1.0))
+        return json.dumps({"label": f"ラベル{seed}", "description": f"説明{seed}"})
+
+    return request
+
+
+def _legacy(clusters_df: pd.DataFrame, cluster_id_columns: list[str], config: dict) -> None:
+    cluster_index = build_cluster_index(clusters_df, cluster_id_columns)
+    labels = {
+        cluster_id: ClusterValues(
+            label=clusters_df[ClusterColumns.from_id_column(cluster_id_columns[0]).label].iat[rows[0]],
+            description="",
+        )
+        for cluster_id, rows in cluster_index[cluster_id_columns[0]].items()
+    }
+    for children_column, column in zip(cluster_id_columns, cluster_id_columns[1:], strict=False):
+        children = clusters_df[children_column]
+
+        async def label_cluster(cluster_id: str, column=column, children=children) -> ClusterValues:
+            rows = cluster_index[column][cluster_id]
+            values = list(dict.fromkeys(labels[child] for child in children.iloc[rows].unique()))
+            if len(values) == 1:
+                return values[0]
+            sampling_num = config["hierarchical_merge_labelling"]["sampling_num"]
+            sampled_rows = np.random.choice(rows, min(sampling_num, len(rows)), replace=False)
+            return await merge_step.process_merge_labelling(cluster_id, values, clusters_df, sampled_rows, config)
+
+        cluster_ids = sorted(cluster_index[column])
+        # 階層毎に全クラスタの応答を待つ
+        level_labels = dict(
+            zip(
+                cluster_ids,
+                map_concurrently(label_cluster, cluster_ids, config["hierarchical_merge_labelling"]["workers"]),
+                strict=True,
+            )
+        )
+        labels.update(level_labels)
+        current_columns = ClusterColumns.from_id_column(column)
+        clusters_df = clusters_df.assign(
+            **{
+                current_columns.label: clusters_df[column].map({k: v.label for k, v in level_labels.items()}),
+                current_columns.description: clusters_df[column].map(
+                    {k: v.description for k, v in level_labels.items()}
+                ),
+            }
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n", type=int, default=20000)
+    parser.add_argument("--cluster-nums", type=int, nargs="+", default=[5, 25, 125, 625])
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--mean-latency", type=float, default=0.1)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    cluster_nums = sorted(args.cluster_nums)
+    clusters_df = _synthetic_clusters(args.n, cluster_nums)
+    cluster_id_columns = [f"cluster-level-{level}-id" for level in range(len(cluster_nums), 0, -1)]
+    config = {
+        "hierarchical_merge_labelling": {
+            "sampling_num": 3,
+            "sampling_method": "random",
+            "prompt": "",
+            "model": "",
+            "workers": args.workers,
+            "pack_size": 1,
+        }
+    }
+    # 所要時間は少数の遅い応答に左右されるため、応答時間の乱数を変えて繰り返した平均で比べる
+    legacy_times, current_times = [], []
+    for salt in range(args.repeats):
+        merge_step.request_to_chat_llm_async = _fake_llm(args.mean_latency, salt)
+
+        start = time.perf_counter()
+        _legacy(clusters_df, cluster_id_columns, config)
+        legacy_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        merge_labelling(clusters_df, cluster_id_columns, config)
+        current_times.append(time.perf_counter() - start)
+
+    legacy_time, current_time = np.mean(legacy_times), np.mean(current_times)
+    print(f"{args.n} arguments, clusters per level {cluster_nums}, workers={args.workers}, repeats={args.repeats}")
+    print(f"level by level: {legacy_time:.2f}s, dependency-driven: {current_time:.2f}s (x{legacy_time / current_time:.2f})")
+
+
+if __name__ == "__main__":
+    main()
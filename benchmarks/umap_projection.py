@@ -0,0 +1,84 @@
+"""hierarchical_clustering の umap_* オプションの効果を測るベンチマーク
+
+現在の方法（全件・乱数シード固定・シングルスレッドのUMAP）を基準に、各方法の所要時間と
+最下層のクラスタの一致度（ARI）を比較する。ARIは同じ方法を繰り返しても1にならないことがある
+（parallel は実行毎に結果が変わる）ため、目安として使う。
+
+    python -m benchmarks.umap_projection [outputs/{dataset}] [--n 件数] [--dim 次元数] [--subsample-size 件数]
+
+ディレクトリを指定すると、その embeddings.npy を使う。指定しない場合は合成データを使う。
+precomputed_knn は近傍グラフの作成時間（括弧内）を含めずに測る。
+"""
+
+import argparse
+import os
+import time
+
+from sklearn.metrics import adjusted_rand_score
+
+from benchmarks.clustering_pre_reduction import CLUSTER_NUMS, _synthetic_embeddings
+from services.embedding_store import load_embeddings
+from services.knn_graph import build_knn_graph
+from steps.hierarchical_clustering import hierarchical_clustering_embeddings, project_embeddings
+
+WARMUP_SIZE = 4500
+
+
+def _run(matrix, **options):
+    start = time.perf_counter()
+    umap_embeds, _ = project_embeddings(matrix, **options)
+    elapsed = time.perf_counter() - start
+    labels = hierarchical_clustering_embeddings(umap_embeds, list(CLUSTER_NUMS))[CLUSTER_NUMS[-1]]
+    return labels, elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", nargs="?")
+    parser.add_argument("--n", type=int, default=8000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--subsample-size", type=int, default=2000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    if args.directory:
+        _, matrix = load_embeddings(args.directory)
+    else:
+        matrix = _synthetic_embeddings(args.n, dim=args.dim)
+    print(f"{matrix.shape[0]} x {matrix.shape[1]} embeddings, cluster_nums={CLUSTER_NUMS}, {os.cpu_count()} CPUs")
+
+    # numbaのJITコンパイル（初回は1分以上かかる）を測定から除くため、各方法を一部のデータで一度実行しておく
+    # 4096件以上にしないとUMAPの近似近傍探索のコードが通らない
+    warmup = matrix[:WARMUP_SIZE]
+    build_knn_graph(warmup)
+    knn_start = time.perf_counter()
+    knn = build_knn_graph(matrix)
+    knn_time = time.perf_counter() - knn_start
+
+    modes = {
+        "exact (current)": {},
+        "exact + parallel": {"parallel": True},
+        "exact + precomputed_knn": {"precomputed_knn": knn},
+        "subsample": {"mode": "subsample", "subsample_size": args.subsample_size},
+        f"subsample + {args.workers} workers": {
+            "mode": "subsample",
+            "subsample_size": args.subsample_size,
+            "workers": args.workers,
+        },
+        "subsample + parallel": {"mode": "subsample", "subsample_size": args.subsample_size, "parallel": True},
+    }
+    for options in modes.values():
+        if "precomputed_knn" not in options:
+            project_embeddings(warmup, **{**options, "subsample_size": min(args.subsample_size, WARMUP_SIZE // 2)})
+
+    exact_labels, exact_time = _run(matrix)
+    print(f"exact (current): {exact_time:.1f}s")
+    for name, options in list(modes.items())[1:]:
+        labels, elapsed = _run(matrix, **options)
+        extra = f" (+{knn_time:.1f}s to build the graph)" if "precomputed_knn" in options else ""
+        ari = adjusted_rand_score(exact_labels, labels)
+        print(f"{name}: {elapsed:.1f}s{extra}, x{exact_time / elapsed:.1f}, ARI vs exact {ari:.3f}")
+
+
+if __name__ == "__main__":
+    main()
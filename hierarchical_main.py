@@ -32,6 +32,16 @@ def parse_arguments():
         action="store_true",
         help="Skip the interactive confirmation prompt and run pipeline immediately.",
     )
+    parser.add_argument(
+        "--no-llm-cache",
+        action="store_true",
+        help="Bypass the on-disk LLM response cache (neither read nor write).",
+    )
+    parser.add_argument(
+        "--clear-llm-cache",
+        action="store_true",
+        help="Delete all cached LLM responses before running.",
+    )
 
     # parser.add_argument(
     #     "--without-html",
@@ -52,6 +62,10 @@ def main():
         new_argv.extend(["-o", args.only])
     if args.skip_interaction:
         new_argv.append("-skip-interaction")
+    if args.no_llm_cache:
+        new_argv.append("-no-llm-cache")
+    if args.clear_llm_cache:
+        new_argv.append("-clear-llm-cache")
     # if args.without_html:
     #     new_argv.append("--without-html")
 
@@ -3,6 +3,9 @@ import os
 import traceback
 from datetime import datetime, timedelta
 
+from services.journal import file_fingerprint
+from services.llm import configure_llm_cache, get_connection_stats, get_llm_cache_stats
+
 with open("./hierarchical_specs.json") as f:
     specs = json.load(f)
 
@@ -12,7 +15,7 @@ def validate_config(config):
         raise Exception("Missing required field 'input' in config")
     if "question" not in config:
         raise Exception("Missing required field 'question' in config")
-    valid_fields = ["input", "question", "model", "name", "intro"]
+    valid_fields = ["input", "question", "model", "name", "intro", "llm_cache"]
     step_names = [x["step"] for x in specs]
     for key in config:
         if key not in valid_fields and key not in step_names:
@@ -106,6 +109,10 @@ def initialization(sysargv):
             config["only"] = sysargv[i + 1]
         if option == "-skip-interaction":
             config["skip-interaction"] = True
+        if option == "-no-llm-cache":
+            config["no-llm-cache"] = True
+        if option == "-clear-llm-cache":
+            config["clear-llm-cache"] = True
         # if option == "--without-html":
         #     config["without-html"] = True
 
@@ -134,6 +141,13 @@ def initialization(sysargv):
     if "is_pubcom" not in config:
         config["is_pubcom"] = True # デフォルト値を True に設定
 
+    # LLM応答キャッシュの設定（--no-llm-cache / --clear-llm-cache で上書き可能）
+    llm_cache_config = {"enabled": True, **config.get("llm_cache", {})}
+    if config.get("no-llm-cache", False):
+        llm_cache_config["enabled"] = False
+    llm_cache_config["clear"] = config.get("clear-llm-cache", False)
+    configure_llm_cache(**llm_cache_config)
+
     # prepare configs for each jobs
     for step_spec in specs:
         step = step_spec["step"]
@@ -150,6 +164,9 @@ def initialization(sysargv):
                 config[step]["source_code"] = f.read()
         except Exception:
             print(f"Warning: could not find source code for step '{step}'")
+        # 入力CSVにコメントを追加・変更した場合に extraction 以降を実行し直すため、内容のハッシュを記録する
+        if step == "extraction" and os.path.exists(f"inputs/{config['input']}.csv"):
+            config[step]["input_fingerprint"] = file_fingerprint(f"inputs/{config['input']}.csv")
         # resolve common options for llm-based jobs
         if step_spec.get("use_llm", False):
             # resolve prompt
@@ -223,8 +240,22 @@ def run_step(step, func, config):
         },
     )
     print("Running step:", step)
+    llm_cache_before = get_llm_cache_stats()
     # run the step...
     func(config)
+    llm_cache_after = get_llm_cache_stats()
+    llm_cache_stats = {
+        "hits": llm_cache_after["hits"] - llm_cache_before["hits"],
+        "misses": llm_cache_after["misses"] - llm_cache_before["misses"],
+    }
+    if llm_cache_stats["hits"] or llm_cache_stats["misses"]:
+        print(f"LLM cache for '{step}': {llm_cache_stats['hits']} hits, {llm_cache_stats['misses']} misses")
+    connection_stats = get_connection_stats()
+    for client_name, stats in connection_stats.items():
+        print(
+            f"HTTP connections ({client_name}): {stats['requests']} requests, "
+            f"{stats['new_connections']} new connections, {stats['tls_handshakes']} TLS handshakes"
+        )
     # update status after running...
     update_status(
         config,
@@ -241,6 +272,8 @@ def run_step(step, func, config):
                         - datetime.fromisoformat(config["current_job_started"])
                     ).total_seconds(),
                     "params": config[step],
+                    "llm_cache": llm_cache_stats,
+                    "http_connections": connection_stats,
                 }
             ],
         },
@@ -0,0 +1,392 @@
+"""asyncioベースのLLMクライアント
+
+全ステップで1つのイベントループ・1つのHTTPクライアント(services.llm.get_client)・1つのレート制御器を共有する。
+レート制御は requests/min と tokens/min のトークンバケットで行い、429応答の Retry-After を尊重する。
+
+.env で以下を設定できる（0は無制限）:
+    LLM_MAX_CONCURRENCY: 同時に送信するリクエスト数の上限（全ステップ合計）
+    LLM_REQUESTS_PER_MINUTE: 1分あたりのリクエスト数の上限
+    LLM_TOKENS_PER_MINUTE: 1分あたりのトークン数の上限
+    LLM_MAX_RETRIES: レート制限・一時的なエラー時のリトライ回数
+"""
+
+import asyncio
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+from collections.abc import Awaitable, Callable, Hashable, Iterable, Iterator, Mapping
+from typing import Any
+
+import openai
+from tqdm import tqdm
+
+from services.llm import (
+    CHAT_SEED,
+    CHAT_TEMPERATURE,
+    GEMINI_OPENAI_BASE_URL,
+    estimate_tokens,
+    get_cached_chat_response,
+    get_chat_provider,
+    get_client,
+    store_chat_response,
+)
+
+# 応答側のトークン数は事前に分からないため、見積もりに一律で加算する（応答後に実測値で補正）
+ESTIMATED_COMPLETION_TOKENS = 256
+REQUEST_TIMEOUT = 30
+
+
+def _env_int(name: str, default: int) -> int:
+    return int(os.getenv(name, default))
+
+
+class TokenBucketRateLimiter:
+    """requests/min と tokens/min の2つのトークンバケットでリクエストを間引く
+
+    バケット容量は1分間の上限の1/6（10秒分）とし、短時間にリクエストが集中しないようにする。
+    """
+
+    def __init__(self, requests_per_minute: int = 0, tokens_per_minute: int = 0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._request_capacity = max(1.0, requests_per_minute / 6)
+        self._token_capacity = max(1.0, tokens_per_minute / 6)
+        self._requests = self._request_capacity
+        self._tokens = self._token_capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._updated_at
+        self._updated_at = now
+        if self.requests_per_minute:
+            self._requests = min(self._request_capacity, self._requests + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute:
+            self._tokens = min(self._token_capacity, self._tokens + elapsed * self.tokens_per_minute / 60)
+
+    def _wait_time(self, tokens: int) -> float:
+        wait = max(0.0, self._paused_until - time.monotonic())
+        if self.requests_per_minute and self._requests < 1:
+            wait = max(wait, (1 - self._requests) * 60 / self.requests_per_minute)
+        if self.tokens_per_minute:
+            # 1リクエストがバケット容量を超える場合は満タンになるまで待って送る
+            needed = min(tokens, self._token_capacity)
+            if self._tokens < needed:
+                wait = max(wait, (needed - self._tokens) * 60 / self.tokens_per_minute)
+        return wait
+
+    async def acquire(self, tokens: int) -> None:
+        async with self._lock:
+            while True:
+                self._refill()
+                wait = self._wait_time(tokens)
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            if self.requests_per_minute:
+                self._requests -= 1
+            if self.tokens_per_minute:
+                self._tokens -= tokens
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: int | None) -> None:
+        """見積もりと実際の消費トークン数の差をバケットに反映する"""
+        if self.tokens_per_minute and actual_tokens is not None:
+            self._tokens = min(self._token_capacity, self._tokens + estimated_tokens - actual_tokens)
+
+    def pause(self, seconds: float) -> None:
+        """Retry-After 等で指定された時間、全リクエストの送信を止める"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+def _retry_after_seconds(error: openai.APIStatusError) -> float | None:
+    headers = error.response.headers if error.response is not None else {}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        # HTTP-date形式のRetry-Afterは扱わず指数バックオフに任せる
+        pass
+    return None
+
+
+class _AsyncLLMService:
+    """イベントループを専用スレッドで動かし、クライアント・セマフォ・レート制御器を保持する"""
+
+    def __init__(self):
+        self.max_concurrency = _env_int("LLM_MAX_CONCURRENCY", 64)
+        self.max_retries = _env_int("LLM_MAX_RETRIES", 5)
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="async-llm", daemon=True)
+        self._thread.start()
+        self._client = None
+        self._semaphore = None
+        self._limiter = None
+
+    def _ensure_initialized(self) -> None:
+        # イベントループ上で生成する（asyncioのプリミティブ・HTTPクライアントはループに紐づくため）
+        if self._client is not None:
+            return
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._limiter = TokenBucketRateLimiter(
+            requests_per_minute=_env_int("LLM_REQUESTS_PER_MINUTE", 0),
+            tokens_per_minute=_env_int("LLM_TOKENS_PER_MINUTE", 0),
+        )
+        if get_chat_provider() == "azure":
+            self._client = get_client(
+                "azure",
+                os.getenv("AZURE_CHATCOMPLETION_ENDPOINT"),
+                os.getenv("AZURE_CHATCOMPLETION_API_KEY"),
+                os.getenv("AZURE_CHATCOMPLETION_VERSION"),
+                is_async=True,
+                pool_size=self.max_concurrency,
+            )
+        else:
+            self._client = get_client(
+                "openai",
+                GEMINI_OPENAI_BASE_URL,
+                os.getenv("GEMINI_API_KEY"),
+                is_async=True,
+                pool_size=self.max_concurrency,
+            )
+
+    async def chat(self, messages: list[dict], model: str, is_json: bool) -> str:
+        self._ensure_initialized()
+        if get_chat_provider() == "azure":
+            request_model = os.getenv("AZURE_CHATCOMPLETION_DEPLOYMENT_NAME")
+            seed = CHAT_SEED
+        else:
+            request_model = model
+            seed = None
+        estimated_tokens = estimate_tokens(messages) + ESTIMATED_COMPLETION_TOKENS
+
+        for attempt in range(self.max_retries + 1):
+            await self._limiter.acquire(estimated_tokens)
+            try:
+                async with self._semaphore:
+                    response = await self._client.chat.completions.create(
+                        model=request_model,
+                        messages=messages,
+                        temperature=CHAT_TEMPERATURE,
+                        n=1,
+                        seed=seed,
+                        response_format={"type": "json_object"} if is_json else None,
+                        timeout=REQUEST_TIMEOUT,
+                    )
+            except openai.RateLimitError as e:
+                if attempt == self.max_retries:
+                    raise
+                wait = _retry_after_seconds(e) or min(60, 2 ** (attempt + 1))
+                logging.warning(f"OpenAI API rate limit hit, retrying after {wait:.1f}s: {e}")
+                self._limiter.pause(wait)
+            except (openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError) as e:
+                if attempt == self.max_retries:
+                    raise
+                wait = min(20, 2 ** (attempt + 1))
+                logging.warning(f"OpenAI API transient error, retrying after {wait}s: {e}")
+                await asyncio.sleep(wait)
+            else:
+                usage = getattr(response, "usage", None)
+                self._limiter.record_usage(estimated_tokens, getattr(usage, "total_tokens", None))
+                return response.choices[0].message.content
+
+
+_service: _AsyncLLMService | None = None
+_service_lock = threading.Lock()
+
+
+def _get_service() -> _AsyncLLMService:
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = _AsyncLLMService()
+        return _service
+
+
+async def request_to_chat_llm_async(
+    messages: list[dict],
+    model: str = "gpt-4o",
+    is_json: bool = False,
+) -> str:
+    """request_to_chat_llm の非同期版（応答キャッシュも共有する）"""
+    cached, cache_key = get_cached_chat_response(messages, model, is_json)
+    if cached is not None:
+        return cached
+    response = await _get_service().chat(messages, model, is_json)
+    store_chat_response(cache_key, response)
+    return response
+
+
+def run_concurrently(
+    func: Callable[[Any], Awaitable[Any]],
+    items: Iterable,
+    max_in_flight: int,
+) -> Iterator[tuple[int, Any]]:
+    """非同期関数 func を items の各要素に適用し、完了した順に (入力の位置, 結果) を返す
+
+    items は必要になった時点で1件ずつ読み出すため、ジェネレータを渡してもよい。
+    同時実行数は max_in_flight で制限される（全ステップ合計の上限は LLM_MAX_CONCURRENCY）。
+    func が例外を送出した場合は、結果としてその例外オブジェクトを返す。
+    """
+
+    async def feed(put: Callable[[tuple[int, Any]], None]) -> None:
+        async def run_one(index: int, item) -> None:
+            put((index, await _call_capturing_errors(func, item)))
+
+        in_flight: set[asyncio.Task] = set()
+        try:
+            for index, item in enumerate(items):
+                while len(in_flight) >= max_in_flight:
+                    _, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                in_flight.add(asyncio.ensure_future(run_one(index, item)))
+            if in_flight:
+                await asyncio.wait(in_flight)
+        except asyncio.CancelledError:
+            for task in in_flight:
+                task.cancel()
+            raise
+
+    return _iterate_on_loop(feed)
+
+
+def run_graph_concurrently(
+    func: Callable[[Hashable, Mapping[Hashable, Any]], Awaitable[Any]],
+    dependencies: Mapping[Hashable, Iterable[Hashable]],
+    max_in_flight: int,
+    resolve: Callable[[Hashable, Mapping[Hashable, Any]], Any | None] | None = None,
+    completed: Mapping[Hashable, Any] | None = None,
+    batch_size: int = 1,
+) -> Iterator[tuple[Hashable, Any]]:
+    """依存関係のあるノードに非同期関数 func を適用し、完了した順に (ノード, 結果) を返す
+
+    dependencies はノード → 依存先のノードの辞書で、各ノードは依存先が全て完了した時点で開始する
+    （階層の区切りを待たないため、同時実行数は最後まで max_in_flight に保たれる）。
+    依存先には、結果が既に分かっている completed のノードも指定できる（これらは実行も返却もしない）。
+    func と resolve には、completed とそれまでに完了したノードの結果の辞書が渡される。
+    resolve(node, results) が None 以外を返したノードは func を呼ばずにその値を結果とし、同時実行数を消費しない。
+    func または resolve が例外を送出した場合は結果としてその例外オブジェクトを返し、そのノードに依存するノードは実行しない。
+
+    batch_size が2以上の場合、func は開始できるノードを最大 batch_size 件ずつまとめたリスト nodes で呼ばれ、
+    ノード → 結果 の辞書を返す（辞書に含まれないノードは KeyError を結果とする）。
+    batch_size 件に満たないまとまりは、実行中のノードが無くなった時点で開始する
+    （実行中のノードの完了で開始できるノードが増え、まとまりが大きくなるのを待つ）。
+    """
+    completed = completed or {}
+    remaining = {
+        node: {dependency for dependency in node_dependencies if dependency not in completed}
+        for node, node_dependencies in dependencies.items()
+    }
+    dependants: dict[Hashable, list[Hashable]] = {node: [] for node in remaining}
+    for node, node_dependencies in remaining.items():
+        for dependency in node_dependencies:
+            dependants[dependency].append(node)
+
+    async def feed(put: Callable[[tuple[Hashable, Any]], None]) -> None:
+        results: dict[Hashable, Any] = dict(completed)
+        pending: deque[Hashable] = deque()
+
+        def complete(node: Hashable, result) -> None:
+            put((node, result))
+            if isinstance(result, BaseException):
+                return
+            results[node] = result
+            for dependant in dependants[node]:
+                remaining[dependant].discard(node)
+                if not remaining[dependant]:
+                    make_ready(dependant)
+
+        def make_ready(node: Hashable) -> None:
+            try:
+                value = resolve(node, results) if resolve is not None else None
+            except BaseException as e:
+                # func の例外と同じく、呼び出し側のスレッドでそのノードの結果として受け取る
+                complete(node, e)
+                return
+            if value is None:
+                pending.append(node)
+            else:
+                complete(node, value)
+
+        for node in [node for node, node_dependencies in remaining.items() if not node_dependencies]:
+            make_ready(node)
+        in_flight: dict[asyncio.Task, Hashable | list[Hashable]] = {}
+        try:
+            while pending or in_flight:
+                while pending and len(in_flight) < max_in_flight:
+                    if batch_size == 1:
+                        node = pending.popleft()
+                        in_flight[asyncio.ensure_future(_call_capturing_errors(func, node, results))] = node
+                        continue
+                    if len(pending) < batch_size and in_flight:
+                        break
+                    nodes = [pending.popleft() for _ in range(min(batch_size, len(pending)))]
+                    in_flight[asyncio.ensure_future(_call_capturing_errors(func, nodes, results))] = nodes
+                done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    node, result = in_flight.pop(task), task.result()
+                    if batch_size == 1:
+                        complete(node, result)
+                        continue
+                    for batch_node in node:
+                        if isinstance(result, BaseException):
+                            complete(batch_node, result)
+                        elif batch_node in result:
+                            complete(batch_node, result[batch_node])
+                        else:
+                            complete(batch_node, KeyError(batch_node))
+        except BaseException:
+            # 中断された場合や予期しない例外の場合も、実行中のタスクを共有のイベントループに残さない
+            for task in in_flight:
+                task.cancel()
+            raise
+
+    return _iterate_on_loop(feed)
+
+
+async def _call_capturing_errors(func: Callable[..., Awaitable[Any]], *args):
+    try:
+        return await func(*args)
+    except asyncio.CancelledError:
+        raise
+    except BaseException as e:
+        # KeyboardInterrupt等がイベントループのスレッドを止めないよう、呼び出し側のスレッドで送出させる
+        return e
+
+
+def _iterate_on_loop(feed: Callable[[Callable[[Any], None]], Awaitable[None]]) -> Iterator:
+    """feed(put) を共有のイベントループで実行し、put された値を呼び出し側のスレッドで順に返す"""
+    service = _get_service()
+    results: queue.Queue = queue.Queue()
+    finished = object()
+
+    future = asyncio.run_coroutine_threadsafe(feed(results.put), service.loop)
+    future.add_done_callback(lambda _: results.put(finished))
+    try:
+        while (entry := results.get()) is not finished:
+            if not isinstance(entry[1], Exception) and isinstance(entry[1], BaseException):
+                raise entry[1]
+            yield entry
+        future.result()
+    finally:
+        future.cancel()
+
+
+def map_concurrently(
+    func: Callable[[Any], Awaitable[Any]],
+    items: list,
+    max_in_flight: int,
+    desc: str | None = None,
+) -> list:
+    """run_concurrently の結果を入力と同じ順序のリストで返す（例外があれば送出する）"""
+    results = [None] * len(items)
+    for index, result in tqdm(run_concurrently(func, items, max_in_flight), total=len(items), desc=desc):
+        if isinstance(result, Exception):
+            raise result
+        results[index] = result
+    return results
@@ -0,0 +1,302 @@
+"""バッチAPI経由でLLMリクエストをまとめて実行する
+
+全リクエストをOpenAIのBatch API形式のJSONLファイルに書き出してバックエンドに投入し、
+完了するまでポーリングしてから応答を取り込む。即時性は無いが、夜間バッチなどでスループットあたりの
+コストを下げたい場合に使う。
+
+バックエンド:
+    openai: OpenAI/Azure OpenAIのBatch API（.env の USE_AZURE で切り替え）
+    local: ローカルディレクトリ上でバッチを1件ずつ処理するスタンドイン
+        （local_responses に用意した応答のJSONLを指定すると、ネットワークなしで流れを確認できる）
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from collections.abc import Callable
+from dataclasses import dataclass
+
+from services.llm import (
+    CHAT_SEED,
+    CHAT_TEMPERATURE,
+    GEMINI_OPENAI_BASE_URL,
+    get_cached_chat_response,
+    get_chat_provider,
+    get_client,
+    request_to_chat_llm,
+    store_chat_response,
+)
+
+DEFAULT_LOCAL_BATCH_DIR = "cache/local_batches"
+TERMINAL_BATCH_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+@dataclass
+class BatchRequest:
+    custom_id: str
+    messages: list[dict]
+    model: str
+    is_json: bool = False
+
+
+def _request_line(request: BatchRequest, url: str) -> dict:
+    if get_chat_provider() == "azure":
+        # Azureではmodel引数ではなくデプロイメント名のモデルが使われる
+        body = {"model": os.getenv("AZURE_CHATCOMPLETION_DEPLOYMENT_NAME"), "seed": CHAT_SEED}
+    else:
+        body = {"model": request.model}
+    body.update({"messages": request.messages, "temperature": CHAT_TEMPERATURE, "n": 1})
+    if request.is_json:
+        body["response_format"] = {"type": "json_object"}
+    return {"custom_id": request.custom_id, "method": "POST", "url": url, "body": body}
+
+
+def write_batch_file(path: str, requests: list[BatchRequest], url: str = "/v1/chat/completions") -> None:
+    """リクエストをBatch API形式のJSONLとして書き出す"""
+    with open(path, "w", encoding="utf-8") as f:
+        for request in requests:
+            f.write(json.dumps(_request_line(request, url), ensure_ascii=False) + "\n")
+
+
+def _response_content(result: dict) -> str | None:
+    """Batch APIの出力1行から応答本文を取り出す（失敗したリクエストはNone）"""
+    response = result.get("response") or {}
+    if result.get("error") or response.get("status_code") != 200:
+        return None
+    try:
+        return response["body"]["choices"][0]["message"]["content"]
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+class BatchBackend:
+    """バッチの投入・状態確認・結果取得を行うバックエンドの基底クラス"""
+
+    # バッチファイルの各行に書くエンドポイント
+    url = "/v1/chat/completions"
+    # Falseの場合、run_batch はLLM応答キャッシュを参照・保存しない（用意した応答を返すスタンドイン用）
+    caches_responses = True
+
+    def submit(self, path: str) -> str:
+        """バッチファイルを投入し、バッチIDを返す"""
+        raise NotImplementedError
+
+    def status(self, batch_id: str) -> str:
+        """バッチの状態を返す（完了・失敗時は TERMINAL_BATCH_STATUSES のいずれか）"""
+        raise NotImplementedError
+
+    def results(self, batch_id: str) -> list[dict]:
+        """Batch APIの出力形式 ({"custom_id", "response", "error"}) の行のリストを返す"""
+        raise NotImplementedError
+
+
+class OpenAIBatchBackend(BatchBackend):
+    """OpenAI互換のBatch API（Azure OpenAI / Gemini）にバッチを投入する"""
+
+    def __init__(self):
+        if get_chat_provider() == "azure":
+            self.url = "/chat/completions"
+            self._client = get_client(
+                "azure",
+                os.getenv("AZURE_CHATCOMPLETION_ENDPOINT"),
+                os.getenv("AZURE_CHATCOMPLETION_API_KEY"),
+                os.getenv("AZURE_CHATCOMPLETION_VERSION"),
+            )
+        else:
+            self._client = get_client("openai", GEMINI_OPENAI_BASE_URL, os.getenv("GEMINI_API_KEY"))
+
+    def submit(self, path: str) -> str:
+        with open(path, "rb") as f:
+            input_file = self._client.files.create(file=f, purpose="batch")
+        batch = self._client.batches.create(
+            input_file_id=input_file.id, endpoint=self.url, completion_window="24h"
+        )
+        return batch.id
+
+    def status(self, batch_id: str) -> str:
+        return self._client.batches.retrieve(batch_id).status
+
+    def results(self, batch_id: str) -> list[dict]:
+        batch = self._client.batches.retrieve(batch_id)
+        lines = []
+        # 期限切れ・キャンセル時も処理済みの分は出力ファイルに含まれる
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                lines += self._client.files.content(file_id).text.splitlines()
+        return [json.loads(line) for line in lines if line.strip()]
+
+
+class LocalBatchBackend(BatchBackend):
+    """ローカルディレクトリをバッチAPIに見立てたスタンドイン
+
+    submit() でバッチファイルを directory/<バッチID>/input.jsonl にコピーし、最初に status() が
+    呼ばれた時点で responder を使って全リクエストを順に処理して output.jsonl を書き出す。
+    responder の既定値は request_to_chat_llm だが、応答を返す関数（CannedResponder 等）を渡せばネットワークなしで
+    実行できる。その場合の応答は実際のLLMの応答ではないため、LLM応答キャッシュには保存しない。
+    """
+
+    def __init__(
+        self,
+        directory: str = DEFAULT_LOCAL_BATCH_DIR,
+        responder: Callable[[list[dict], str, bool], str] | None = None,
+    ):
+        self.directory = directory
+        self.caches_responses = responder is None
+        self.responder = responder or (lambda messages, model, is_json: request_to_chat_llm(messages, model, is_json))
+
+    def _batch_dir(self, batch_id: str) -> str:
+        return os.path.join(self.directory, batch_id)
+
+    def submit(self, path: str) -> str:
+        batch_id = f"local_{uuid.uuid4().hex}"
+        os.makedirs(self._batch_dir(batch_id))
+        shutil.copyfile(path, os.path.join(self._batch_dir(batch_id), "input.jsonl"))
+        return batch_id
+
+    def status(self, batch_id: str) -> str:
+        output_path = os.path.join(self._batch_dir(batch_id), "output.jsonl")
+        if not os.path.exists(output_path):
+            self._process(batch_id, output_path)
+        return "completed"
+
+    def _process(self, batch_id: str, output_path: str) -> None:
+        with open(os.path.join(self._batch_dir(batch_id), "input.jsonl"), encoding="utf-8") as f:
+            request_lines = [json.loads(line) for line in f if line.strip()]
+        output_lines = []
+        for line in request_lines:
+            body = line["body"]
+            is_json = body.get("response_format", {}).get("type") == "json_object"
+            try:
+                content = self.responder(body["messages"], body["model"], is_json)
+                result = {
+                    "custom_id": line["custom_id"],
+                    "response": {"status_code": 200, "body": {"choices": [{"message": {"content": content}}]}},
+                    "error": None,
+                }
+            except Exception as e:
+                result = {"custom_id": line["custom_id"], "response": None, "error": {"message": repr(e)}}
+            output_lines.append(json.dumps(result, ensure_ascii=False))
+        # 途中で止まった場合に不完全な出力が完了扱いされないよう、書き終えてから置き換える
+        with open(output_path + ".tmp", "w", encoding="utf-8") as f:
+            f.write("\n".join(output_lines) + "\n")
+        os.replace(output_path + ".tmp", output_path)
+
+    def results(self, batch_id: str) -> list[dict]:
+        with open(os.path.join(self._batch_dir(batch_id), "output.jsonl"), encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+
+class CannedResponder:
+    """local_responses のJSONLに用意した応答を返す、LocalBatchBackend 用の responder
+
+    各行は {"match": 文字列, "response": 応答本文}。メッセージの本文に match を含む最初の行の response を返し、
+    該当する行が無い場合は match の無い行（既定の応答）の response を返す。どちらも無いリクエストは失敗とする。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, encoding="utf-8") as f:
+            self.entries = [json.loads(line) for line in f if line.strip()]
+
+    def __call__(self, messages: list[dict], model: str, is_json: bool) -> str:
+        text = "\n".join(message.get("content") or "" for message in messages)
+        for entry in self.entries:
+            if entry.get("match") is not None and entry["match"] in text:
+                return entry["response"]
+        for entry in self.entries:
+            if entry.get("match") is None:
+                return entry["response"]
+        raise LookupError(f"No canned response in {self.path} matches the request")
+
+
+def get_batch_backend(name: str, local_responses: str | None = None) -> BatchBackend:
+    """name のバックエンドを返す（local_responses は "local" で CannedResponder に使う応答のJSONLのパス）"""
+    if name == "openai":
+        if local_responses is not None:
+            raise ValueError("batch_local_responses can only be used with batch_backend 'local'")
+        return OpenAIBatchBackend()
+    if name == "local":
+        return LocalBatchBackend(responder=CannedResponder(local_responses) if local_responses is not None else None)
+    raise ValueError(f"Unknown batch backend: {name}, available backends: ['openai', 'local']")
+
+
+def _requests_hash(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def run_batch(
+    requests: list[BatchRequest],
+    backend: BatchBackend,
+    work_path: str,
+    poll_interval: float = 60,
+) -> dict[str, str | None]:
+    """requests をバッチとして実行し、{custom_id: 応答本文} を返す（失敗したリクエストはNone）
+
+    応答キャッシュにあるリクエストは投入しない（backend.caches_responses がFalseの場合はキャッシュを使わない）。
+    投入したバッチのIDは work_path + ".state.json" に
+    保存するため、ポーリング中に中断しても再実行時には同じバッチの完了を待って結果を取り込む。
+
+    Args:
+        requests: 実行するリクエスト
+        backend: バッチを投入するバックエンド
+        work_path: バッチファイル(JSONL)の書き出し先
+        poll_interval: 状態確認の間隔（秒）
+    """
+    responses: dict[str, str | None] = {}
+    cache_keys: dict[str, str | None] = {}
+    pending = []
+    for request in requests:
+        if backend.caches_responses:
+            cached, cache_key = get_cached_chat_response(request.messages, request.model, request.is_json)
+        else:
+            cached, cache_key = None, None
+        if cached is not None:
+            responses[request.custom_id] = cached
+        else:
+            cache_keys[request.custom_id] = cache_key
+            pending.append(request)
+    if not pending:
+        return responses
+
+    write_batch_file(work_path, pending, backend.url)
+    requests_hash = _requests_hash(work_path)
+    state_path = work_path + ".state.json"
+    batch_id = None
+    if os.path.exists(state_path):
+        with open(state_path, encoding="utf-8") as f:
+            state = json.load(f)
+        if state.get("requests_hash") == requests_hash:
+            batch_id = state["batch_id"]
+            print(f"Resuming batch {batch_id}")
+    if batch_id is None:
+        batch_id = backend.submit(work_path)
+        with open(state_path, "w", encoding="utf-8") as f:
+            json.dump({"batch_id": batch_id, "requests_hash": requests_hash}, f)
+        print(f"Submitted batch {batch_id} with {len(pending)} requests")
+
+    while (status := backend.status(batch_id)) not in TERMINAL_BATCH_STATUSES:
+        logging.info(f"Batch {batch_id} is {status}, checking again in {poll_interval}s")
+        time.sleep(poll_interval)
+    if status != "completed":
+        logging.warning(f"Batch {batch_id} finished with status '{status}', ingesting partial results")
+
+    for result in backend.results(batch_id):
+        custom_id = result.get("custom_id")
+        if custom_id not in cache_keys:
+            continue
+        content = _response_content(result)
+        if content is None:
+            logging.error(f"Batch request {custom_id} failed: {result.get('error') or result.get('response')}")
+        responses[custom_id] = content
+        store_chat_response(cache_keys[custom_id], content)
+
+    os.remove(state_path)
+    os.remove(work_path)
+    for request in pending:
+        responses.setdefault(request.custom_id, None)
+    return responses
@@ -1,10 +1,13 @@
-import concurrent.futures
 import json
 
 import pandas as pd
 from tqdm import tqdm
 
-from services.llm import request_to_chat_llm
+from services.async_llm import request_to_chat_llm_async, run_concurrently
+from services.batch_llm import BatchRequest, get_batch_backend, run_batch
+from services.embedding_cache import text_hash
+from services.journal import ResultsJournal, fingerprint
+from services.llm import evict_chat_response
 
 BASE_CLASSIFICATION_PROMPT = """与えられた意見群をカテゴリに分類してください
 
@@ -112,45 +115,121 @@ def _parse_arg_result(classification_results: dict, arg_id: str, categories: lis
     return parsed_result
 
 
-def classify_batch_args(batch_args: pd.DataFrame, categories: dict, model: str) -> dict:
+def _build_classification_messages(batch_args: pd.DataFrame, categories: dict) -> list[dict]:
     category_string = _build_categories_string(categories)
     batch_args_string = _build_batch_args_string(batch_args)
     prompt = BASE_CLASSIFICATION_PROMPT.format(categories_string=category_string, args_string=batch_args_string)
-    result = request_to_chat_llm(
-        messages=[
-            {"role": "system", "content": prompt},
-        ],
+    return [{"role": "system", "content": prompt}]
+
+
+def _parse_classification_response(result: str) -> dict | None:
+    """応答を {arg-id: 分類結果} に変換する（パースできない・空の場合はNone）"""
+    try:
+        classification_results = json.loads(result)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(classification_results, dict) or not classification_results:
+        return None
+    return classification_results
+
+
+async def classify_batch_args(batch_args: pd.DataFrame, categories: dict, model: str) -> dict | None:
+    messages = _build_classification_messages(batch_args, categories)
+    result = await request_to_chat_llm_async(
+        messages=messages,
         model=model,
         is_json=True,
     )
-    try:
-        return json.loads(result)
-    except json.JSONDecodeError:
-        return {}
+    classification_results = _parse_classification_response(result)
+    if classification_results is None:
+        # パースできなかった応答はキャッシュに残さず、次回の実行で送り直す
+        evict_chat_response(messages, model, is_json=True)
+    return classification_results
+
+
+def classify_batches_with_batch_api(batches: list[pd.DataFrame], categories: dict, config):
+    """各バッチの分類リクエストをバッチAPIでまとめて実行し、(バッチの位置, 分類結果) を返す（失敗・パースできなかったバッチはNone）"""
+    requests = [
+        BatchRequest(
+            custom_id=str(index),
+            messages=_build_classification_messages(batch_args, categories),
+            model=config["extraction"]["model"],
+            is_json=True,
+        )
+        for index, batch_args in enumerate(batches)
+    ]
+    responses = run_batch(
+        requests,
+        get_batch_backend(config["extraction"]["batch_backend"], config["extraction"]["batch_local_responses"]),
+        f"outputs/{config['output_dir']}/classification_batch.jsonl",
+        poll_interval=config["extraction"]["batch_poll_interval"],
+    )
+    for index in range(len(batches)):
+        response = responses[str(index)]
+        if response is None:
+            yield index, None
+            continue
+        classification_results = _parse_classification_response(response)
+        if classification_results is None:
+            # パースできなかった応答はキャッシュに残さず、次回の実行で送り直す
+            evict_chat_response(requests[index].messages, requests[index].model, is_json=True)
+        yield index, classification_results
 
 
 def classify_args(args: pd.DataFrame, config, workers: int) -> pd.DataFrame:
     batch_size = config["extraction"]["category_batch_size"]
+    categories = config["extraction"]["categories"]
+    model = config["extraction"]["model"]
 
+    # バッチの結果を1件ずつジャーナルに追記し、中断後の再実行では未分類の意見だけを分類する
+    journal = ResultsJournal(
+        f"outputs/{config['output_dir']}/classification_journal.jsonl",
+        fingerprint(categories, model),
+    )
     classification_results = {}
-    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
-        batch_start_indices = range(0, len(args), batch_size)
-        future_to_batch = {
-            executor.submit(
-                classify_batch_args,
-                args.loc[batch_idx : batch_idx + batch_size],
-                config["extraction"]["categories"],
-                config["extraction"]["model"],
-            ): batch_idx
-            for batch_idx in batch_start_indices
-        }
-        for future in tqdm(
-            concurrent.futures.as_completed(future_to_batch),
-            total=len(batch_start_indices),
-            desc="Classifying arguments",
-        ):
-            result = future.result()
-            classification_results.update(result)
+    journal_keys = {
+        arg_id: f"{arg_id}:{text_hash(argument)}"
+        for arg_id, argument in zip(args["arg-id"], args["argument"], strict=True)
+    }
+    journaled = journal.load()
+    for arg_id, key in journal_keys.items():
+        if key in journaled:
+            classification_results[arg_id] = journaled[key]
+    pending_args = args[~args["arg-id"].isin(classification_results.keys())]
+    if len(pending_args) < len(args):
+        print(f"Resuming classification: {len(args) - len(pending_args)} arguments found in journal")
+    journal.open(journaled)
+
+    batches = [pending_args.iloc[i : i + batch_size] for i in range(0, len(pending_args), batch_size)]
+    if config["extraction"]["execution"] == "batch":
+        batch_results = classify_batches_with_batch_api(batches, categories, config)
+    else:
+        batch_results = run_concurrently(
+            lambda batch: classify_batch_args(batch, categories, model),
+            batches,
+            max_in_flight=workers,
+        )
+    failed = 0
+    for index, result in tqdm(batch_results, total=len(batches), desc="Classifying arguments"):
+        if isinstance(result, Exception):
+            journal.close()
+            raise result
+        for arg_id in batches[index]["arg-id"]:
+            if result is None or arg_id not in result:
+                # 失敗した・応答をパースできなかった・応答に含まれない意見はジャーナルに残さない
+                # （分類なしとして出力し、ジャーナルは最後に削除せず残す）
+                classification_results[arg_id] = {}
+                failed += 1
+                continue
+            arg_result = result[arg_id]
+            classification_results[arg_id] = arg_result
+            journal.append(journal_keys[arg_id], arg_result)
+    if failed:
+        # 抽出ステップを再実行すると、ジャーナルにない失敗した意見だけを再度分類する
+        journal.close()
+        print(f"Classification failed for {failed} arguments, keeping {journal.path} to retry them on the next run")
+    else:
+        journal.remove()
 
     # 結果をdataframeに変換し、argsにjoinする
     results = []
@@ -0,0 +1,18 @@
+"""クラスタIDから、そのクラスタに属する意見の行番号を引く索引
+
+ラベリングのステップでは、クラスタ毎に `df[df[column] == cluster_id]` で絞り込むと
+1回毎にDataFrame全体を走査するため、全体で (クラスタ数 × 意見数) の計算量になる。
+列毎に1回だけ groupby して索引を作り、各ワーカー・各階層で共有する。
+"""
+
+import numpy as np
+import pandas as pd
+
+# 列名 → (クラスタID → 行番号（昇順）の配列)
+ClusterIndex = dict[str, dict[str, np.ndarray]]
+
+
+def build_cluster_index(df: pd.DataFrame, id_columns: list[str]) -> ClusterIndex:
+    """id_columns の各列について、クラスタID毎の行番号（df.iloc で使う位置）を求める"""
+    return {column: df.groupby(column, sort=False).indices for column in id_columns}
+
@@ -0,0 +1,64 @@
+import hashlib
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+DEFAULT_EMBEDDING_CACHE_PATH = "cache/embeddings.sqlite3"
+
+# SQLiteのバインド変数上限を超えないように分割して問い合わせる
+_QUERY_CHUNK_SIZE = 900
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """(埋め込みモデル, テキストのハッシュ) をキーに埋め込みベクトルを保存する永続ストア
+
+    ベクトルはfloat32のバイト列としてSQLiteに保存する。WALモードで開くため、
+    書き込み中でも他プロセスから同時に読み出せる。
+    """
+
+    def __init__(self, path: str = DEFAULT_EMBEDDING_CACHE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, text_hash TEXT NOT NULL, dim INTEGER NOT NULL, vector BLOB NOT NULL, "
+            "PRIMARY KEY (model, text_hash)) WITHOUT ROWID"
+        )
+        self._conn.commit()
+
+    def get_many(self, model: str, texts: list[str]) -> dict[str, np.ndarray]:
+        """キャッシュ済みのベクトルを {テキストのハッシュ: ベクトル} で返す"""
+        hashes = list({text_hash(text) for text in texts})
+        found: dict[str, np.ndarray] = {}
+        with self._lock:
+            for i in range(0, len(hashes), _QUERY_CHUNK_SIZE):
+                chunk = hashes[i : i + _QUERY_CHUNK_SIZE]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                    [model, *chunk],
+                ).fetchall()
+                for hash_, vector in rows:
+                    found[hash_] = np.frombuffer(vector, dtype=np.float32)
+        return found
+
+    def put_many(self, model: str, texts: list[str], vectors) -> None:
+        rows = []
+        for text, vector in zip(texts, vectors, strict=True):
+            vector = np.asarray(vector, dtype=np.float32)
+            rows.append((model, text_hash(text), vector.shape[0], vector.tobytes()))
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, dim, vector) VALUES (?, ?, ?, ?)", rows
+            )
+            self._conn.commit()
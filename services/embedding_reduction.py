@@ -0,0 +1,83 @@
+"""クラスタリング前に埋め込み行列の次元を落とす
+
+UMAPの近傍グラフ構築は次元数に比例して重くなるため、hierarchical_clustering.pre_reduction で
+以下の方法を選んで事前に次元を削減できる。
+
+    pca: 乱択SVDによるPCAで pre_reduction_dim 次元に射影する
+    truncate: 先頭の pre_reduction_dim 次元だけを残してL2正規化する
+              （text-embedding-3 系のようにMatryoshka表現学習されたモデル向け）
+
+結果は outputs/{dataset}/embeddings_{方法}_{次元数}.npy に、学習済みの変換を同じ名前の .joblib に保存し、
+embeddings.npy が更新されるまで再利用する（変換は追加の意見を同じ空間に写すために使う）。
+"""
+
+import os
+
+import joblib
+import numpy as np
+from sklearn.decomposition import PCA
+from sklearn.preprocessing import FunctionTransformer
+
+from services.embedding_store import EMBEDDINGS_FILENAME
+
+REDUCTION_METHODS = ["pca", "truncate"]
+
+
+def make_reducer(method: str, dim: int, n_samples: int, n_features: int):
+    """method に対応する未学習の変換（fit_transform / transform を持つ）を返す"""
+    if method not in REDUCTION_METHODS:
+        raise ValueError(f"Unknown pre_reduction method: {method}, available methods: {REDUCTION_METHODS}")
+    if dim >= n_features:
+        return FunctionTransformer(_to_float32)
+    if method == "truncate":
+        return FunctionTransformer(_truncate, kw_args={"dim": dim})
+    return PCA(n_components=min(dim, n_samples), svd_solver="randomized", random_state=42)
+
+
+def _to_float32(matrix: np.ndarray) -> np.ndarray:
+    return np.asarray(matrix, dtype=np.float32)
+
+
+def _truncate(matrix: np.ndarray, dim: int) -> np.ndarray:
+    truncated = np.array(matrix[:, :dim], dtype=np.float32)
+    norms = np.linalg.norm(truncated, axis=1, keepdims=True)
+    return truncated / np.maximum(norms, 1e-12)
+
+
+def reduce_embeddings(matrix: np.ndarray, method: str, dim: int) -> np.ndarray:
+    """(意見数, 次元数) の行列を (意見数, dim) のfloat32行列にする"""
+    return fit_reducer(matrix, method, dim)[0]
+
+
+def fit_reducer(matrix: np.ndarray, method: str, dim: int):
+    """(次元削減後のfloat32行列, 学習済みの変換) を返す"""
+    reducer = make_reducer(method, dim, *matrix.shape)
+    return reducer.fit_transform(matrix).astype(np.float32, copy=False), reducer
+
+
+def load_reduced_embeddings(directory: str, matrix: np.ndarray, method: str, dim: int):
+    """(次元削減済みの行列のmmap, 学習済みの変換) を返す
+
+    未計算、または embeddings.npy の方が新しい場合は計算して保存する。
+    """
+    source_path = os.path.join(directory, EMBEDDINGS_FILENAME)
+    reduced_path = os.path.join(directory, f"embeddings_{method}_{dim}.npy")
+    reducer_path = os.path.join(directory, f"embeddings_{method}_{dim}.joblib")
+    if (
+        os.path.exists(reduced_path)
+        and os.path.exists(reducer_path)
+        and os.path.getmtime(reduced_path) >= os.path.getmtime(source_path)
+    ):
+        reduced = np.load(reduced_path, mmap_mode="r")
+        if reduced.shape[0] == matrix.shape[0]:
+            print(f"Reusing reduced embeddings {reduced_path}")
+            return reduced, joblib.load(reducer_path)
+
+    reduced, reducer = fit_reducer(matrix, method, dim)
+    joblib.dump(reducer, reducer_path)
+    # 書き込み途中のファイルを次回に再利用しないよう、書き終えてから置き換える
+    tmp_path = reduced_path + ".tmp.npy"
+    np.save(tmp_path, reduced)
+    os.replace(tmp_path, reduced_path)
+    print(f"Reduced embeddings from {matrix.shape[1]} to {reduced.shape[1]} dimensions with {method}")
+    return np.load(reduced_path, mmap_mode="r"), reducer
@@ -0,0 +1,69 @@
+"""意見の埋め込みベクトルを連続したfloat32行列として保存・読み込みする
+
+outputs/{dataset}/embeddings.npy に (意見数, 次元数) のfloat32行列を、
+outputs/{dataset}/embedding_arg_ids.csv に各行に対応する arg-id を保存する。
+読み込み時はmmapで開くため、行列全体をメモリにコピーせずに後続のステップへ渡せる。
+
+以前の形式 (embeddings.pkl: arg-id と Pythonのリストの embedding 列を持つDataFrame) は
+load_embeddings が自動で変換するほか、以下のコマンドで明示的に変換できる。
+
+    python -m services.embedding_store outputs/{dataset}
+"""
+
+import os
+import sys
+from collections.abc import Callable, Sequence
+
+import numpy as np
+import pandas as pd
+
+EMBEDDINGS_FILENAME = "embeddings.npy"
+EMBEDDING_IDS_FILENAME = "embedding_arg_ids.csv"
+LEGACY_EMBEDDINGS_FILENAME = "embeddings.pkl"
+
+
+def save_embeddings(
+    directory: str,
+    arg_ids: Sequence[str],
+    dim: int,
+    get_vector: Callable[[int], np.ndarray],
+) -> None:
+    """get_vector(i) で得られるi行目のベクトルを1行ずつ書き込む（行列全体をメモリ上に作らない）"""
+    matrix_path = os.path.join(directory, EMBEDDINGS_FILENAME)
+    tmp_path = matrix_path + ".tmp.npy"
+    matrix = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(len(arg_ids), dim))
+    for i in range(len(arg_ids)):
+        matrix[i] = get_vector(i)
+    matrix.flush()
+    del matrix
+    pd.DataFrame({"arg-id": arg_ids}).to_csv(os.path.join(directory, EMBEDDING_IDS_FILENAME), index=False)
+    # 書き込み途中で止まった行列を後続のステップが読まないよう、書き終えてから置き換える
+    os.replace(tmp_path, matrix_path)
+
+
+def load_embeddings(directory: str) -> tuple[pd.Series, np.ndarray]:
+    """(arg-id, 埋め込み行列) を返す。行列は読み取り専用のmmapで、i行目が arg-id のi番目に対応する"""
+    matrix_path = os.path.join(directory, EMBEDDINGS_FILENAME)
+    if not os.path.exists(matrix_path) and os.path.exists(os.path.join(directory, LEGACY_EMBEDDINGS_FILENAME)):
+        convert_legacy_embeddings(directory)
+    arg_ids = pd.read_csv(os.path.join(directory, EMBEDDING_IDS_FILENAME))["arg-id"]
+    matrix = np.load(matrix_path, mmap_mode="r")
+    if len(arg_ids) != matrix.shape[0]:
+        raise ValueError(
+            f"Embedding matrix has {matrix.shape[0]} rows but {EMBEDDING_IDS_FILENAME} has {len(arg_ids)} arg-ids"
+        )
+    return arg_ids, matrix
+
+
+def convert_legacy_embeddings(directory: str) -> None:
+    """embeddings.pkl を embeddings.npy + embedding_arg_ids.csv に変換する"""
+    legacy_df = pd.read_pickle(os.path.join(directory, LEGACY_EMBEDDINGS_FILENAME))
+    embeddings = legacy_df["embedding"]
+    dim = len(embeddings.iloc[0]) if len(embeddings) else 0
+    save_embeddings(directory, legacy_df["arg-id"].tolist(), dim, lambda i: embeddings.iloc[i])
+    print(f"Converted {LEGACY_EMBEDDINGS_FILENAME} in {directory} to {EMBEDDINGS_FILENAME} ({len(legacy_df)} x {dim})")
+
+
+if __name__ == "__main__":
+    for directory in sys.argv[1:]:
+        convert_legacy_embeddings(directory)
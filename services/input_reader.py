@@ -0,0 +1,85 @@
+"""入力CSV (inputs/{input}.csv) をチャンク単位で読み込む
+
+数GBのパブリックコメントでもメモリ使用量が入力サイズに比例しないよう、必要なカラムだけを
+INPUT_CHUNK_SIZE 行ずつ読み込み、必要な行だけを残す。
+"""
+
+from collections.abc import Iterator
+
+import pandas as pd
+
+INPUT_CHUNK_SIZE = 50000
+# IDのカラムは文字列として読む（チャンク毎の型推論で、NaNを含むチャンクの comment-id が "1.0" のような値にならないように）
+ID_COLUMN_DTYPES = {"comment-id": str, "arg-id": str}
+
+
+def read_input_columns(path: str) -> list[str]:
+    """ヘッダ行だけを読み込み、カラム名を返す"""
+    return list(pd.read_csv(path, nrows=0).columns)
+
+
+def iter_input_chunks(path: str, usecols, chunksize: int = INPUT_CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    yield from pd.read_csv(path, usecols=usecols, chunksize=chunksize, dtype=ID_COLUMN_DTYPES)
+
+
+def count_input_rows(path: str, chunksize: int = INPUT_CHUNK_SIZE) -> int:
+    """入力の行数を数える（本文の改行を正しく扱うため、行数ではなくCSVとしてパースして数える）"""
+    return sum(len(chunk) for chunk in iter_input_chunks(path, ["comment-id"], chunksize))
+
+
+def _non_blank_bodies(chunk: pd.DataFrame) -> pd.Series:
+    bodies = chunk["comment-body"]
+    keep = bodies.notna()
+    if not pd.api.types.is_numeric_dtype(bodies):
+        # 文字列以外の値は .str.strip() がNaNになり、空白扱いにはならない
+        keep &= ~bodies.str.strip().eq("")
+    return keep
+
+
+def iter_unique_comments(
+    path: str,
+    usecols: list[str],
+    limit: int | None = None,
+    chunksize: int = INPUT_CHUNK_SIZE,
+) -> Iterator[pd.DataFrame]:
+    """本文が空・空白のみの行と、本文が重複する行（2件目以降）を除いたコメントをチャンク単位で返す
+
+    重複の判定には本文の64bitハッシュの集合を使い、本文そのものは保持しない。
+    limit 件に達した時点で読み込みをやめる。
+    """
+    seen_hashes: set[int] = set()
+    remaining = limit
+    for chunk in iter_input_chunks(path, usecols, chunksize):
+        chunk = chunk[_non_blank_bodies(chunk)]
+        hashes = pd.util.hash_pandas_object(chunk["comment-body"], index=False).to_numpy()
+        keep = ~pd.Series(hashes).duplicated().to_numpy()
+        for i, body_hash in enumerate(hashes.tolist()):
+            if keep[i]:
+                if body_hash in seen_hashes:
+                    keep[i] = False
+                else:
+                    seen_hashes.add(body_hash)
+        chunk = chunk[keep]
+        if remaining is not None:
+            chunk = chunk.iloc[:remaining]
+            remaining -= len(chunk)
+        if len(chunk):
+            yield chunk
+        if remaining is not None and remaining <= 0:
+            return
+
+
+def read_unique_comments(path: str, usecols: list[str], limit: int | None = None) -> pd.DataFrame:
+    """iter_unique_comments の結果を1つのDataFrameにまとめて返す"""
+    chunks = list(iter_unique_comments(path, usecols, limit))
+    if not chunks:
+        return pd.read_csv(path, usecols=usecols, nrows=0, dtype=ID_COLUMN_DTYPES)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def read_comments_by_id(path: str, comment_ids: set[str], usecols) -> pd.DataFrame:
+    """comment-id（文字列として比較）が comment_ids に含まれる行だけを読み込む"""
+    chunks = [chunk[chunk["comment-id"].isin(comment_ids)] for chunk in iter_input_chunks(path, usecols)]
+    if not chunks:
+        return pd.read_csv(path, usecols=usecols, nrows=0, dtype=ID_COLUMN_DTYPES)
+    return pd.concat(chunks, ignore_index=True)
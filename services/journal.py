@@ -0,0 +1,79 @@
+import hashlib
+import json
+import logging
+import os
+from typing import Any
+
+
+def fingerprint(*values) -> str:
+    """ジャーナルの内容を無効にすべき設定（プロンプト・モデル等）からハッシュを作る"""
+    payload = json.dumps(values, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def file_fingerprint(path: str) -> str:
+    """ファイルの内容のハッシュ（入力CSVが変わったかの判定に使う）"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ResultsJournal:
+    """処理結果を1件ずつJSONLに追記するジャーナル
+
+    1行目に設定のフィンガープリントを書き、以降は {"key": ..., "value": ...} を1行ずつ追記する。
+    処理が途中で止まっても、再実行時に load() で完了済みの結果を読み出して未処理分だけ実行できる。
+    フィンガープリントが異なる（プロンプトやモデルが変わった）場合は既存の内容を破棄する。
+    """
+
+    def __init__(self, path: str, fingerprint: str):
+        self.path = path
+        self.fingerprint = fingerprint
+        self._file = None
+
+    def load(self) -> dict[str, Any]:
+        """完了済みの結果を {key: value} で返す"""
+        if not os.path.exists(self.path):
+            return {}
+        entries: dict[str, Any] = {}
+        with open(self.path, encoding="utf-8") as f:
+            header = f.readline()
+            try:
+                if json.loads(header).get("fingerprint") != self.fingerprint:
+                    logging.warning(f"Journal {self.path} was written with different settings, discarding it")
+                    return {}
+            except json.JSONDecodeError:
+                return {}
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # 書き込み途中で止まった最終行は読み飛ばす
+                    continue
+                entries[entry["key"]] = entry["value"]
+        return entries
+
+    def open(self, entries: dict[str, Any]) -> None:
+        """ジャーナルを書き込み用に開く（entries は load() の結果。無効だった場合は作り直す）"""
+        if entries and os.path.exists(self.path):
+            self._file = open(self.path, "a", encoding="utf-8")
+        else:
+            self._file = open(self.path, "w", encoding="utf-8")
+            self._file.write(json.dumps({"fingerprint": self.fingerprint}) + "\n")
+            self._file.flush()
+
+    def append(self, key: str, value: Any) -> None:
+        self._file.write(json.dumps({"key": key, "value": value}, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def remove(self) -> None:
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
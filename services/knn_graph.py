@@ -0,0 +1,58 @@
+"""UMAPに渡す近似k近傍グラフを作成・保存・読み込みする
+
+hierarchical_clustering.umap_knn に指定した .npz ファイル（indices, distances の2つの (意見数, k) 行列）を
+UMAPの precomputed_knn として渡すと、UMAP内部での近傍探索を省略できる。
+各行の先頭は自分自身（距離0）で、距離はUMAPと同じユークリッド距離である必要がある。
+GPU上のfaiss等、外部で計算したグラフも同じ形式で保存すれば利用できる。
+
+以下のコマンドで、embeddings.npy からpynndescentで近似k近傍グラフを作成して保存できる。
+
+    python -m services.knn_graph outputs/{dataset} [出力先.npz]
+"""
+
+import os
+import sys
+
+import numpy as np
+
+from services.embedding_store import load_embeddings
+
+KNN_GRAPH_FILENAME = "knn_graph.npz"
+# UMAPのn_neighbors（デフォルト15）以上である必要がある
+DEFAULT_KNN_NEIGHBORS = 15
+
+
+def build_knn_graph(matrix: np.ndarray, n_neighbors: int = DEFAULT_KNN_NEIGHBORS) -> tuple[np.ndarray, np.ndarray]:
+    """(indices, distances) を返す。pynndescentの近似探索を使う"""
+    from pynndescent import NNDescent
+
+    index = NNDescent(matrix, n_neighbors=n_neighbors, metric="euclidean", random_state=42, low_memory=True)
+    indices, distances = index.neighbor_graph
+    return indices.astype(np.int32), distances.astype(np.float32)
+
+
+def save_knn_graph(path: str, indices: np.ndarray, distances: np.ndarray) -> None:
+    np.savez(path, indices=indices, distances=distances)
+
+
+def load_knn_graph(path: str, n_samples: int) -> tuple[np.ndarray, np.ndarray]:
+    """(indices, distances) を返す。行数が意見数と一致しない場合は例外を送出する"""
+    with np.load(path) as graph:
+        indices, distances = graph["indices"], graph["distances"]
+    if indices.shape != distances.shape:
+        raise ValueError(f"indices {indices.shape} and distances {distances.shape} in {path} must have the same shape")
+    if indices.shape[0] != n_samples:
+        raise ValueError(
+            f"kNN graph {path} has {indices.shape[0]} rows but there are {n_samples} embeddings, "
+            "please rebuild it from the current embeddings"
+        )
+    return indices, distances
+
+
+if __name__ == "__main__":
+    directory = sys.argv[1]
+    output_path = sys.argv[2] if len(sys.argv) > 2 else os.path.join(directory, KNN_GRAPH_FILENAME)
+    _, embeddings = load_embeddings(directory)
+    knn_indices, knn_distances = build_knn_graph(embeddings)
+    save_knn_graph(output_path, knn_indices, knn_distances)
+    print(f"Saved {knn_indices.shape[1]}-NN graph of {knn_indices.shape[0]} embeddings to {output_path}")
@@ -1,13 +1,19 @@
-import os
+import hashlib
+import json
 import logging
+import os
+import sqlite3
+import threading
+import time
 
+import httpx
+import numpy as np
 from dotenv import load_dotenv
-from pydantic import BaseModel
 
 from google import genai
 import openai
-from openai import AzureOpenAI, OpenAI
-from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+from openai import AsyncAzureOpenAI, AsyncOpenAI, AzureOpenAI, OpenAI
+from tenacity import retry, stop_after_attempt, wait_exponential
 
 DOTENV_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.env"))
 load_dotenv(DOTENV_PATH)
@@ -32,6 +38,264 @@ if use_azure == "true":
     if not os.getenv("AZURE_EMBEDDING_DEPLOYMENT_NAME"):
         raise RuntimeError("AZURE_EMBEDDING_DEPLOYMENT_NAME environment variable is not set")
 
+
+# chat completionの生成パラメータ（キャッシュキーにも含める）
+CHAT_TEMPERATURE = 0
+CHAT_SEED = 0
+
+DEFAULT_LLM_CACHE_PATH = "cache/llm_responses.sqlite3"
+DEFAULT_LLM_CACHE_MAX_ENTRIES = 200000
+
+
+class LLMResponseCache:
+    """LLMの応答をSQLiteに永続化するキャッシュ
+
+    キーは (provider, model, messages, is_json, temperature, seed) のハッシュ。
+    件数が max_entries を超えた場合は最終参照日時が古いものから削除する（LRU）。
+    パースできなかった応答は、呼び出し側が evict_chat_response で削除する。
+    """
+
+    def __init__(self, path: str = DEFAULT_LLM_CACHE_PATH, max_entries: int = DEFAULT_LLM_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses(last_access)")
+        self._conn.commit()
+        self._size = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(provider: str, model: str, messages: list[dict], is_json: bool, temperature, seed) -> str:
+        payload = json.dumps(
+            {
+                "provider": provider,
+                "model": model,
+                "messages": messages,
+                "is_json": is_json,
+                "temperature": temperature,
+                "seed": seed,
+            },
+            ensure_ascii=False,
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            return row[0]
+
+    def set(self, key: str, response: str) -> None:
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO responses (key, response, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, response, now, now),
+            )
+            self._size += cursor.rowcount
+            if self._size > self.max_entries:
+                # 1件ずつ消すとINSERT毎に削除が走るため、上限の1%を余分に空ける
+                n_evict = self._size - self.max_entries + max(1, self.max_entries // 100)
+                cursor = self._conn.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_access LIMIT ?)",
+                    (n_evict,),
+                )
+                self._size -= cursor.rowcount
+            self._conn.commit()
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._size -= cursor.rowcount
+            self._conn.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+            self._size = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": self._size}
+
+
+_llm_cache: LLMResponseCache | None = None
+
+
+def configure_llm_cache(
+    enabled: bool = True,
+    path: str = DEFAULT_LLM_CACHE_PATH,
+    max_entries: int = DEFAULT_LLM_CACHE_MAX_ENTRIES,
+    clear: bool = False,
+) -> None:
+    """request_to_chat_llm が利用する応答キャッシュを設定する
+
+    Args:
+        enabled: Falseの場合はキャッシュを参照・保存しない
+        path: キャッシュファイル(SQLite)のパス
+        max_entries: 保持する応答の最大件数
+        clear: Trueの場合は既存のキャッシュを全て削除する
+    """
+    global _llm_cache
+    if clear:
+        LLMResponseCache(path, max_entries).clear()
+    _llm_cache = LLMResponseCache(path, max_entries) if enabled else None
+
+
+def get_llm_cache_stats() -> dict:
+    if _llm_cache is None:
+        return {"hits": 0, "misses": 0, "size": 0}
+    return _llm_cache.stats()
+
+
+GEMINI_OPENAI_BASE_URL = "https://generativelanguage.googleapis.com/v1beta/"
+
+# ネットワーク不要のローカル埋め込みモデル（embedding.model で指定する）
+LOCAL_HASHING_EMBEDDING_MODEL = "local-hashing"
+LOCAL_SENTENCE_TRANSFORMER_PREFIX = "local-st:"
+
+
+class ConnectionStats:
+    """HTTPクライアント毎のリクエスト数・新規接続数・TLSハンドシェイク数を数える
+
+    httpcoreのtrace拡張を使い、リクエスト毎に新しいTCP接続が張られたかを記録する。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+        self.tls_handshakes = 0
+
+    def _on_trace(self, event_name: str) -> None:
+        with self._lock:
+            if event_name == "connection.connect_tcp.complete":
+                self.new_connections += 1
+            elif event_name == "connection.start_tls.complete":
+                self.tls_handshakes += 1
+
+    def _on_request(self, request: httpx.Request) -> None:
+        with self._lock:
+            self.requests += 1
+        request.extensions["trace"] = lambda event_name, info: self._on_trace(event_name)
+
+    async def _on_request_async(self, request: httpx.Request) -> None:
+        with self._lock:
+            self.requests += 1
+
+        async def trace(event_name, info):
+            self._on_trace(event_name)
+
+        request.extensions["trace"] = trace
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "new_connections": self.new_connections,
+                "reused_connections": max(0, self.requests - self.new_connections),
+                "tls_handshakes": self.tls_handshakes,
+            }
+
+
+_clients: dict[tuple, object] = {}
+_connection_stats: dict[tuple, ConnectionStats] = {}
+_clients_lock = threading.Lock()
+
+
+def _http_limits(pool_size: int | None) -> httpx.Limits:
+    pool_size = pool_size or int(os.getenv("LLM_HTTP_POOL_SIZE", 100))
+    return httpx.Limits(
+        max_connections=pool_size,
+        max_keepalive_connections=pool_size,
+        keepalive_expiry=float(os.getenv("LLM_HTTP_KEEPALIVE_EXPIRY", 60)),
+    )
+
+
+def get_client(
+    provider: str,
+    endpoint: str | None,
+    api_key: str | None,
+    api_version: str | None = None,
+    is_async: bool = False,
+    pool_size: int | None = None,
+):
+    """(provider, endpoint, key) 毎に1つの長寿命クライアントを返す
+
+    OpenAI/AzureOpenAIクライアントはスレッドセーフなため、全スレッドで共有する。
+    非同期クライアントはイベントループに紐づくため、async_llmのループ上からのみ取得すること。
+
+    Args:
+        provider: "azure" / "openai"(OpenAI互換API) / "genai"(google-genai)
+        endpoint: エンドポイントURL
+        api_key: APIキー
+        api_version: AzureのAPIバージョン
+        is_async: Trueの場合は非同期クライアントを返す
+        pool_size: コネクションプールの上限（未指定時は LLM_HTTP_POOL_SIZE）
+    """
+    key = (provider, endpoint, api_key, api_version, is_async)
+    with _clients_lock:
+        if key in _clients:
+            return _clients[key]
+
+        if provider == "genai":
+            # google-genaiは内部でHTTPクライアントを保持するため、接続統計は取らずに再利用のみ行う
+            client = genai.Client(api_key=api_key)
+        else:
+            stats = ConnectionStats()
+            if is_async:
+                http_client = httpx.AsyncClient(
+                    limits=_http_limits(pool_size), event_hooks={"request": [stats._on_request_async]}
+                )
+            else:
+                http_client = httpx.Client(limits=_http_limits(pool_size), event_hooks={"request": [stats._on_request]})
+            # 非同期クライアントのリトライはasync_llm側でRetry-Afterを見て行う
+            retry_options = {"max_retries": 0} if is_async else {}
+            if provider == "azure":
+                client_class = AsyncAzureOpenAI if is_async else AzureOpenAI
+                client = client_class(
+                    api_version=api_version,
+                    azure_endpoint=endpoint,
+                    api_key=api_key,
+                    http_client=http_client,
+                    **retry_options,
+                )
+            else:
+                client_class = AsyncOpenAI if is_async else OpenAI
+                client = client_class(api_key=api_key, base_url=endpoint, http_client=http_client, **retry_options)
+            _connection_stats[key] = stats
+
+        _clients[key] = client
+        return client
+
+
+def get_connection_stats() -> dict:
+    """クライアント毎の接続再利用の統計を返す（キーは "provider endpoint" 形式）"""
+    with _clients_lock:
+        items = list(_connection_stats.items())
+    stats: dict[str, dict] = {}
+    for (provider, endpoint, _, _, is_async), connection_stats in items:
+        name = f"{provider}{' async' if is_async else ''} {endpoint}"
+        stats[name] = connection_stats.to_dict()
+    return stats
+
+
 @retry(
     wait=wait_exponential(multiplier=1, min=2, max=20),
     stop=stop_after_attempt(3),
@@ -46,11 +310,7 @@ def request_to_azure_chatcompletion(
     api_key = os.getenv("AZURE_CHATCOMPLETION_API_KEY")
     api_version = os.getenv("AZURE_CHATCOMPLETION_VERSION")
 
-    client = AzureOpenAI(
-        api_version=api_version,
-        azure_endpoint=azure_endpoint,
-        api_key=api_key,
-    )
+    client = get_client("azure", azure_endpoint, api_key, api_version)
 
     if is_json:
         response_format = {"type": "json_object"}
@@ -61,9 +321,9 @@ def request_to_azure_chatcompletion(
         response = client.chat.completions.create(
             model=deployment,
             messages=messages,
-            temperature=0,
+            temperature=CHAT_TEMPERATURE,
             n=1,
-            seed=0,
+            seed=CHAT_SEED,
             response_format=response_format,
             timeout=30,
         )
@@ -88,10 +348,7 @@ def request_to_gemini(
 
     api_key = os.getenv("GEMINI_API_KEY")
 
-    client = OpenAI(
-        api_key=api_key,
-        base_url="https://generativelanguage.googleapis.com/v1beta/"
-    )
+    client = get_client("openai", GEMINI_OPENAI_BASE_URL, api_key)
 
     if is_json:
         response_format = {"type": "json_object"}
@@ -101,7 +358,7 @@ def request_to_gemini(
     response = client.chat.completions.create(
         model=model,
         messages=messages,
-        temperature=0,
+        temperature=CHAT_TEMPERATURE,
         n=1,
         response_format=response_format,
         timeout=30,
@@ -110,46 +367,224 @@ def request_to_gemini(
     return response.choices[0].message.content
 
 
+def get_chat_provider() -> str:
+    use_azure = os.getenv("USE_AZURE", "false").lower()
+    return "azure" if use_azure == "true" else "gemini"
+
+
+def _chat_cache_key(messages: list[dict], model: str, is_json: bool) -> str:
+    if get_chat_provider() == "azure":
+        # Azureではmodel引数ではなくデプロイメント名のモデルが使われる
+        return LLMResponseCache.make_key(
+            "azure",
+            os.getenv("AZURE_CHATCOMPLETION_DEPLOYMENT_NAME"),
+            messages,
+            is_json,
+            CHAT_TEMPERATURE,
+            CHAT_SEED,
+        )
+    return LLMResponseCache.make_key("gemini", model, messages, is_json, CHAT_TEMPERATURE, None)
+
+
+def get_cached_chat_response(messages: list[dict], model: str, is_json: bool) -> tuple[str | None, str | None]:
+    """キャッシュ済みの応答とキャッシュキーを返す（キャッシュ無効時は (None, None)）"""
+    if _llm_cache is None:
+        return None, None
+    cache_key = _chat_cache_key(messages, model, is_json)
+    return _llm_cache.get(cache_key), cache_key
+
+
+def store_chat_response(cache_key: str | None, response: str | None) -> None:
+    if _llm_cache is not None and cache_key is not None and response:
+        _llm_cache.set(cache_key, response)
+
+
+def evict_chat_response(messages: list[dict], model: str, is_json: bool) -> None:
+    """パースできなかった応答をキャッシュから削除し、次回の実行ではLLMに送り直す"""
+    if _llm_cache is not None:
+        _llm_cache.delete(_chat_cache_key(messages, model, is_json))
+
+
+def estimate_tokens(messages: list[dict]) -> int:
+    """レート制御用にプロンプトのトークン数を見積もる
+
+    日本語では1文字がおおよそ1トークン以上になるため、文字数をそのまま上限側の見積もりとして使う。
+    """
+    return sum(len(message.get("content") or "") for message in messages)
+
+
 def request_to_chat_llm(
     messages: list[dict],
     model: str = "gpt-4o",
     is_json: bool = False,
 ) -> dict:
-    use_azure = os.getenv("USE_AZURE", "false").lower()
-    if use_azure == "true":
-        return request_to_azure_chatcompletion(messages, is_json)
+    cached, cache_key = get_cached_chat_response(messages, model, is_json)
+    if cached is not None:
+        return cached
+
+    if get_chat_provider() == "azure":
+        response = request_to_azure_chatcompletion(messages, is_json)
     else:
-        return request_to_gemini(messages, model, is_json)
+        response = request_to_gemini(messages, model, is_json)
+
+    store_chat_response(cache_key, response)
+    return response
 
 
 EMBDDING_MODELS = [
     "text-embedding-3-large",
     "text-embedding-3-small",
-    "gemini-embedding-exp-03-07"
+    "gemini-embedding-exp-03-07",
+    LOCAL_HASHING_EMBEDDING_MODEL,
 ]
 
 
 def _validate_model(model):
-    if model not in EMBDDING_MODELS:
-        raise RuntimeError(f"Invalid embedding model: {model}, available models: {EMBDDING_MODELS}")
+    if model not in EMBDDING_MODELS and not model.startswith(LOCAL_SENTENCE_TRANSFORMER_PREFIX):
+        raise RuntimeError(
+            f"Invalid embedding model: {model}, available models: {EMBDDING_MODELS} "
+            f"or '{LOCAL_SENTENCE_TRANSFORMER_PREFIX}<model name>'"
+        )
 
 
-def request_to_embed(args, model):
-    use_azure = os.getenv("USE_AZURE", "false").lower()
-    if use_azure == "true":
-        return request_to_azure_embed(args, model)
+class EmbeddingBackend:
+    """埋め込みベクトルを計算する実装の基底クラス（embedding.model の値で選択される）"""
 
-    else:
-        _validate_model(model)
+    def model_id(self) -> str:
+        """実際にベクトルを計算するモデルの識別子（埋め込みキャッシュのキーに使う）"""
+        raise NotImplementedError
+
+    def embed(self, texts: list[str]) -> list:
+        raise NotImplementedError
+
+
+class RemoteEmbeddingBackend(EmbeddingBackend):
+    """Azure OpenAI または Gemini のEmbedding APIを呼び出す（.env の USE_AZURE で切り替え）"""
+
+    def __init__(self, model: str):
+        self.model = model
+
+    def model_id(self) -> str:
+        use_azure = os.getenv("USE_AZURE", "false").lower()
+        if use_azure == "true":
+            # Azureではmodel引数ではなくデプロイメント名のモデルが使われる
+            return f"azure:{os.getenv('AZURE_EMBEDDING_DEPLOYMENT_NAME')}"
+        return "gemini:gemini-embedding-exp-03-07"
+
+    def embed(self, texts: list[str]) -> list:
+        use_azure = os.getenv("USE_AZURE", "false").lower()
+        if use_azure == "true":
+            return request_to_azure_embed(texts, self.model)
+
+        _validate_model(self.model)
         api_key = os.getenv("GEMINI_API_KEY")
-        client = genai.Client(api_key=api_key)
+        client = get_client("genai", None, api_key)
         result = client.models.embed_content(
-        model="gemini-embedding-exp-03-07",
-        contents=args,
-)
+            model="gemini-embedding-exp-03-07",
+            contents=texts,
+        )
+        return result.embeddings
+
 
-        embeds = result.embeddings
-    return embeds
+class HashingEmbeddingBackend(EmbeddingBackend):
+    """文字n-gramの特徴ハッシュを固定の乱数射影で低次元に落とすCPU実装
+
+    モデルのダウンロードやネットワークが不要で、同じテキストからは常に同じベクトルが得られる。
+    意味的な類似度の精度はAPIのモデルに劣るため、テストやドライラン向け。
+    テキストをCPUコア数に分割し、joblibのプロセスで並列に計算する。
+    """
+
+    N_HASH_FEATURES = 2**18
+    DIM = 768
+    # これより少ない件数はプロセスを起動せずにその場で計算する
+    MIN_TEXTS_PER_JOB = 2000
+
+    def __init__(self):
+        from sklearn.feature_extraction.text import HashingVectorizer
+        from sklearn.random_projection import SparseRandomProjection
+
+        self._vectorizer = HashingVectorizer(
+            analyzer="char_wb",
+            ngram_range=(1, 3),
+            n_features=self.N_HASH_FEATURES,
+            norm=None,
+            alternate_sign=False,
+            dtype=np.float32,
+        )
+        # 射影行列は乱数のシードだけで決まるため、ダミーの入力でfitしておく
+        self._projection = SparseRandomProjection(n_components=self.DIM, random_state=0, dense_output=True)
+        self._projection.fit(np.zeros((1, self.N_HASH_FEATURES), dtype=np.float32))
+
+    def model_id(self) -> str:
+        return f"local:{LOCAL_HASHING_EMBEDDING_MODEL}:{self.DIM}"
+
+    def _embed_chunk(self, texts: list[str]) -> np.ndarray:
+        counts = self._vectorizer.transform(texts)
+        counts.data = 1 + np.log(counts.data)  # sublinear tf
+        vectors = self._projection.transform(counts).astype(np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def embed(self, texts: list[str]) -> list:
+        n_jobs = min(os.cpu_count() or 1, max(1, len(texts) // self.MIN_TEXTS_PER_JOB))
+        if n_jobs == 1:
+            return list(self._embed_chunk(texts))
+        from joblib import Parallel, delayed
+
+        chunk_size = -(-len(texts) // n_jobs)
+        chunks = Parallel(n_jobs=n_jobs)(
+            delayed(self._embed_chunk)(texts[i : i + chunk_size]) for i in range(0, len(texts), chunk_size)
+        )
+        return list(np.concatenate(chunks))
+
+
+class SentenceTransformerEmbeddingBackend(EmbeddingBackend):
+    """sentence-transformers のモデルをCPUで実行する（"local-st:<モデル名>" で指定。要 sentence-transformers）"""
+
+    def __init__(self, model_name: str):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            raise RuntimeError(
+                "sentence-transformers is not installed. Run `uv add sentence-transformers` "
+                f"or use '{LOCAL_HASHING_EMBEDDING_MODEL}' instead."
+            ) from e
+        self.model_name = model_name
+        self._model = SentenceTransformer(model_name, device="cpu")
+
+    def model_id(self) -> str:
+        return f"local:{self.model_name}"
+
+    def embed(self, texts: list[str]) -> list:
+        vectors = self._model.encode(texts, batch_size=64, convert_to_numpy=True, normalize_embeddings=True)
+        return list(vectors.astype(np.float32))
+
+
+_embedding_backends: dict[str, EmbeddingBackend] = {}
+_embedding_backends_lock = threading.Lock()
+
+
+def get_embedding_backend(model: str) -> EmbeddingBackend:
+    """embedding.model の値に対応するバックエンドを返す（モデル毎に1つだけ生成して共有する）"""
+    with _embedding_backends_lock:
+        if model not in _embedding_backends:
+            if model == LOCAL_HASHING_EMBEDDING_MODEL:
+                backend = HashingEmbeddingBackend()
+            elif model.startswith(LOCAL_SENTENCE_TRANSFORMER_PREFIX):
+                backend = SentenceTransformerEmbeddingBackend(model[len(LOCAL_SENTENCE_TRANSFORMER_PREFIX) :])
+            else:
+                backend = RemoteEmbeddingBackend(model)
+            _embedding_backends[model] = backend
+        return _embedding_backends[model]
+
+
+def get_embedding_model_id(model: str) -> str:
+    """実際にベクトルを計算するモデルの識別子を返す（埋め込みキャッシュのキーに使う）"""
+    return get_embedding_backend(model).model_id()
+
+
+def request_to_embed(args, model):
+    return get_embedding_backend(model).embed(args)
 
 
 def request_to_azure_embed(args, model):
@@ -159,11 +594,7 @@ def request_to_azure_embed(args, model):
     deployment = os.getenv("AZURE_EMBEDDING_DEPLOYMENT_NAME")
     assert azure_endpoint and deployment and api_key and api_version
 
-    client = AzureOpenAI(
-        api_version=api_version,
-        azure_endpoint=azure_endpoint,
-        api_key=api_key,
-    )
+    client = get_client("azure", azure_endpoint, api_key, api_version)
 
     response = client.embeddings.create(input=args, model=deployment)
     return [item.embedding for item in response.data]
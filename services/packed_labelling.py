@@ -0,0 +1,74 @@
+"""複数クラスタのラベリングを1リクエストにまとめる（hierarchical_initial_labelling / hierarchical_merge_labelling の pack_size）
+
+各クラスタの入力を「[クラスタID]」の見出し付きで連結し、システムプロンプトは1回だけ送る。
+応答は {"クラスタID": {"label": ..., "description": ...}} 形式で受け取り、
+パースできなかったクラスタは呼び出し側で1件ずつラベリングし直す。
+"""
+
+import threading
+
+from services.llm import estimate_tokens
+
+# LLMの呼び出しや応答のパースに失敗したクラスタのラベルと説明
+ERROR_LABEL = "エラーでラベル名が取得できませんでした"
+ERROR_DESCRIPTION = "エラーで解説が取得できませんでした"
+
+# 複数クラスタをまとめて送る場合にシステムプロンプトの後ろに追加する指示
+PACKED_LABELLING_INSTRUCTION = """
+
+# 複数クラスタの入力
+以降の入力には、複数のクラスタの情報が「[1_0]」「[1_1]」のようなクラスタIDの見出し付きで与えられます。
+各クラスタに対して上記と同じ基準で個別にラベルと説明を作成し、クラスタIDをキー、label と description を持つオブジェクトを値とするJSONオブジェクトを返してください。
+全てのクラスタIDをキーに含めてください。
+出力例: {"1_0": {"label": "...", "description": "..."}, "1_1": {"label": "...", "description": "..."}}
+"""
+
+
+def labelling_messages(prompt: str, input: str) -> list[dict]:
+    return [
+        {"role": "system", "content": prompt},
+        {"role": "user", "content": input},
+    ]
+
+
+def packed_labelling_messages(prompt: str, inputs: dict[str, str]) -> list[dict]:
+    """inputs（クラスタID → 1件ずつ送る場合のuserメッセージ）を1リクエストにまとめたメッセージ"""
+    packed_input = "\n\n".join(f"[{cluster_id}]\n{input}" for cluster_id, input in inputs.items())
+    return labelling_messages(prompt + PACKED_LABELLING_INSTRUCTION, packed_input)
+
+
+class PackingReport:
+    """まとめて送ったリクエストの数とプロンプトのトークン数（見積もり）を、1件ずつ送った場合と比べて集計する"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.requests = 0
+        self.tokens = 0
+        self.baseline_requests = 0
+        self.baseline_tokens = 0
+        self.retried = 0
+        self._lock = threading.Lock()
+
+    def add_packed(self, messages: list[dict], single_messages: list[list[dict]]) -> None:
+        """まとめたリクエストと、同じクラスタを1件ずつ送った場合のメッセージを記録する"""
+        with self._lock:
+            self.requests += 1
+            self.tokens += estimate_tokens(messages)
+            self.baseline_requests += len(single_messages)
+            self.baseline_tokens += sum(estimate_tokens(messages) for messages in single_messages)
+
+    def add_retry(self, messages: list[dict]) -> None:
+        """応答からパースできなかったクラスタを1件ずつ送り直したリクエストを記録する"""
+        with self._lock:
+            self.requests += 1
+            self.tokens += estimate_tokens(messages)
+            self.retried += 1
+
+    def summary(self) -> str:
+        with self._lock:
+            saved_tokens = self.baseline_tokens - self.tokens
+            return (
+                f"{self.name}: {self.requests} requests instead of {self.baseline_requests} "
+                f"({self.retried} clusters retried individually), ~{saved_tokens} prompt tokens saved "
+                f"({saved_tokens / max(1, self.baseline_tokens):.0%} of one-per-call baseline)"
+            )
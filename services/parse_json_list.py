@@ -74,6 +74,74 @@ def parse_response(response):
         return items
 
 
+def parse_packed_response(response, tags):
+    """
+    複数コメントをまとめて抽出した応答 {"タグ": [意見, ...]} から、タグごとの意見リストを取り出す。
+    パースできなかったタグは結果に含めない（呼び出し側で1件ずつ再抽出する）。
+
+    >>> parse_packed_response('{"C0": ["a", " b "], "C1": []}', ["C0", "C1"])
+    {'C0': ['a', 'b'], 'C1': []}
+
+    >>> parse_packed_response('```json\\n{"C0": "a", "C1": 3}\\n```', ["C0", "C1", "C2"])
+    {'C0': ['a']}
+
+    >>> parse_packed_response('No json here', ["C0"])
+    {}
+    """
+    obj = _load_json_object(response)
+    results = {}
+    for tag in tags:
+        items = obj.get(tag)
+        if isinstance(items, str):
+            items = [items]
+        if not isinstance(items, list) or not all(isinstance(item, str) for item in items):
+            continue
+        results[tag] = [item.strip() for item in items if item.strip()]
+    return results
+
+
+def parse_packed_labels(response, cluster_ids):
+    """
+    複数クラスタをまとめてラベリングした応答 {"クラスタID": {"label": ..., "description": ...}} から、
+    クラスタIDごとのラベルと説明を取り出す。
+    パースできなかったクラスタ（キーの欠落、label / description が空・文字列でない）は結果に含めない
+    （呼び出し側で1件ずつラベリングし直す）。
+
+    >>> parse_packed_labels('{"1_0": {"label": " a ", "description": "b"}, "1_1": {"label": "c"}}', ["1_0", "1_1"])
+    {'1_0': {'label': 'a', 'description': 'b'}}
+
+    >>> parse_packed_labels('```json\\n{"1_0": "a"}\\n```', ["1_0"])
+    {}
+    """
+    obj = _load_json_object(response)
+    results = {}
+    for cluster_id in cluster_ids:
+        values = obj.get(cluster_id)
+        if not isinstance(values, dict):
+            continue
+        label, description = values.get("label"), values.get("description")
+        if not isinstance(label, str) or not isinstance(description, str) or not label.strip():
+            continue
+        results[cluster_id] = {"label": label.strip(), "description": description.strip()}
+    return results
+
+
+def _load_json_object(response):
+    """応答からJSONオブジェクトを取り出す（見つからない・パースできない場合は空の辞書）"""
+    response = response.replace("```json", "").replace("```", "")
+    try:
+        obj = json.loads(response)
+    except json.JSONDecodeError:
+        match = re.search(r"\{.*\}", response, flags=re.DOTALL)
+        if not match:
+            return {}
+        try:
+            obj = json.loads(match.group(0))
+        except json.JSONDecodeError:
+            return {}
+    return obj if isinstance(obj, dict) else {}
+
+
 if __name__ == "__main__":
     import doctest
 
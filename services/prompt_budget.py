@@ -0,0 +1,153 @@
+"""LLMに送るプロンプトを、トークン数の上限（token_budget）に収まるように組み立てる
+
+意見やクラスタの説明などの項目を1件ずつ追加し、上限に達したところで残りを入れない。
+長すぎる項目は max_item_tokens で末尾を切り詰める。
+
+トークン数はローカルのトークナイザ（tiktoken）で数える。tiktoken が無い場合や、語彙ファイルを取得できない
+オフライン環境では、services.llm.estimate_tokens と同じく1文字を1トークンとして数える（日本語では多めに数える）。
+"""
+
+import logging
+import threading
+from collections.abc import Sequence
+
+# tiktoken が対応していないモデル（Gemini等）で使うエンコーディング
+DEFAULT_ENCODING = "o200k_base"
+TRUNCATION_SUFFIX = "…"
+
+
+class _CharacterTokenizer:
+    """1文字を1トークンとして数える（tiktoken が使えない場合の代わり）"""
+
+    name = "characters"
+
+    def encode(self, text: str, **kwargs) -> list[str]:
+        return list(text)
+
+    def decode(self, tokens: list[str]) -> str:
+        return "".join(tokens)
+
+
+_tokenizers: dict[str | None, object] = {}
+_tokenizers_lock = threading.Lock()
+
+
+def get_tokenizer(model: str | None = None):
+    """model に対応するトークナイザ（モデル毎に1つだけ読み込んで共有する）"""
+    with _tokenizers_lock:
+        if model not in _tokenizers:
+            _tokenizers[model] = _load_tokenizer(model)
+        return _tokenizers[model]
+
+
+def _load_tokenizer(model: str | None):
+    try:
+        import tiktoken
+    except ImportError:
+        logging.warning("tiktoken is not installed, counting prompt tokens as characters")
+        return _CharacterTokenizer()
+    try:
+        try:
+            return tiktoken.encoding_for_model(model) if model else tiktoken.get_encoding(DEFAULT_ENCODING)
+        except KeyError:
+            return tiktoken.get_encoding(DEFAULT_ENCODING)
+    except Exception as e:
+        # 語彙ファイルは初回にダウンロードされるため、オフラインでは読み込めない
+        logging.warning(f"Could not load tiktoken encoding, counting prompt tokens as characters: {e}")
+        return _CharacterTokenizer()
+
+
+def count_tokens(text: str, tokenizer) -> int:
+    return len(tokenizer.encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text: str, max_tokens: int, tokenizer) -> str:
+    """text が max_tokens を超える場合、末尾を切り詰めて TRUNCATION_SUFFIX を付ける"""
+    tokens = tokenizer.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    keep = max(max_tokens - count_tokens(TRUNCATION_SUFFIX, tokenizer), 0)
+    # トークンの途中で切れたマルチバイト文字は置換文字になるため取り除く
+    return tokenizer.decode(tokens[:keep]).rstrip("�") + TRUNCATION_SUFFIX
+
+
+class PromptBudget:
+    """1つのステップのプロンプトの組み立てと、トークン数の上限に対する利用率の集計
+
+    Args:
+        name: ログに表示するステップ名
+        token_budget: 1リクエストのメッセージ全体のトークン数の上限（None は上限なし）
+        max_item_tokens: 1項目のトークン数の上限（None は切り詰めない）
+        model: トークナイザを選ぶためのモデル名
+    """
+
+    def __init__(self, name: str, token_budget: int | None, max_item_tokens: int | None, model: str | None = None):
+        self.name = name
+        self.token_budget = token_budget
+        self.max_item_tokens = max_item_tokens
+        self.tokenizer = get_tokenizer(model)
+        self._utilisations: list[float] = []
+        self._truncated = 0
+        self._dropped = 0
+        self._lock = threading.Lock()
+
+    def pack(self, items: Sequence[str], reserved: Sequence[str] = (), min_items: int = 1) -> list[str]:
+        """reserved（プロンプトの固定部分）と合わせて token_budget に収まるだけ items を先頭から選ぶ
+
+        項目は max_item_tokens で切り詰めてから数える。先頭の min_items 件は上限を超えても入れる。
+        項目間の区切り（改行）は1トークンとして数える。
+        """
+        used = sum(count_tokens(text, self.tokenizer) for text in reserved)
+        packed = []
+        truncated = 0
+        for item in items:
+            text = item if self.max_item_tokens is None else truncate_tokens(item, self.max_item_tokens, self.tokenizer)
+            tokens = count_tokens(text, self.tokenizer) + 1
+            if self.token_budget is not None and used + tokens > self.token_budget and len(packed) >= min_items:
+                break
+            truncated += text != item
+            packed.append(text)
+            used += tokens
+        with self._lock:
+            self._truncated += truncated
+            self._dropped += len(items) - len(packed)
+        return packed
+
+    def record(self, key: str, messages: list[dict], n_prompts: int = 1) -> int:
+        """送信するメッセージ全体のトークン数を数え、上限に対する利用率をログに出す
+
+        n_prompts は1リクエストにまとめたプロンプトの数（pack_size）。各プロンプトは1件ずつ送る場合と同じく
+        token_budget に収めているため、まとめたリクエストの上限は token_budget * n_prompts とする。
+        """
+        tokens = sum(count_tokens(message.get("content") or "", self.tokenizer) for message in messages)
+        if self.token_budget:
+            budget = self.token_budget * n_prompts
+            utilisation = tokens / budget
+            with self._lock:
+                self._utilisations.append(utilisation)
+            log = logging.warning if utilisation > 1 else logging.info
+            log(f"{self.name} {key}: {tokens}/{budget} tokens ({utilisation:.0%})")
+        return tokens
+
+    def summary(self) -> str:
+        with self._lock:
+            if not self._utilisations:
+                return f"{self.name}: {self._truncated} items truncated"
+            return (
+                f"{self.name}: {len(self._utilisations)} prompts, token budget utilisation "
+                f"mean {sum(self._utilisations) / len(self._utilisations):.0%} / max {max(self._utilisations):.0%}, "
+                f"{self._truncated} items truncated, {self._dropped} items left out "
+                f"(tokenizer: {self.tokenizer.name})"
+            )
+
+
+def prompt_budget_from_config(name: str, step_config: dict) -> PromptBudget | None:
+    """ステップの設定（token_budget / max_item_tokens / model）から PromptBudget を作る
+
+    token_budget と max_item_tokens がどちらも未設定（null）の場合は None を返す（プロンプトは以前のまま）。
+    """
+    token_budget = step_config.get("token_budget")
+    max_item_tokens = step_config.get("max_item_tokens")
+    if token_budget is None and max_item_tokens is None:
+        return None
+    return PromptBudget(name, token_budget, max_item_tokens, step_config.get("model"))
@@ -0,0 +1,137 @@
+"""ラベリングのプロンプトに載せる意見をクラスタ毎に選ぶ
+
+sampling_method で以下の方法を選べる。
+
+    random: 無作為に選ぶ（実行毎に変わる）
+    centroid: クラスタの重心に近い順に選ぶ
+    mmr: 重心への近さと、既に選んだ意見からの遠さを釣り合わせて選ぶ（Maximal Marginal Relevance）
+
+centroid と mmr は全クラスタ分を階層毎にまとめて（クラスタ毎のループなしに）求め、同じ入力からは常に同じ意見を選ぶ。
+プロンプトが実行毎に変わらないため、LLMの応答キャッシュもそのまま使える。
+距離は sampling_space で選んだ空間（umap: UMAPの x, y / embedding: 埋め込みベクトル）のユークリッド距離。
+"""
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from services.embedding_store import load_embeddings
+
+SAMPLING_METHODS = ["random", "centroid", "mmr"]
+SAMPLING_SPACES = ["umap", "embedding"]
+# mmr で重心への近さに掛ける重み（残りは既に選んだ意見からの遠さに掛ける）
+MMR_LAMBDA = 0.5
+# 埋め込みベクトルの距離を一度に計算する行数（(行数, 次元数) の一時配列を作る）
+DISTANCE_CHUNK_SIZE = 65536
+
+
+def load_sampling_points(directory: str, clusters_df: pd.DataFrame, space: str) -> np.ndarray:
+    """clusters_df の各行に対応する、sampling_space の座標（(意見数, 次元数) の行列）を返す"""
+    if space not in SAMPLING_SPACES:
+        raise ValueError(f"Unknown sampling_space: {space}, available spaces: {SAMPLING_SPACES}")
+    if space == "umap":
+        return clusters_df[["x", "y"]].to_numpy(dtype=np.float32)
+    arg_ids, matrix = load_embeddings(directory)
+    if arg_ids.equals(clusters_df["arg-id"]):
+        return matrix
+    positions = pd.Index(arg_ids).get_indexer(clusters_df["arg-id"])
+    if (positions < 0).any():
+        raise ValueError("Some arguments have no embedding, please re-run the embedding step")
+    return matrix[positions]
+
+
+def sample_cluster_rows(
+    cluster_rows: dict[str, np.ndarray],
+    sampling_num: int,
+    method: str = "random",
+    points: np.ndarray | None = None,
+) -> dict[str, np.ndarray]:
+    """cluster_rows の全クラスタについて、プロンプトに載せる最大 sampling_num 件の行番号を選ぶ
+
+    Args:
+        cluster_rows: クラスタID → 行番号 の索引（build_cluster_index の1列分）
+        sampling_num: 各クラスタから選ぶ意見の数
+        method: SAMPLING_METHODS のいずれか
+        points: 各行の座標（method が centroid / mmr の場合に必要）
+
+    Returns:
+        クラスタID → 選んだ行番号（centroid / mmr では選んだ順）
+    """
+    if method not in SAMPLING_METHODS:
+        raise ValueError(f"Unknown sampling_method: {method}, available methods: {SAMPLING_METHODS}")
+    if method == "random":
+        return {
+            cluster_id: np.random.choice(rows, min(sampling_num, len(rows)), replace=False)
+            for cluster_id, rows in cluster_rows.items()
+        }
+
+    cluster_ids = list(cluster_rows)
+    rows = np.concatenate([cluster_rows[cluster_id] for cluster_id in cluster_ids])
+    codes = np.repeat(np.arange(len(cluster_ids)), [len(cluster_rows[cluster_id]) for cluster_id in cluster_ids])
+    if method == "centroid":
+        selected = _select_nearest_centroid(points, rows, codes, len(cluster_ids), sampling_num)
+    else:
+        selected = _select_mmr(points, rows, codes, len(cluster_ids), sampling_num)
+    return dict(zip(cluster_ids, selected, strict=True))
+
+
+def _centroid_distances(points: np.ndarray, rows: np.ndarray, codes: np.ndarray, n_clusters: int) -> np.ndarray:
+    """各行から、その行が属するクラスタの重心までの距離"""
+    # クラスタ毎の和を (クラスタ数, 意見数) の疎行列との積で求める（mmapの行列も型を変えずに1回読むだけで済む）
+    membership = sp.csr_matrix(
+        (np.ones(len(rows), dtype=points.dtype), (codes, rows)), shape=(n_clusters, len(points))
+    )
+    counts = np.bincount(codes, minlength=n_clusters)
+    centroids = np.asarray(membership @ points, dtype=np.float64) / counts[:, None]
+    return _row_distances(points, rows, centroids, codes)
+
+
+def _row_distances(points: np.ndarray, rows: np.ndarray, targets: np.ndarray, target_index: np.ndarray) -> np.ndarray:
+    """points[rows[i]] と targets[target_index[i]] の距離（DISTANCE_CHUNK_SIZE 行ずつ計算する）"""
+    distances = np.empty(len(rows))
+    for start in range(0, len(rows), DISTANCE_CHUNK_SIZE):
+        chunk = slice(start, start + DISTANCE_CHUNK_SIZE)
+        differences = np.asarray(points[rows[chunk]], dtype=np.float64) - targets[target_index[chunk]]
+        distances[chunk] = np.linalg.norm(differences, axis=1)
+    return distances
+
+
+def _select_nearest_centroid(points, rows, codes, n_clusters, sampling_num) -> list[np.ndarray]:
+    distances = _centroid_distances(points, rows, codes, n_clusters)
+    # クラスタ毎に距離の小さい順に並べる（同じ距離なら行番号の小さい順）
+    order = np.lexsort((rows, distances, codes))
+    starts = np.searchsorted(codes[order], np.arange(n_clusters))
+    ends = np.append(starts[1:], len(order))
+    return [rows[order[start : min(end, start + sampling_num)]] for start, end in zip(starts, ends, strict=True)]
+
+
+def _select_mmr(points, rows, codes, n_clusters, sampling_num) -> list[np.ndarray]:
+    relevance = -_centroid_distances(points, rows, codes, n_clusters)
+    # 各行から、同じクラスタで既に選んだ意見までの最短距離（1件目は重心に最も近い意見を選ぶため0とする）
+    novelty = np.zeros(len(rows))
+    available = np.ones(len(rows), dtype=bool)
+    selected_steps = []
+    for step in range(sampling_num):
+        scores = np.where(available, MMR_LAMBDA * relevance + (1 - MMR_LAMBDA) * novelty, -np.inf)
+        best = np.full(n_clusters, -np.inf)
+        np.maximum.at(best, codes, scores)
+        # 各クラスタで最大のスコアを持つ最初の行（全て選び終えたクラスタは除く）
+        candidates = np.flatnonzero((scores == best[codes]) & available)
+        cluster_codes, first = np.unique(codes[candidates], return_index=True)
+        picked = candidates[first]
+        selected_steps.append((cluster_codes, picked))
+        available[picked] = False
+        if step + 1 < sampling_num:
+            # 今回選んだ意見までの距離で、最短距離を更新する（今回選べなかったクラスタの行は更新しない）
+            target_of_cluster = np.full(n_clusters, -1)
+            target_of_cluster[cluster_codes] = np.arange(len(cluster_codes))
+            has_pick = target_of_cluster[codes] >= 0
+            targets = np.asarray(points[rows[picked]], dtype=np.float64)
+            distances = _row_distances(points, rows[has_pick], targets, target_of_cluster[codes[has_pick]])
+            novelty[has_pick] = distances if step == 0 else np.minimum(novelty[has_pick], distances)
+
+    selected = [[] for _ in range(n_clusters)]
+    for cluster_codes, picked in selected_steps:
+        for code, position in zip(cluster_codes, picked, strict=True):
+            selected[code].append(rows[position])
+    return [np.array(cluster_selected, dtype=np.int64) for cluster_selected in selected]
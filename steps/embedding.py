@@ -1,20 +1,116 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
-from services.llm import request_to_embed
+from services.embedding_cache import EmbeddingCache, text_hash
+from services.embedding_store import save_embeddings
+from services.llm import get_embedding_model_id, request_to_embed
+
+# 一時的なエラー時に同じバッチを再送する回数
+EMBEDDING_MAX_RETRIES = 3
 
 
 def embedding(config):
     model = config["embedding"]["model"]
 
     dataset = config["output_dir"]
-    path = f"outputs/{dataset}/embeddings.pkl"
     arguments = pd.read_csv(f"outputs/{dataset}/args.csv", usecols=["arg-id", "argument"])
-    embeddings = []
-    batch_size = 1000
-    for i in tqdm(range(0, len(arguments), batch_size)):
-        args = arguments["argument"].tolist()[i : i + batch_size]
-        embeds = request_to_embed(args, model)
-        embeddings.extend(embeds)
-    df = pd.DataFrame([{"arg-id": arguments.iloc[i]["arg-id"], "embedding": e} for i, e in enumerate(embeddings)])
-    df.to_pickle(path)
\ No newline at end of file
+    texts = arguments["argument"].tolist()
+
+    cache = EmbeddingCache() if config["embedding"]["use_cache"] else None
+    model_id = get_embedding_model_id(model)
+    cached = cache.get_many(model_id, texts) if cache else {}
+
+    # キャッシュに無いテキストだけをAPIに送る（同一テキストは1回だけ）
+    missing_texts = list(dict.fromkeys(text for text in texts if text_hash(text) not in cached))
+    batches = split_batches(
+        missing_texts, config["embedding"]["batch_size"], config["embedding"]["max_tokens_per_batch"]
+    )
+    latencies = []
+    with ThreadPoolExecutor(max_workers=config["embedding"]["workers"]) as executor:
+        futures = [executor.submit(embed_batch, batch, model) for batch in batches]
+        # 完了した順にキャッシュへ書き込む（出力の順序はテキストのハッシュで引き直すため入力順になる）
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            batch_texts, vectors, batch_latencies = future.result()
+            latencies += batch_latencies
+            for text, vector in zip(batch_texts, vectors, strict=True):
+                cached[text_hash(text)] = vector
+            if cache:
+                cache.put_many(model_id, batch_texts, vectors)
+    if latencies:
+        print(
+            f"Embedding requests: {len(latencies)} batches, latency "
+            f"p50 {np.percentile(latencies, 50):.2f}s / p95 {np.percentile(latencies, 95):.2f}s / "
+            f"max {max(latencies):.2f}s"
+        )
+
+    missing_set = set(missing_texts)
+    reused = sum(1 for text in texts if text not in missing_set)
+    print(f"Embeddings reused from cache: {reused}/{len(texts)} (computed {len(missing_texts)} unique texts)")
+
+    # float32の行列として outputs/{dataset}/embeddings.npy に保存する（後続のステップはmmapで読み込む）
+    text_hashes = [text_hash(text) for text in texts]
+    dim = len(cached[text_hashes[0]]) if texts else 0
+    save_embeddings(f"outputs/{dataset}", arguments["arg-id"].tolist(), dim, lambda i: cached[text_hashes[i]])
+
+
+def split_batches(texts: list[str], max_batch_size: int, max_tokens_per_batch: int) -> list[list[str]]:
+    """件数が max_batch_size 以下、トークン数（文字数で見積もる）が max_tokens_per_batch 以下になるように分割する"""
+    batches = []
+    batch: list[str] = []
+    batch_tokens = 0
+    for text in texts:
+        tokens = len(text)
+        if batch and (len(batch) >= max_batch_size or batch_tokens + tokens > max_tokens_per_batch):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(text)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _is_request_too_large(error: Exception) -> bool:
+    # 400系（入力が大きすぎる等）は再送しても成功しないため、バッチを分割して送り直す
+    status = getattr(error, "status_code", None) or getattr(error, "code", None)
+    return status in (400, 413)
+
+
+def _request_with_retry(texts: list[str], model: str) -> list[np.ndarray]:
+    for attempt in range(EMBEDDING_MAX_RETRIES + 1):
+        try:
+            embeds = request_to_embed(texts, model)
+            return [np.asarray(getattr(e, "values", e), dtype=np.float32) for e in embeds]
+        except Exception as e:
+            if _is_request_too_large(e) or attempt == EMBEDDING_MAX_RETRIES:
+                raise
+            wait = min(20, 2 ** (attempt + 1))
+            logging.warning(f"Embedding request for {len(texts)} texts failed, retrying after {wait}s: {e!r}")
+            time.sleep(wait)
+
+
+def embed_batch(texts: list[str], model: str) -> tuple[list[str], list[np.ndarray], list[float]]:
+    """texts を1リクエストでベクトル化し、(テキスト, ベクトル, リクエスト毎の所要時間) を返す
+
+    入力が大きすぎるエラー（400 / 413）で失敗したバッチは半分に分けて送り直す（1件でも失敗する場合は例外を送出する）。
+    認証・権限・クォータ等のそれ以外のエラーは、分割しても成功しないためリトライ後にそのまま送出する。
+    """
+    start = time.perf_counter()
+    try:
+        vectors = _request_with_retry(texts, model)
+    except Exception as e:
+        if len(texts) == 1 or not _is_request_too_large(e):
+            raise
+        logging.warning(f"Embedding request for {len(texts)} texts is too large, splitting the batch: {e!r}")
+        middle = len(texts) // 2
+        _, head_vectors, head_latencies = embed_batch(texts[:middle], model)
+        _, tail_vectors, tail_latencies = embed_batch(texts[middle:], model)
+        return texts, head_vectors + tail_vectors, head_latencies + tail_latencies
+    latency = time.perf_counter() - start
+    logging.info(f"Embedded {len(texts)} texts in {latency:.2f}s")
+    return texts, vectors, [latency]
@@ -1,15 +1,22 @@
-import concurrent.futures
+import asyncio
 import json
 import logging
 import re
+from itertools import chain
 
+import openai
 import pandas as pd
 import numpy as np
 from tqdm import tqdm
 
 from services.category_classification import classify_args
-from services.llm import request_to_chat_llm
-from services.parse_json_list import parse_response
+from services.async_llm import request_to_chat_llm_async, run_concurrently
+from services.batch_llm import BatchRequest, get_batch_backend, run_batch
+from services.embedding_cache import text_hash
+from services.input_reader import read_input_columns, read_unique_comments
+from services.journal import ResultsJournal, fingerprint
+from services.llm import estimate_tokens, evict_chat_response
+from services.parse_json_list import parse_packed_response, parse_response
 from hierarchical_utils import update_progress # 前まではbroadlistening.utilsから呼び出していた。これでエラーになったらもとに戻す。
 
 COMMA_AND_SPACE_AND_RIGHT_BRACKET = re.compile(r",\s*(\])")
@@ -20,6 +27,31 @@ def _validate_property_columns(property_columns: list[str], comments: pd.DataFra
         raise ValueError(f"Properties {property_columns} not found in comments. Columns are {comments.columns}")
 
 
+def build_argument_tables(comment_ids, extracted_args_list) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """コメントごとの抽出結果から、意見テーブル (arg-id, argument) と関係テーブル (arg-id, comment-id) を作る
+
+    同じ文字列の意見は最初に現れたコメントの arg-id (A{comment-id}_{コメント内の位置}) に統合する。
+    """
+    counts = np.fromiter((len(extracted_args) for extracted_args in extracted_args_list), dtype=np.int64)
+    flat_args = list(chain.from_iterable(extracted_args_list))
+    relation_comment_ids = np.repeat(np.asarray(comment_ids), counts)
+    positions = np.arange(len(flat_args)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    # 意見の文字列をハッシュで出現順の連番に変換し、各意見の最初の出現位置から arg-id を作る
+    codes, unique_args = pd.factorize(pd.Series(flat_args))
+    _, first_positions = np.unique(codes, return_index=True)
+    arg_ids = (
+        "A"
+        + pd.Series(relation_comment_ids[first_positions]).astype(str)
+        + "_"
+        + pd.Series(positions[first_positions]).astype(str)
+    ).to_numpy()
+
+    results = pd.DataFrame({"arg-id": arg_ids, "argument": unique_args})
+    relation_df = pd.DataFrame({"arg-id": arg_ids[codes], "comment-id": relation_comment_ids})
+    return results, relation_df
+
+
 def extraction(config):
     dataset = config["output_dir"]
     path = f"outputs/{dataset}/args.csv"
@@ -30,56 +62,61 @@ def extraction(config):
     property_columns = config["extraction"]["properties"]
 
     # カラム名だけを読み込み、必要なカラムが含まれているか確認する
-    comments = pd.read_csv(f"inputs/{config['input']}.csv", nrows=0)
-    _validate_property_columns(property_columns, comments)
-    # エラーが出なかった場合、すべての行を読み込む
-    comments = pd.read_csv(
-        f"inputs/{config['input']}.csv", usecols=["comment-id", "comment-body"] + config["extraction"]["properties"]
-    )
-    # 対象カラムに空白が含まれていたら削除
-    comments["comment-body"] = comments["comment-body"].apply(lambda x: x if not isinstance(x, str) or x.strip() else np.nan)
-    comments = comments.dropna(subset="comment-body")
-    
-    # 対象カラムに重複の情報が含まれていたら削除
-    comments = comments.drop_duplicates("comment-body", keep='first')
-    
-    comment_ids = (comments["comment-id"].values)[:limit]
-    comments.set_index("comment-id", inplace=True)
-    results = pd.DataFrame()
+    input_path = f"inputs/{config['input']}.csv"
+    _validate_property_columns(property_columns, pd.Index(read_input_columns(input_path)))
+    # エラーが出なかった場合、必要なカラムだけをチャンク単位で読み込み、空白・重複の本文を除いて limit 件まで取り出す
+    comments = read_unique_comments(input_path, ["comment-id", "comment-body"] + property_columns, limit)
+
+    comment_ids = comments["comment-id"].to_numpy()
+    comment_bodies = comments["comment-body"].tolist()
     update_progress(config, total=len(comment_ids))
 
-    argument_map = {}
-    relation_rows = []
-
-    for i in tqdm(range(0, len(comment_ids), workers)):
-        batch = comment_ids[i : i + workers]
-        batch_inputs = [comments.loc[id]["comment-body"] for id in batch]
-        batch_results = extract_batch(batch_inputs, prompt, model, workers)
-
-        for comment_id, extracted_args in zip(batch, batch_results, strict=False):
-            for j, arg in enumerate(extracted_args):
-                if arg not in argument_map:
-                    # argumentテーブルに追加
-                    arg_id = f"A{comment_id}_{j}"
-                    argument_map[arg] = {
-                        "arg-id": arg_id,
-                        "argument": arg,
-                    }
-                else:
-                    arg_id = argument_map[arg]["arg-id"]
-
-                # relationテーブルにcommentとargの関係を追加
-                relation_row = {
-                    "arg-id": arg_id,
-                    "comment-id": comment_id,
-                }
-                relation_rows.append(relation_row)
-
-        update_progress(config, incr=len(batch))
-
-    # DataFrame化
-    results = pd.DataFrame(argument_map.values())
-    relation_df = pd.DataFrame(relation_rows)
+    # 抽出結果を1件ずつジャーナルに追記し、中断後の再実行では未処理のコメントだけを抽出する
+    journal = ResultsJournal(f"outputs/{dataset}/extraction_journal.jsonl", fingerprint(prompt, model))
+    journaled = journal.load()
+    journal_keys = [
+        f"{comment_id}:{text_hash(body)}" for comment_id, body in zip(comment_ids, comment_bodies, strict=True)
+    ]
+    extracted_args_list = [journaled.get(key) for key in journal_keys]
+    pending_indices = [i for i, extracted_args in enumerate(extracted_args_list) if extracted_args is None]
+    if len(pending_indices) < len(comment_ids):
+        print(f"Resuming extraction: {len(comment_ids) - len(pending_indices)} comments found in journal")
+        update_progress(config, incr=len(comment_ids) - len(pending_indices))
+    journal.open(journaled)
+
+    pending_bodies = [comment_bodies[i] for i in pending_indices]
+    if config["extraction"]["execution"] == "batch":
+        extracted_stream = extract_batch(pending_bodies, prompt, model, config)
+    elif config["extraction"]["pack_size"] > 1:
+        extracted_stream = extract_packed_stream(
+            pending_bodies, prompt, model, workers, config["extraction"]["pack_size"]
+        )
+    else:
+        extracted_stream = extract_stream(pending_bodies, prompt, model, workers)
+
+    # 完了した順に受け取り、入力順に並べ直す
+    progress_interval = max(1, len(comment_ids) // 100)
+    pending_progress = 0
+    failed = 0
+    for position, extracted_args in tqdm(extracted_stream, total=len(pending_indices)):
+        i = pending_indices[position]
+        if extracted_args is None:
+            # 失敗した・応答をパースできなかったコメントはジャーナルに残さない（意見なしとして出力し、ジャーナルは最後に削除せず残す）
+            extracted_args = []
+            failed += 1
+        else:
+            journal.append(journal_keys[i], extracted_args)
+        extracted_args_list[i] = extracted_args
+        pending_progress += 1
+        # 1件ごとにステータスファイルを書き換えないよう、進捗の更新は約1%ごとにまとめる
+        if pending_progress >= progress_interval:
+            update_progress(config, incr=pending_progress)
+            pending_progress = 0
+    if pending_progress:
+        update_progress(config, incr=pending_progress)
+    journal.close()
+
+    results, relation_df = build_argument_tables(comment_ids, extracted_args_list)
 
     if results.empty:
         raise RuntimeError("result is empty, maybe bad prompt")
@@ -91,33 +128,112 @@ def extraction(config):
     results.to_csv(path, index=False)
     # comment-idとarg-idの関係を保存
     relation_df.to_csv(f"outputs/{dataset}/relations.csv", index=False)
+    if failed:
+        # 抽出ステップを再実行（-o extraction）すると、ジャーナルにない失敗したコメントだけを再度抽出する
+        print(f"Extraction failed for {failed} comments, keeping {journal.path} to retry them on the next extraction run")
+    else:
+        journal.remove()
 
 
 logging.basicConfig(level=logging.ERROR)
 
 
-def extract_batch(batch, prompt, model, workers):
-    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
-        futures_with_index = [
-            (i, executor.submit(extract_arguments, input, prompt, model)) for i, input in enumerate(batch)
-        ]
+# タイムアウトしたコメントを後回しにして再試行する回数
+EXTRACTION_TIMEOUT_RETRIES = 2
+
+
+def extract_stream(inputs, prompt, model, workers):
+    """各コメントから意見を抽出し、完了した順に (入力の位置, 抽出結果) を返す（失敗・パースできなかったコメントの抽出結果はNone）
+
+    最大 workers 件のリクエストを常に送信中に保ち、1件完了するごとに次のコメントを送る。
+    タイムアウトしたコメントは破棄せず、他のコメントの処理が終わった後に再試行する。
+    """
+
+    async def extract(index):
+        return await extract_arguments(inputs[index], prompt, model)
 
-        done, not_done = concurrent.futures.wait([f for _, f in futures_with_index], timeout=30)
-        results = [[] for _ in range(len(batch))]
+    pending = list(range(len(inputs)))
+    for attempt in range(EXTRACTION_TIMEOUT_RETRIES + 1):
+        timed_out = []
+        for position, result in run_concurrently(extract, pending, max_in_flight=workers):
+            index = pending[position]
+            if isinstance(result, (openai.APITimeoutError, asyncio.TimeoutError)) and attempt < EXTRACTION_TIMEOUT_RETRIES:
+                timed_out.append(index)
+                continue
+            if isinstance(result, Exception):
+                logging.error(f"Extraction for input {index} failed with error: {result!r}")
+                result = None
+            yield index, result
+        if not timed_out:
+            break
+        logging.warning(f"Retrying {len(timed_out)} timed-out inputs (attempt {attempt + 2})")
+        pending = timed_out
 
-        for _, future in futures_with_index:
-            if future in not_done and not future.cancelled():
-                future.cancel()
 
-        for i, future in futures_with_index:
-            if future in done:
-                try:
-                    result = future.result()
-                    results[i] = result
-                except Exception as e:
-                    logging.error(f"Task {future} failed with error: {e}")
-                    results[i] = []
-        return results
+def extract_packed_stream(inputs, prompt, model, workers, pack_size):
+    """pack_size 件ずつのコメントを1リクエストにまとめて抽出し、完了した順に (入力の位置, 抽出結果) を返す
+
+    応答をパースできなかったコメントは、まとめたリクエストが全て終わった後に extract_stream で1件ずつ再抽出する。
+    終了時に、1件ずつ送った場合と比べたプロンプトのトークン数（見積もり）を表示する。
+    """
+    packs = [list(range(start, min(start + pack_size, len(inputs)))) for start in range(0, len(inputs), pack_size)]
+
+    async def extract(pack):
+        return await extract_packed_arguments([inputs[index] for index in pack], prompt, model)
+
+    fallback = []
+    for position, result in run_concurrently(extract, packs, max_in_flight=workers):
+        pack = packs[position]
+        if isinstance(result, Exception):
+            logging.warning(f"Packed extraction for inputs {pack[0]}-{pack[-1]} failed with error: {result!r}")
+            result = {}
+        for tag_index, index in enumerate(pack):
+            extracted_args = result.get(_pack_tag(tag_index))
+            if extracted_args is None:
+                fallback.append(index)
+            else:
+                yield index, extracted_args
+
+    if fallback:
+        logging.warning(f"Falling back to single-comment extraction for {len(fallback)} inputs")
+        for position, result in extract_stream([inputs[index] for index in fallback], prompt, model, workers):
+            yield fallback[position], result
+
+    baseline_tokens = sum(estimate_tokens(_extraction_messages(input, prompt)) for input in inputs)
+    packed_tokens = sum(
+        estimate_tokens(_packed_extraction_messages([inputs[index] for index in pack], prompt)) for pack in packs
+    ) + sum(estimate_tokens(_extraction_messages(inputs[index], prompt)) for index in fallback)
+    saved_tokens = baseline_tokens - packed_tokens
+    print(
+        f"Packed extraction: {len(packs) + len(fallback)} requests instead of {len(inputs)}, "
+        f"~{saved_tokens} prompt tokens saved ({saved_tokens / max(1, baseline_tokens):.0%} of one-per-call baseline)"
+    )
+
+
+def extract_batch(inputs, prompt, model, config):
+    """各コメントの抽出リクエストをバッチAPIでまとめて実行し、(入力の位置, 抽出結果) を返す（失敗・パースできなかったコメントの抽出結果はNone）"""
+    requests = [
+        BatchRequest(custom_id=str(index), messages=_extraction_messages(input, prompt), model=model)
+        for index, input in enumerate(inputs)
+    ]
+    responses = run_batch(
+        requests,
+        get_batch_backend(config["extraction"]["batch_backend"], config["extraction"]["batch_local_responses"]),
+        f"outputs/{config['output_dir']}/extraction_batch.jsonl",
+        poll_interval=config["extraction"]["batch_poll_interval"],
+    )
+    for index in range(len(inputs)):
+        response = responses[str(index)]
+        if response is None:
+            yield index, None
+            continue
+        try:
+            yield index, _parse_arguments(response)
+        except (json.decoder.JSONDecodeError, RuntimeError) as e:
+            logging.error(f"Extraction for input {index} returned invalid JSON: {e}")
+            # パースできなかった応答はキャッシュに残さず、次回の実行で送り直す
+            evict_chat_response(requests[index].messages, model, is_json=False)
+            yield index, None
 
 
 # def extract_by_llm(input, prompt, model):
@@ -129,19 +245,62 @@ def extract_batch(batch, prompt, model, workers):
 #     return response
 
 
-def extract_arguments(input, prompt, model, retries=3):
-    messages = [
+def _extraction_messages(input, prompt):
+    return [
         {"role": "system", "content": prompt},
         {"role": "user", "content": input},
     ]
+
+
+# 複数コメントをまとめて送る場合にシステムプロンプトの後ろに追加する指示
+PACKED_EXTRACTION_INSTRUCTION = """
+
+# 複数コメントの入力
+以降の入力には、複数のコメントが「[C0]」「[C1]」のようなタグ付きで与えられます。
+各コメントに対して上記と同じ基準で個別に抽出し、タグをキー、抽出した文字列リストを値とするJSONオブジェクトを返してください。
+抽出する情報がないコメントも、空のリストを値として全てのタグをキーに含めてください。
+出力例: {"C0": ["...", "..."], "C1": []}
+"""
+
+
+def _pack_tag(tag_index):
+    return f"C{tag_index}"
+
+
+def _packed_extraction_messages(inputs, prompt):
+    packed_input = "\n\n".join(f"[{_pack_tag(tag_index)}]\n{input}" for tag_index, input in enumerate(inputs))
+    return [
+        {"role": "system", "content": prompt + PACKED_EXTRACTION_INSTRUCTION},
+        {"role": "user", "content": packed_input},
+    ]
+
+
+def _parse_arguments(response):
+    items = parse_response(response)
+    return list(filter(None, items))  # omit empty strings
+
+
+async def extract_arguments(input, prompt, model, retries=3):
+    messages = _extraction_messages(input, prompt)
+    response = await request_to_chat_llm_async(messages=messages, model=model, is_json=False)
     try:
-        response = request_to_chat_llm(messages=messages, model=model, is_json=False)
-        items = parse_response(response)
-        items = filter(None, items)  # omit empty strings
-        return items
-    except json.decoder.JSONDecodeError as e:
+        return _parse_arguments(response)
+    except (json.decoder.JSONDecodeError, RuntimeError) as e:
+        # パースできなかった応答はキャッシュに残さず、次回の実行で送り直す
+        evict_chat_response(messages, model, is_json=False)
         print("JSON error:", e)
         print("Input was:", input)
         print("Response was:", response)
-        print("Silently giving up on trying to generate valid list.")
-        return []
\ No newline at end of file
+        print("Giving up on this comment, it will be retried on the next extraction run.")
+        return None
+
+
+async def extract_packed_arguments(inputs, prompt, model):
+    """複数コメントを1リクエストで抽出し、{タグ: 意見のリスト} を返す（パースできなかったコメントのタグは含まない）"""
+    messages = _packed_extraction_messages(inputs, prompt)
+    response = await request_to_chat_llm_async(messages=messages, model=model, is_json=True)
+    results = parse_packed_response(response, [_pack_tag(tag_index) for tag_index in range(len(inputs))])
+    if len(results) < len(inputs):
+        # 一部のコメントをパースできなかった応答はキャッシュに残さず、次回の実行で送り直す
+        evict_chat_response(messages, model, is_json=True)
+    return results
@@ -7,6 +7,8 @@ from typing import TypedDict
 
 import pandas as pd
 
+from services.input_reader import ID_COLUMN_DTYPES, count_input_rows, read_comments_by_id, read_input_columns
+
 ROOT_DIR = Path(__file__).parent.parent.parent.parent
 CONFIG_DIR = ROOT_DIR / "scatter" / "pipeline" / "configs"
 
@@ -43,12 +45,14 @@ def hierarchical_aggregation(config):
         "config": config,
     }
 
-    arguments = pd.read_csv(f"outputs/{config['output_dir']}/args.csv")
+    # IDは入力CSVと同じく文字列として読み、元コメントの comment-id と一致させる
+    arguments = pd.read_csv(f"outputs/{config['output_dir']}/args.csv", dtype=ID_COLUMN_DTYPES)
     arguments.set_index("arg-id", inplace=True)
     arg_num = len(arguments)
-    relation_df = pd.read_csv(f"outputs/{config['output_dir']}/relations.csv")
-    comments = pd.read_csv(f"inputs/{config['input']}.csv")
-    clusters = pd.read_csv(f"outputs/{config['output_dir']}/hierarchical_clusters.csv")
+    relation_df = pd.read_csv(f"outputs/{config['output_dir']}/relations.csv", dtype=ID_COLUMN_DTYPES)
+    # 入力CSVは件数だけが必要なため、全体を読み込まずに数える
+    input_count = count_input_rows(f"inputs/{config['input']}.csv")
+    clusters = pd.read_csv(f"outputs/{config['output_dir']}/hierarchical_clusters.csv", dtype=ID_COLUMN_DTYPES)
     labels = pd.read_csv(f"outputs/{config['output_dir']}/hierarchical_merge_labels.csv")
 
     hidden_properties_map: dict[str, list[str]] = config["hierarchical_aggregation"]["hidden_properties"]
@@ -57,9 +61,9 @@ def hierarchical_aggregation(config):
     results["clusters"] = _build_cluster_value(labels, arg_num)
     # NOTE: 属性に応じたコメントフィルタ機能が実装されておらず、全てのコメントが含まれてしまうので、コメントアウト
     # results["comments"] = _build_comments_value(
-    #     comments, arguments, hidden_properties_map
+    #     pd.read_csv(f"inputs/{config['input']}.csv"), arguments, hidden_properties_map
     # )
-    results["comment_num"] = len(comments)
+    results["comment_num"] = input_count
     results["translations"] = _build_translations(config)
     # 属性情報のカラムは、元データに対して指定したカラムとclassificationするカテゴリを合わせたもの
     results["propertyMap"] = _build_property_map(arguments, hidden_properties_map, config)
@@ -73,18 +77,18 @@ def hierarchical_aggregation(config):
     with open(path, "w", encoding='utf-8') as file:
         json.dump(results, file, indent=2, ensure_ascii=False)
     # TODO: サンプリングロジックを実装したいが、現状は全件抽出
-    create_custom_intro(config)
+    create_custom_intro(config, input_count)
     if config["is_pubcom"]:
         add_original_comments(labels, arguments, relation_df, clusters, config)
 
 
-def create_custom_intro(config):
+def create_custom_intro(config, input_count=None):
     dataset = config["output_dir"]
     args_path = f"outputs/{dataset}/args.csv"
-    comments = pd.read_csv(f"inputs/{config['input']}.csv")
     result_path = f"outputs/{dataset}/hierarchical_result.json"
 
-    input_count = len(comments)
+    if input_count is None:
+        input_count = count_input_rows(f"inputs/{config['input']}.csv")
     args_count = len(pd.read_csv(args_path))
     processed_num = min(input_count, config["extraction"]["limit"])
 
@@ -119,10 +123,13 @@ def add_original_comments(labels, arguments, relation_df, clusters, config):
     # relation_df と結合
     merged = merged.merge(relation_df, on="arg-id", how="left")
 
-    # 元コメント取得
-    comments = pd.read_csv(f"inputs/{config['input']}.csv")
-    comments["comment-id"] = comments["comment-id"].astype(str)
+    # 元コメント取得（必要なカラム・結果に含まれるコメントの行だけをチャンク単位で読み込む）
     merged["comment-id"] = merged["comment-id"].astype(str)
+    input_path = f"inputs/{config['input']}.csv"
+    comment_columns = ["comment-id", "comment-body"] + [
+        col for col in ["source", "url"] if col in read_input_columns(input_path)
+    ]
+    comments = read_comments_by_id(input_path, set(merged["comment-id"]), comment_columns)
 
     # 元コメント本文などとマージ
     final_df = merged.merge(comments, on="comment-id", how="left")
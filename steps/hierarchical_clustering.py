@@ -1,43 +1,140 @@
 """Cluster the arguments using UMAP + HDBSCAN and GPT-4."""
 
+import json
+import os
+import warnings
 from importlib import import_module
 
+import joblib
 import numpy as np
 import pandas as pd
 import scipy.cluster.hierarchy as sch
-from sklearn.cluster import KMeans
+from joblib import Parallel, delayed
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import davies_bouldin_score, pairwise_distances_argmin, silhouette_score
 
+from services.embedding_reduction import load_reduced_embeddings
+from services.embedding_store import load_embeddings
+from services.journal import fingerprint
+from services.knn_graph import load_knn_graph
 
-def hierarchical_clustering(config):
-    UMAP = import_module("umap").UMAP
+# 学習済みのモデル（次元削減・UMAP・KMeansの中心・ウォード法の樹形図）と、incremental で割り当てた際の各クラスタの変化
+CLUSTERING_MODEL_FILENAME = "hierarchical_clustering_model.joblib"
+CLUSTER_DRIFT_FILENAME = "hierarchical_cluster_drift.csv"
+# 保存したモデルを使って割り当てるには、これらの設定が前回と同じである必要がある
+CLUSTERING_MODEL_PARAMS = ["cluster_nums", "pre_reduction", "pre_reduction_dim"]
+# ラベルのCSVと並べて保存する、ラベリングの設定のフィンガープリントのファイル名の接尾辞
+LABEL_FINGERPRINT_SUFFIX = ".fingerprint.json"
+# ラベルの内容に影響しないため、フィンガープリントに含めないラベリングの設定（source_code は実行時に追加されるステップのコード）
+LABELLING_RUNTIME_PARAMS = ["workers", "source_code"]
+
+KMEANS_ENGINES = ["kmeans", "minibatch"]
+# kmeans_engine="minibatch" の1バッチの件数のデフォルト値
+KMEANS_BATCH_SIZE = 4096
+
+# cluster_nums="auto" で評価するクラスタ数の候補の数と、シルエット係数の計算に使う件数のデフォルト値
+AUTO_CANDIDATE_NUM = 16
+AUTO_SILHOUETTE_SAMPLE_SIZE = 10000
+CLUSTER_NUM_SCORES_FILENAME = "hierarchical_cluster_num_scores.csv"
 
+UMAP_MODES = ["exact", "subsample"]
+# umap_mode="subsample" で学習に使う件数のデフォルト値
+UMAP_SUBSAMPLE_SIZE = 20000
+# 層化抽出の層の数
+UMAP_SUBSAMPLE_STRATA = 50
+# 学習に使わなかった埋め込みを transform する単位（の下限）
+# umap-learnは10000件を超える transform では最適化のエポック数を100から30に減らすため、それより大きくする
+UMAP_TRANSFORM_CHUNK_SIZE = 20000
+
+
+def hierarchical_clustering(config):
     dataset = config["output_dir"]
     path = f"outputs/{dataset}/hierarchical_clusters.csv"
+    model_path = f"outputs/{dataset}/{CLUSTERING_MODEL_FILENAME}"
+    drift_path = f"outputs/{dataset}/{CLUSTER_DRIFT_FILENAME}"
+    clustering_config = config["hierarchical_clustering"]
     arguments_df = pd.read_csv(f"outputs/{dataset}/args.csv", usecols=["arg-id", "argument"])
-    embeddings_df = pd.read_pickle(f"outputs/{dataset}/embeddings.pkl")
-    embeddings_array = np.asarray(embeddings_df["embedding"].values.tolist())
-    cluster_nums = config["hierarchical_clustering"]["cluster_nums"]
+    # float32の埋め込み行列をmmapで開く（コピーせずにUMAPへ渡す）
+    embedding_arg_ids, embeddings_array = load_embeddings(f"outputs/{dataset}")
+    if not embedding_arg_ids.equals(arguments_df["arg-id"]):
+        raise ValueError("Embeddings are not aligned with args.csv, please re-run the embedding step")
+    cluster_nums = clustering_config["cluster_nums"]
 
-    n_samples = embeddings_array.shape[0]
-    # デフォルト設定は15
-    default_n_neighbors = 15
+    if clustering_config["incremental"]:
+        model = _load_reusable_model(model_path, path, clustering_config)
+        if model is not None:
+            result_df, drift_df = assign_new_arguments(
+                arguments_df, embeddings_array, pd.read_csv(path), model, clustering_config
+            )
+            result_df.to_csv(path, index=False)
+            drift_df.to_csv(drift_path, index=False)
+            return
+    # 全件で学習し直した場合は、前回の結果からの変化を使わない（後続のステップで全てのクラスタをラベリングする）
+    if os.path.exists(drift_path):
+        os.remove(drift_path)
 
-    # テスト等サンプルが少なすぎる場合、n_neighborsの設定値を下げる
-    if n_samples <= default_n_neighbors:
-        n_neighbors = max(2, n_samples - 1)  # 最低2以上
-    else:
-        n_neighbors = default_n_neighbors
+    reducer = None
+    pre_reduction = clustering_config["pre_reduction"]
+    if pre_reduction:
+        embeddings_array, reducer = load_reduced_embeddings(
+            f"outputs/{dataset}", embeddings_array, pre_reduction, clustering_config["pre_reduction_dim"]
+        )
 
-    umap_model = UMAP(random_state=42, n_components=2, n_neighbors=n_neighbors)
-    # TODO 詳細エラーメッセージを加える
-    # 以下のエラーの場合、おそらく元の意見件数が少なすぎることが原因
-    # TypeError: Cannot use scipy.linalg.eigh for sparse A with k >= N. Use scipy.linalg.eigh(A.toarray()) or reduce k.
-    umap_embeds = umap_model.fit_transform(embeddings_array)
+    knn_path = clustering_config["umap_knn"]
+    umap_embeds, umap_model = project_embeddings(
+        embeddings_array,
+        mode=clustering_config["umap_mode"],
+        subsample_size=clustering_config["umap_subsample_size"],
+        parallel=clustering_config["umap_parallel"],
+        workers=clustering_config["umap_workers"],
+        precomputed_knn=load_knn_graph(knn_path, embeddings_array.shape[0]) if knn_path else None,
+    )
+
+    if cluster_nums == "auto":
+        candidates = candidate_cluster_nums(
+            clustering_config["auto_min_clusters"], clustering_config["auto_max_clusters"], len(umap_embeds)
+        )
+        print(f"Scoring cluster counts {candidates}")
+        scores_df = score_cluster_nums(
+            umap_embeds,
+            candidates,
+            engine=clustering_config["kmeans_engine"],
+            batch_size=clustering_config["kmeans_batch_size"],
+            n_init=clustering_config["kmeans_n_init"],
+            sample_size=clustering_config["auto_silhouette_sample_size"],
+            workers=clustering_config["auto_workers"],
+        )
+        cluster_nums = select_cluster_nums(scores_df)
+        scores_df["selected"] = scores_df["k"].isin(cluster_nums)
+        scores_df.to_csv(f"outputs/{dataset}/{CLUSTER_NUM_SCORES_FILENAME}", index=False)
+        print(f"Selected cluster_nums: {cluster_nums}")
 
-    cluster_results = hierarchical_clustering_embeddings(
+    cluster_results, kmeans_centers, linkage = fit_hierarchical_clusters(
         umap_embeds=umap_embeds,
         cluster_nums=cluster_nums,
+        engine=clustering_config["kmeans_engine"],
+        batch_size=clustering_config["kmeans_batch_size"],
+        n_init=clustering_config["kmeans_n_init"],
     )
+    result_df = _build_result_df(arguments_df, umap_embeds, cluster_results)
+    result_df.to_csv(path, index=False)
+
+    # 追加の意見を同じクラスタに割り当てられるよう、学習済みのモデルを保存する
+    joblib.dump(
+        {
+            "params": _model_params(clustering_config),
+            "reducer": reducer,
+            # 事前計算したk近傍グラフで学習したUMAPは検索用インデックスを持たず transform できない
+            "umap": None if knn_path else umap_model,
+            "kmeans_centers": kmeans_centers,
+            "linkage": linkage,
+            "cluster_nums": sorted(cluster_nums),
+        },
+        model_path,
+    )
+
+
+def _build_result_df(arguments_df, umap_embeds, cluster_results):
     result_df = pd.DataFrame(
         {
             "arg-id": arguments_df["arg-id"],
@@ -49,8 +146,243 @@ def hierarchical_clustering(config):
 
     for cluster_level, final_labels in enumerate(cluster_results.values(), start=1):
         result_df[f"cluster-level-{cluster_level}-id"] = [f"{cluster_level}_{label}" for label in final_labels]
+    return result_df
 
-    result_df.to_csv(path, index=False)
+
+def _load_reusable_model(model_path, path, clustering_config):
+    """前回保存したモデルを返す（無い、または設定が変わって使えない場合は None）"""
+    if not os.path.exists(model_path) or not os.path.exists(path):
+        print("No saved clustering model found, fitting on all arguments")
+        return None
+    model = joblib.load(model_path)
+    params = _model_params(clustering_config)
+    changed = [key for key in CLUSTERING_MODEL_PARAMS if model["params"].get(key) != params[key]]
+    if changed:
+        print(f"Clustering parameters changed ({', '.join(changed)}), fitting on all arguments")
+        return None
+    if model["umap"] is None:
+        print("The saved UMAP model was fitted on a precomputed kNN graph and cannot transform, fitting on all arguments")
+        return None
+    return model
+
+
+def _model_params(clustering_config):
+    params = {key: clustering_config[key] for key in CLUSTERING_MODEL_PARAMS}
+    if isinstance(params["cluster_nums"], list):
+        params["cluster_nums"] = sorted(params["cluster_nums"])
+    return params
+
+
+def assign_new_arguments(arguments_df, embeddings_array, previous_df, model, clustering_config):
+    """前回の結果に含まれない意見だけを保存済みのモデルで射影し、既存のクラスタに割り当てる
+
+    前回から残っている意見の座標とクラスタは変えない。(新しい結果, 各クラスタの件数の変化) を返す。
+    """
+    is_new = ~arguments_df["arg-id"].isin(previous_df["arg-id"]).to_numpy()
+    new_index = np.flatnonzero(is_new)
+    kept_df = arguments_df[["arg-id"]].merge(previous_df.drop(columns=["argument"]), on="arg-id", how="inner")
+    print(f"Assigning {len(new_index)} new arguments to existing clusters ({len(kept_df)} kept)")
+
+    new_matrix = np.asarray(embeddings_array[new_index])
+    if model["reducer"] is not None and len(new_index):
+        new_matrix = model["reducer"].transform(new_matrix).astype(np.float32, copy=False)
+    new_embeds = np.empty((len(new_index), 2), dtype=np.float32)
+    if len(new_index):
+        new_embeds[:] = _transform_in_chunks(model["umap"], new_matrix, clustering_config["umap_workers"])
+    new_results = assign_to_clusters(new_embeds, model["kmeans_centers"], model["linkage"], model["cluster_nums"])
+    new_df = _build_result_df(arguments_df.iloc[new_index], new_embeds, new_results)
+
+    # args.csv の順に並べ直す
+    result_df = pd.concat([kept_df, new_df.drop(columns=["argument"])], ignore_index=True)
+    result_df = arguments_df.merge(result_df, on="arg-id", how="left")
+    return result_df, _cluster_drift(previous_df, result_df, clustering_config["relabel_threshold"])
+
+
+def assign_to_clusters(umap_embeds, kmeans_centers, linkage, cluster_nums):
+    """最も近いKMeansの中心に割り当て、保存したウォード法の樹形図で上位の階層のクラスタを決める"""
+    if len(umap_embeds) == 0:
+        finest_labels = np.zeros(0, dtype=int)
+    else:
+        # (意見数, クラスタ数) の距離行列を一度に作らないよう、チャンク単位で計算する
+        finest_labels = pairwise_distances_argmin(umap_embeds, kmeans_centers)
+    return cut_hierarchy(linkage, finest_labels, cluster_nums)
+
+
+def _cluster_drift(previous_df, result_df, threshold):
+    """各クラスタについて、前回の件数に対する追加・削除された意見の割合を計算する"""
+    added_ids = set(result_df["arg-id"]) - set(previous_df["arg-id"])
+    removed_ids = set(previous_df["arg-id"]) - set(result_df["arg-id"])
+    id_columns = [col for col in result_df.columns if col.startswith("cluster-level-") and col.endswith("-id")]
+    rows = []
+    for level, column in enumerate(id_columns, start=1):
+        previous_counts = previous_df[column].value_counts()
+        drift_df = pd.DataFrame(
+            {
+                "previous_value": previous_counts,
+                "value": result_df[column].value_counts(),
+                "added": result_df.loc[result_df["arg-id"].isin(added_ids), column].value_counts(),
+                "removed": previous_df.loc[previous_df["arg-id"].isin(removed_ids), column].value_counts(),
+            }
+        ).fillna(0)
+        drift_df["drift"] = (drift_df["added"] + drift_df["removed"]) / drift_df["previous_value"]
+        rows.append(drift_df.rename_axis("id").reset_index().assign(level=level))
+    drift_df = pd.concat(rows, ignore_index=True)
+    drift_df["relabel"] = drift_df["drift"] > threshold
+    print(f"{int(drift_df['relabel'].sum())} of {len(drift_df)} clusters drifted more than {threshold:.0%}")
+    return drift_df[["level", "id", "previous_value", "value", "added", "removed", "drift", "relabel"]]
+
+
+def load_reusable_cluster_ids(config, label_path: str, steps: list[str]) -> set[str]:
+    """前回のラベルをそのまま使えるクラスタのidを返す
+
+    incremental で既存のクラスタに割り当てた場合のみ、件数の変化が relabel_threshold 以下のクラスタを返す。
+    steps はラベルに影響するラベリングのステップ（最後が実行中のステップ）。実行中のステップを -f / -o で強制した場合や、
+    label_path を書いた時と steps の設定（labelling_fingerprint）が異なる場合は空集合を返す（全てのクラスタをラベリングする）。
+    """
+    drift_path = f"outputs/{config['output_dir']}/{CLUSTER_DRIFT_FILENAME}"
+    if not config["hierarchical_clustering"]["incremental"] or not os.path.exists(drift_path):
+        return set()
+    if config.get("force", False) or config.get("only") == steps[-1]:
+        print(f"{steps[-1]} was forced, labelling all clusters")
+        return set()
+    if _load_label_fingerprint(label_path) != labelling_fingerprint(config, steps):
+        print(f"{steps[-1]} settings changed since {label_path} was written, labelling all clusters")
+        return set()
+    drift_df = pd.read_csv(drift_path)
+    return set(drift_df.loc[~drift_df["relabel"], "id"])
+
+
+def labelling_fingerprint(config, steps: list[str]) -> str:
+    """steps のラベリングの設定（プロンプト・モデル・サンプリング・pack_size・token_budget 等）からハッシュを作る"""
+    return fingerprint(
+        *[
+            {key: value for key, value in config[step].items() if key not in LABELLING_RUNTIME_PARAMS}
+            for step in steps
+        ]
+    )
+
+
+def save_label_fingerprint(config, label_path: str, steps: list[str]) -> None:
+    """label_path を書いた時のラベリングの設定のフィンガープリントを、label_path と並べて保存する"""
+    with open(label_path + LABEL_FINGERPRINT_SUFFIX, "w", encoding="utf-8") as f:
+        json.dump({"fingerprint": labelling_fingerprint(config, steps)}, f)
+
+
+def _load_label_fingerprint(label_path: str) -> str | None:
+    fingerprint_path = label_path + LABEL_FINGERPRINT_SUFFIX
+    if not os.path.exists(fingerprint_path):
+        return None
+    with open(fingerprint_path, encoding="utf-8") as f:
+        try:
+            return json.load(f).get("fingerprint")
+        except json.JSONDecodeError:
+            return None
+
+
+def project_embeddings(
+    embeddings_array,
+    mode="exact",
+    subsample_size=UMAP_SUBSAMPLE_SIZE,
+    parallel=False,
+    workers=1,
+    precomputed_knn=None,
+):
+    """埋め込み行列をUMAPで2次元に射影し、(座標, 学習したUMAPモデル) を返す
+
+    mode="exact" は全件でUMAPを学習する。mode="subsample" は層化抽出した subsample_size 件で学習し、
+    残りを UMAP_TRANSFORM_CHUNK_SIZE 件以上のチャンクに分けて workers 個のプロセスで transform する。
+    parallel=True の場合は乱数シードを固定せずにマルチスレッドで学習する（実行毎に結果が変わる）。
+    precomputed_knn には全件の近似k近傍グラフ (indices, distances) を渡せる（mode="exact" のみ）。
+    """
+    n_samples = embeddings_array.shape[0]
+    if mode not in UMAP_MODES:
+        raise ValueError(f"Unknown umap_mode: {mode}, available modes: {UMAP_MODES}")
+    if mode == "subsample" and precomputed_knn is not None:
+        raise ValueError("umap_knn can only be used with umap_mode 'exact'")
+    if mode == "exact" or n_samples <= subsample_size:
+        umap_model = _fit_umap(embeddings_array, parallel, precomputed_knn)
+        return umap_model.embedding_, umap_model
+
+    fit_index = stratified_subsample(embeddings_array, subsample_size)
+    print(f"Fitting UMAP on {len(fit_index)} of {n_samples} embeddings")
+    umap_model = _fit_umap(np.asarray(embeddings_array[fit_index]), parallel, for_transform=True)
+
+    rest_mask = np.ones(n_samples, dtype=bool)
+    rest_mask[fit_index] = False
+    rest_index = np.flatnonzero(rest_mask)
+
+    umap_embeds = np.empty((n_samples, 2), dtype=np.float32)
+    umap_embeds[fit_index] = umap_model.embedding_
+    umap_embeds[rest_index] = _transform_in_chunks(umap_model, embeddings_array, workers, rest_index)
+    return umap_embeds, umap_model
+
+
+def _transform_in_chunks(umap_model, embeddings_array, workers, index=None):
+    """embeddings_array の index の行（省略時は全行）を UMAP_TRANSFORM_CHUNK_SIZE 件以上のチャンクに分けて transform する"""
+    if index is None:
+        index = np.arange(embeddings_array.shape[0])
+    chunks = np.array_split(index, max(1, len(index) // UMAP_TRANSFORM_CHUNK_SIZE))
+    # チャンクの区切りは workers に依らないため、並列数を変えても結果は同じ
+    transformed = Parallel(n_jobs=workers)(
+        delayed(umap_model.transform)(np.asarray(embeddings_array[chunk])) for chunk in chunks
+    )
+    return np.concatenate(transformed)
+
+
+def _fit_umap(embeddings_array, parallel, precomputed_knn=None, for_transform=False):
+    UMAP = import_module("umap").UMAP
+
+    n_samples = embeddings_array.shape[0]
+    # デフォルト設定は15
+    default_n_neighbors = 15
+
+    # テスト等サンプルが少なすぎる場合、n_neighborsの設定値を下げる
+    if n_samples <= default_n_neighbors:
+        n_neighbors = max(2, n_samples - 1)  # 最低2以上
+    else:
+        n_neighbors = default_n_neighbors
+
+    umap_options = {"n_components": 2, "n_neighbors": n_neighbors}
+    # random_stateを指定するとumap-learnはシングルスレッドで動くため、並列化する場合は指定しない
+    umap_options.update({"n_jobs": -1} if parallel else {"random_state": 42})
+    if precomputed_knn is not None:
+        umap_options["precomputed_knn"] = precomputed_knn
+    if for_transform:
+        # 4096件未満で学習すると transform が全件との距離をPythonの関数で計算して非常に遅くなるため、
+        # 件数に依らずNN-descentの検索用インデックスを作らせる
+        umap_options["force_approximation_algorithm"] = True
+    umap_model = UMAP(**umap_options)
+    # TODO 詳細エラーメッセージを加える
+    # 以下のエラーの場合、おそらく元の意見件数が少なすぎることが原因
+    # TypeError: Cannot use scipy.linalg.eigh for sparse A with k >= N. Use scipy.linalg.eigh(A.toarray()) or reduce k.
+    with warnings.catch_warnings():
+        # 事前計算したグラフには検索用インデックスが無い旨の警告（transformは使わないため無視する）
+        warnings.filterwarnings("ignore", message=r"precomputed_knn\[2\]")
+        umap_model.fit(embeddings_array)
+    return umap_model
+
+
+def stratified_subsample(embeddings_array, size: int) -> np.ndarray:
+    """MiniBatchKMeansで UMAP_SUBSAMPLE_STRATA 個の層に分け、各層の件数に比例して size 件を抽出する"""
+    n_samples = embeddings_array.shape[0]
+    n_strata = min(UMAP_SUBSAMPLE_STRATA, size)
+    strata = MiniBatchKMeans(n_clusters=n_strata, batch_size=4096, n_init=1, random_state=42).fit_predict(
+        embeddings_array
+    )
+    counts = np.bincount(strata, minlength=n_strata)
+    # 最大剰余法で各層の抽出数を決める（合計がちょうど size になる）
+    quotas = counts * size / n_samples
+    allocated = np.floor(quotas).astype(int)
+    remainder_order = np.argsort(-(quotas - allocated), kind="stable")
+    allocated[remainder_order[: size - allocated.sum()]] += 1
+
+    rng = np.random.default_rng(42)
+    order = np.argsort(strata, kind="stable")
+    boundaries = np.concatenate([[0], np.cumsum(counts)])
+    sampled = [
+        rng.choice(order[boundaries[i] : boundaries[i + 1]], allocated[i], replace=False) for i in range(n_strata)
+    ]
+    return np.sort(np.concatenate(sampled))
 
 
 def generate_cluster_count_list(min_clusters: int, max_clusters: int):
@@ -82,51 +414,138 @@ def generate_cluster_count_list(min_clusters: int, max_clusters: int):
     return cluster_counts
 
 
+def candidate_cluster_nums(min_clusters: int, max_clusters: int, n_samples: int) -> list[int]:
+    """min_clusters から max_clusters までを対数的に等間隔に並べた候補（最大 AUTO_CANDIDATE_NUM 個）"""
+    max_clusters = min(max_clusters, n_samples - 1)
+    min_clusters = max(2, min(min_clusters, max_clusters))
+    candidates = np.geomspace(min_clusters, max_clusters, AUTO_CANDIDATE_NUM).round().astype(int)
+    return sorted(set(candidates.tolist()))
+
+
+def _score_cluster_num(umap_embeds, n_clusters, engine, batch_size, n_init, sample_size):
+    kmeans_model = make_kmeans(n_clusters, engine, batch_size, n_init).fit(umap_embeds)
+    labels = kmeans_model.labels_
+    return {
+        "k": n_clusters,
+        "inertia": float(((umap_embeds - kmeans_model.cluster_centers_[labels]) ** 2).sum()),
+        # シルエット係数は O(件数^2) のため、sample_size 件を抽出して計算する
+        "silhouette": silhouette_score(
+            umap_embeds, labels, sample_size=min(sample_size, len(labels)), random_state=42
+        ),
+        "davies_bouldin": davies_bouldin_score(umap_embeds, labels),
+    }
+
+
+def score_cluster_nums(
+    umap_embeds,
+    candidates,
+    engine="kmeans",
+    batch_size=KMEANS_BATCH_SIZE,
+    n_init="auto",
+    sample_size=AUTO_SILHOUETTE_SAMPLE_SIZE,
+    workers=1,
+) -> pd.DataFrame:
+    """各候補のクラスタ数でKMeansを実行し、慣性・シルエット係数・Davies-Bouldin指数を workers 個のプロセスで計算する"""
+    scores = Parallel(n_jobs=workers)(
+        delayed(_score_cluster_num)(umap_embeds, k, engine, batch_size, n_init, sample_size) for k in candidates
+    )
+    scores_df = pd.DataFrame(scores)
+    # シルエット係数は大きいほど、Davies-Bouldin指数は小さいほど良い
+    scores_df["rank"] = (
+        scores_df["silhouette"].rank(ascending=False) + scores_df["davies_bouldin"].rank(ascending=True)
+    ) / 2
+    # 慣性の曲線の肘: log(k) と慣性を[0, 1]に正規化し、両端を結ぶ直線から最も下に離れている点
+    log_k = np.log(scores_df["k"])
+    x = (log_k - log_k.min()) / max(log_k.max() - log_k.min(), 1e-12)
+    inertia = scores_df["inertia"]
+    y = (inertia - inertia.min()) / max(inertia.max() - inertia.min(), 1e-12)
+    scores_df["elbow"] = (1 - x) - y
+    return scores_df
+
+
+def select_cluster_nums(scores_df: pd.DataFrame) -> list[int]:
+    """スコアから階層毎のクラスタ数を決める
+
+    最下層はシルエット係数とDavies-Bouldin指数の順位の平均が最も良いクラスタ数、最上位の階層はその半分以下の候補の
+    うち慣性の曲線の肘にあたるクラスタ数とし、その間を generate_cluster_count_list で倍々に埋める。
+    最も良いクラスタ数が小さく半分以下の候補が無い場合は、それを最上位の階層とし、2倍以上の候補の肘を最下層とする。
+    """
+    best = int(scores_df.loc[scores_df["rank"].idxmin(), "k"])
+    coarser = scores_df[scores_df["k"] * 2 <= best]
+    if not coarser.empty:
+        return generate_cluster_count_list(int(coarser.loc[coarser["elbow"].idxmax(), "k"]), best)
+    finer = scores_df[scores_df["k"] >= best * 2]
+    if not finer.empty:
+        return generate_cluster_count_list(best, int(finer.loc[finer["elbow"].idxmax(), "k"]))
+    return [best]
+
+
 def merge_clusters_with_hierarchy(
-    cluster_centers: np.ndarray,
+    linkage: np.ndarray,
     kmeans_labels: np.ndarray,
-    umap_array: np.ndarray,
     n_cluster_cut: int,
 ):
-    Z = sch.linkage(cluster_centers, method="ward")
-    cluster_labels_merged = sch.fcluster(Z, t=n_cluster_cut, criterion="maxclust")
+    """KMeansの中心の樹形図を n_cluster_cut 個に切り、各意見のマージ後のクラスタ番号を返す"""
+    cluster_labels_merged = sch.fcluster(linkage, t=n_cluster_cut, criterion="maxclust")
+    # KMeansのクラスタ番号を添字にして、全意見のクラスタ番号をまとめて引き直す
+    return cluster_labels_merged[kmeans_labels]
 
-    n_samples = umap_array.shape[0]
-    final_labels = np.zeros(n_samples, dtype=int)
 
-    for i in range(n_samples):
-        original_label = kmeans_labels[i]
-        final_labels[i] = cluster_labels_merged[original_label]
+def cut_hierarchy(linkage: np.ndarray, kmeans_labels: np.ndarray, cluster_nums: list[int]):
+    """1つの樹形図を cluster_nums の各数で切り、{クラスタ数: 各意見のクラスタ番号} を返す
 
-    return final_labels
+    最後の要素（最下層）はKMeansのクラスタ番号をそのまま使う。
+    """
+    results = {}
+    for n_cluster_cut in cluster_nums[:-1]:
+        print("n_cluster_cut: ", n_cluster_cut)
+        results[n_cluster_cut] = merge_clusters_with_hierarchy(linkage, kmeans_labels, n_cluster_cut)
+    results[cluster_nums[-1]] = kmeans_labels
+    return results
 
 
 def hierarchical_clustering_embeddings(
     umap_embeds,
     cluster_nums,
 ):
+    return fit_hierarchical_clusters(umap_embeds, cluster_nums)[0]
+
+
+def make_kmeans(n_clusters, engine="kmeans", batch_size=KMEANS_BATCH_SIZE, n_init="auto"):
+    """最下層のクラスタリングに使うKMeansを返す
+
+    engine="minibatch" は batch_size 件ずつのミニバッチで中心を更新するMiniBatchKMeansを使う。
+    全件でのLloyd法より速くメモリも少ないが、慣性（クラスタ内の二乗距離の和）はやや大きくなる。
+    """
+    if engine not in KMEANS_ENGINES:
+        raise ValueError(f"Unknown kmeans_engine: {engine}, available engines: {KMEANS_ENGINES}")
+    if engine == "minibatch":
+        return MiniBatchKMeans(n_clusters=n_clusters, batch_size=batch_size, n_init=n_init, random_state=42)
+    return KMeans(n_clusters=n_clusters, n_init=n_init, random_state=42)
+
+
+def fit_hierarchical_clusters(
+    umap_embeds,
+    cluster_nums,
+    engine="kmeans",
+    batch_size=KMEANS_BATCH_SIZE,
+    n_init="auto",
+):
+    """(階層毎のクラスタ番号, KMeansの中心, 中心のウォード法の樹形図) を返す"""
+    # 設定のリストを変えないよう、並べ替えたコピーを使う
+    cluster_nums = sorted(cluster_nums)
     # 最大分割数でクラスタリングを実施
     print("start initial clustering")
     initial_cluster_num = cluster_nums[-1]
-    kmeans_model = KMeans(n_clusters=initial_cluster_num, random_state=42)
+    kmeans_model = make_kmeans(initial_cluster_num, engine, batch_size, n_init)
     kmeans_model.fit(umap_embeds)
     print("end initial clustering")
 
-    results = {}
     print("start hierarchical clustering")
-    cluster_nums.sort()
     print(cluster_nums)
-    for n_cluster_cut in cluster_nums[:-1]:
-        print("n_cluster_cut: ", n_cluster_cut)
-        final_labels = merge_clusters_with_hierarchy(
-            cluster_centers=kmeans_model.cluster_centers_,
-            kmeans_labels=kmeans_model.labels_,
-            umap_array=umap_embeds,
-            n_cluster_cut=n_cluster_cut,
-        )
-        results[n_cluster_cut] = final_labels
-
-    results[initial_cluster_num] = kmeans_model.labels_
+    # 樹形図は全ての階層で共通のため、1回だけ計算する
+    linkage = sch.linkage(kmeans_model.cluster_centers_, method="ward")
+    results = cut_hierarchy(linkage, kmeans_model.labels_, cluster_nums)
     print("end hierarchical clustering")
 
-    return results
\ No newline at end of file
+    return results, kmeans_model.cluster_centers_, linkage
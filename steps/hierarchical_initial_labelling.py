@@ -1,11 +1,31 @@
 import json
-from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
 from functools import partial
+from itertools import chain
 from typing import TypedDict
 
+import numpy as np
 import pandas as pd
 
-from services.llm import request_to_chat_llm
+from services.async_llm import map_concurrently, request_to_chat_llm_async
+from services.cluster_index import build_cluster_index
+from services.packed_labelling import (
+    ERROR_DESCRIPTION,
+    ERROR_LABEL,
+    PackingReport,
+    labelling_messages,
+    packed_labelling_messages,
+)
+from services.parse_json_list import parse_packed_labels
+from services.llm import evict_chat_response
+from services.prompt_budget import PromptBudget, prompt_budget_from_config
+from services.representative_sampling import load_sampling_points, sample_cluster_rows
+from steps.hierarchical_clustering import load_reusable_cluster_ids, save_label_fingerprint
+
+# ラベルに影響するラベリングのステップ（前回のラベルを使えるかの判定に使う）
+LABELLING_STEPS = ["hierarchical_initial_labelling"]
+
 
 
 class LabellingResult(TypedDict):
@@ -24,9 +44,14 @@ def hierarchical_initial_labelling(config: dict) -> None:
             - output_dir: 出力ディレクトリ名
             - hierarchical_initial_labelling: 初期ラベリングの設定
                 - sampling_num: サンプリング数
+                - sampling_method: サンプリングする意見の選び方
+                - sampling_space: sampling_method の距離を測る空間
                 - prompt: LLMへのプロンプト
                 - model: 使用するLLMモデル名
                 - workers: 並列処理のワーカー数
+                - token_budget: 1リクエストのトークン数の上限
+                - max_item_tokens: 意見1件のトークン数の上限
+                - pack_size: 1リクエストにまとめてラベリングするクラスタ数
     """
     dataset = config["output_dir"]
     path = f"outputs/{dataset}/hierarchical_initial_labels.csv"
@@ -38,6 +63,15 @@ def hierarchical_initial_labelling(config: dict) -> None:
     initial_labelling_prompt = config["hierarchical_initial_labelling"]["prompt"]
     model = config["hierarchical_initial_labelling"]["model"]
     workers = config["hierarchical_initial_labelling"]["workers"]
+    sampling_method = config["hierarchical_initial_labelling"]["sampling_method"]
+    points = None
+    if sampling_method != "random":
+        points = load_sampling_points(
+            f"outputs/{dataset}", clusters_argument_df, config["hierarchical_initial_labelling"]["sampling_space"]
+        )
+    reusable_ids = load_reusable_cluster_ids(config, path, LABELLING_STEPS)
+    previous_labels = _load_previous_labels(path, initial_cluster_id_column, reusable_ids)
+    prompt_budget = prompt_budget_from_config("Initial labelling", config["hierarchical_initial_labelling"])
 
     initial_label_df = initial_labelling(
         initial_labelling_prompt,
@@ -45,7 +79,14 @@ def hierarchical_initial_labelling(config: dict) -> None:
         sampling_num,
         model,
         workers,
+        previous_labels,
+        sampling_method,
+        points,
+        prompt_budget,
+        config["hierarchical_initial_labelling"]["pack_size"],
     )
+    if prompt_budget is not None:
+        print(prompt_budget.summary())
     print("start initial labelling")
     initial_clusters_argument_df = clusters_argument_df.merge(
         initial_label_df,
@@ -60,6 +101,23 @@ def hierarchical_initial_labelling(config: dict) -> None:
     )
     print("end initial labelling")
     initial_clusters_argument_df.to_csv(path, index=False)
+    save_label_fingerprint(config, path, LABELLING_STEPS)
+
+
+def _load_previous_labels(path: str, cluster_id_column: str, reusable_ids: set[str]) -> list[LabellingResult]:
+    """前回の結果から、reusable_ids に含まれるクラスタのラベリング結果を取り出す"""
+    if not reusable_ids or not os.path.exists(path):
+        return []
+    label_column = f"{cluster_id_column.replace('-id', '')}-label"
+    description_column = f"{cluster_id_column.replace('-id', '')}-description"
+    previous_df = pd.read_csv(path, usecols=[cluster_id_column, label_column, description_column])
+    previous_df = previous_df[previous_df[cluster_id_column].isin(reusable_ids)].drop_duplicates(cluster_id_column)
+    # 前回ラベリングに失敗したクラスタはラベリングし直す
+    previous_df = previous_df[previous_df[label_column] != ERROR_LABEL]
+    return [
+        LabellingResult(cluster_id=row[cluster_id_column], label=row[label_column], description=row[description_column])
+        for _, row in previous_df.iterrows()
+    ]
 
 
 def initial_labelling(
@@ -68,6 +126,11 @@ def initial_labelling(
     sampling_num: int,
     model: str,
     workers: int,
+    previous_labels: list[LabellingResult] | None = None,
+    sampling_method: str = "random",
+    points: np.ndarray | None = None,
+    prompt_budget: PromptBudget | None = None,
+    pack_size: int = 1,
 ) -> pd.DataFrame:
     """各クラスタに対して初期ラベリングを実行する
 
@@ -77,13 +140,47 @@ def initial_labelling(
         sampling_num: 各クラスタからサンプリングする意見の数
         model: 使用するLLMモデル名
         workers: 並列処理のワーカー数
+        previous_labels: そのまま使う前回のラベリング結果（含まれるクラスタはLLMに送らない）
+        sampling_method: サンプリングする意見の選び方（services.representative_sampling.SAMPLING_METHODS）
+        points: clusters_df の各行の座標（sampling_method が random 以外の場合に必要）
+        prompt_budget: プロンプトに載せる意見をトークン数の上限に収める場合に指定する
+        pack_size: 1リクエストにまとめてラベリングするクラスタ数（1はまとめない）
 
     Returns:
         各クラスタのラベリング結果を含むDataFrame
     """
     cluster_columns = [col for col in clusters_df.columns if col.startswith("cluster-level-")]
     initial_cluster_column = cluster_columns[-1]
-    cluster_ids = clusters_df[initial_cluster_column].unique()
+    previous_labels = previous_labels or []
+    reused_ids = {result["cluster_id"] for result in previous_labels}
+    cluster_ids = [
+        cluster_id for cluster_id in clusters_df[initial_cluster_column].unique() if cluster_id not in reused_ids
+    ]
+    if reused_ids:
+        print(f"Reusing previous labels for {len(reused_ids)} clusters, labelling {len(cluster_ids)} clusters")
+    # 全クラスタのプロンプトに載せる意見を、LLMに送る前にまとめて選んでおく
+    cluster_rows = build_cluster_index(clusters_df, [initial_cluster_column])[initial_cluster_column]
+    sampled_rows = sample_cluster_rows(
+        {cluster_id: cluster_rows[cluster_id] for cluster_id in cluster_ids}, sampling_num, sampling_method, points
+    )
+    if pack_size > 1:
+        report = PackingReport("Packed initial labelling")
+        packs = [cluster_ids[start : start + pack_size] for start in range(0, len(cluster_ids), pack_size)]
+        process_func = partial(
+            process_packed_initial_labelling,
+            df=clusters_df,
+            prompt=prompt,
+            model=model,
+            sampled_rows=sampled_rows,
+            report=report,
+            prompt_budget=prompt_budget,
+        )
+        results = list(
+            chain.from_iterable(map_concurrently(process_func, packs, max_in_flight=workers, desc="Initial labelling"))
+        )
+        print(report.summary())
+        return pd.DataFrame(previous_labels + results, columns=list(LabellingResult.__annotations__))
+
     process_func = partial(
         process_initial_labelling,
         df=clusters_df,
@@ -91,19 +188,22 @@ def initial_labelling(
         sampling_num=sampling_num,
         target_column=initial_cluster_column,
         model=model,
+        sampled_rows=sampled_rows,
+        prompt_budget=prompt_budget,
     )
-    with ThreadPoolExecutor(max_workers=workers) as executor:
-        results = list(executor.map(process_func, cluster_ids))
-    return pd.DataFrame(results)
+    results = map_concurrently(process_func, cluster_ids, max_in_flight=workers, desc="Initial labelling")
+    return pd.DataFrame(previous_labels + results, columns=list(LabellingResult.__annotations__))
 
 
-def process_initial_labelling(
+async def process_initial_labelling(
     cluster_id: str,
     df: pd.DataFrame,
     prompt: str,
     sampling_num: int,
     target_column: str,
     model: str,
+    sampled_rows: dict[str, np.ndarray] | None = None,
+    prompt_budget: PromptBudget | None = None,
 ) -> LabellingResult:
     """個別のクラスタに対してラベリングを実行する
 
@@ -114,30 +214,107 @@ def process_initial_labelling(
         sampling_num: サンプリングする意見の数
         target_column: クラスタIDが格納されている列名
         model: 使用するLLMモデル名
+        sampled_rows: sample_cluster_rows で選んだ、プロンプトに載せる意見の行番号（省略時は無作為に選ぶ）
+        prompt_budget: 指定した場合、選んだ意見を先頭から token_budget に収まるだけ載せる
 
     Returns:
         クラスタのラベリング結果
     """
-    cluster_data = df[df[target_column] == cluster_id]
-    sampling_num = min(sampling_num, len(cluster_data))
-    cluster = cluster_data.sample(sampling_num)
-    input = "\n".join(cluster["argument"].values)
-    messages = [
-        {"role": "system", "content": prompt},
-        {"role": "user", "content": input},
-    ]
+    if sampled_rows is None:
+        sampled_rows = sample_cluster_rows({cluster_id: np.flatnonzero(df[target_column] == cluster_id)}, sampling_num)
+    messages = labelling_messages(prompt, _labelling_input(cluster_id, df, prompt, sampled_rows, prompt_budget))
+    if prompt_budget is not None:
+        prompt_budget.record(cluster_id, messages)
+    return await _request_labelling_result(cluster_id, messages, model)
+
+
+async def process_packed_initial_labelling(
+    cluster_ids: list[str],
+    df: pd.DataFrame,
+    prompt: str,
+    model: str,
+    sampled_rows: dict[str, np.ndarray],
+    report: PackingReport,
+    prompt_budget: PromptBudget | None = None,
+) -> list[LabellingResult]:
+    """複数のクラスタを1リクエストでラベリングする
+
+    応答に含まれない・形式が違うクラスタは、1件ずつのリクエストでラベリングし直す。
+
+    Args:
+        cluster_ids: 処理対象のクラスタIDのリスト
+        df: クラスタリング結果のDataFrame
+        prompt: LLMへのプロンプト
+        model: 使用するLLMモデル名
+        sampled_rows: sample_cluster_rows で選んだ、プロンプトに載せる意見の行番号
+        report: リクエスト数とトークン数を集計する PackingReport
+        prompt_budget: 指定した場合、各クラスタの意見を1件ずつ送る場合と同じく token_budget に収め、
+            まとめたリクエストと1件ずつのラベリングし直しの利用率を記録する
+
+    Returns:
+        cluster_ids と同じ順序のラベリング結果
+    """
+    inputs = {
+        cluster_id: _labelling_input(cluster_id, df, prompt, sampled_rows, prompt_budget) for cluster_id in cluster_ids
+    }
+    single_messages = {cluster_id: labelling_messages(prompt, input) for cluster_id, input in inputs.items()}
+    messages = packed_labelling_messages(prompt, inputs)
+    if prompt_budget is not None:
+        prompt_budget.record(",".join(inputs), messages, n_prompts=len(inputs))
+    report.add_packed(messages, list(single_messages.values()))
+    try:
+        response = await request_to_chat_llm_async(messages=messages, model=model, is_json=True)
+        labels = parse_packed_labels(response, cluster_ids)
+    except Exception as e:
+        logging.warning(f"Packed labelling for clusters {cluster_ids} failed with error: {e!r}")
+        labels = {}
+    if len(labels) < len(cluster_ids):
+        # 一部のクラスタをパースできなかった応答はキャッシュに残さず、次回の実行で送り直す
+        evict_chat_response(messages, model, is_json=True)
+
+    results = []
+    for cluster_id in cluster_ids:
+        if cluster_id in labels:
+            results.append(LabellingResult(cluster_id=cluster_id, **labels[cluster_id]))
+            continue
+        logging.warning(f"Cluster {cluster_id} is missing from the packed response, labelling it individually")
+        report.add_retry(single_messages[cluster_id])
+        if prompt_budget is not None:
+            prompt_budget.record(cluster_id, single_messages[cluster_id])
+        results.append(await _request_labelling_result(cluster_id, single_messages[cluster_id], model))
+    return results
+
+
+def _labelling_input(
+    cluster_id: str,
+    df: pd.DataFrame,
+    prompt: str,
+    sampled_rows: dict[str, np.ndarray],
+    prompt_budget: PromptBudget | None,
+) -> str:
+    arguments = df["argument"].iloc[sampled_rows[cluster_id]].tolist()
+    if prompt_budget is not None:
+        arguments = prompt_budget.pack(arguments, reserved=[prompt])
+    return "\n".join(arguments)
+
+
+async def _request_labelling_result(cluster_id: str, messages: list[dict], model: str) -> LabellingResult:
     try:
-        response = request_to_chat_llm(messages=messages, model=model, is_json=True)
+        response = await request_to_chat_llm_async(messages=messages, model=model, is_json=True)
         response_json = json.loads(response)
+        if "label" not in response_json or "description" not in response_json:
+            # ラベルか説明が欠けた応答はキャッシュに残さず、次回の実行で送り直す
+            evict_chat_response(messages, model, is_json=True)
         return LabellingResult(
             cluster_id=cluster_id,
-            label=response_json.get("label", "エラーでラベル名が取得できませんでした"),
-            description=response_json.get("description", "エラーで解説が取得できませんでした"),
+            label=response_json.get("label", ERROR_LABEL),
+            description=response_json.get("description", ERROR_DESCRIPTION),
         )
     except Exception as e:
         print(e)
+        evict_chat_response(messages, model, is_json=True)
         return LabellingResult(
             cluster_id=cluster_id,
-            label="エラーでラベル名が取得できませんでした",
-            description="エラーで解説が取得できませんでした",
-        )
\ No newline at end of file
+            label=ERROR_LABEL,
+            description=ERROR_DESCRIPTION,
+        )
@@ -1,13 +1,33 @@
 import json
-from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
 from dataclasses import dataclass
-from functools import partial
 
 import numpy as np
 import pandas as pd
+from sklearn.neighbors import NearestNeighbors
 from tqdm import tqdm
 
-from services.llm import request_to_chat_llm
+from services.async_llm import request_to_chat_llm_async, run_graph_concurrently
+from services.cluster_index import ClusterIndex, build_cluster_index
+from services.packed_labelling import (
+    ERROR_DESCRIPTION,
+    ERROR_LABEL,
+    PackingReport,
+    labelling_messages,
+    packed_labelling_messages,
+)
+from services.parse_json_list import parse_packed_labels
+from services.llm import evict_chat_response
+from services.prompt_budget import PromptBudget, prompt_budget_from_config
+from services.representative_sampling import load_sampling_points, sample_cluster_rows
+from steps.hierarchical_clustering import load_reusable_cluster_ids, save_label_fingerprint
+
+DENSITY_METHODS = ["mean_distance", "knn"]
+# density_method="knn" で使う近傍数のデフォルト値
+DENSITY_KNN_K = 10
+# ラベルに影響するラベリングのステップ（前回のラベルを使えるかの判定に使う。初期ラベルは最下層のラベルになる）
+LABELLING_STEPS = ["hierarchical_initial_labelling", "hierarchical_merge_labelling"]
 
 
 @dataclass
@@ -28,7 +48,7 @@ class ClusterColumns:
         )
 
 
-@dataclass
+@dataclass(frozen=True)
 class ClusterValues:
     """対象クラスタのlabel/descriptionを管理するクラス"""
 
@@ -47,40 +67,73 @@ def hierarchical_merge_labelling(config: dict) -> None:
             - output_dir: 出力ディレクトリ名
             - hierarchical_merge_labelling: マージラベリングの設定
                 - sampling_num: サンプリング数
+                - sampling_method: サンプリングする意見の選び方
+                - sampling_space: sampling_method の距離を測る空間
                 - prompt: LLMへのプロンプト
                 - model: 使用するLLMモデル名
                 - workers: 並列処理のワーカー数
+                - token_budget: 1リクエストのトークン数の上限
+                - max_item_tokens: 意見・子クラスタのラベルと説明1件のトークン数の上限
+                - pack_size: 1リクエストにまとめてラベリングするクラスタ数
     """
     dataset = config["output_dir"]
     merge_path = f"outputs/{dataset}/hierarchical_merge_labels.csv"
     clusters_df = pd.read_csv(f"outputs/{dataset}/hierarchical_initial_labels.csv")
+    prompt_budget = prompt_budget_from_config("Merge labelling", config["hierarchical_merge_labelling"])
+    points = None
+    if config["hierarchical_merge_labelling"]["sampling_method"] != "random":
+        points = load_sampling_points(
+            f"outputs/{dataset}", clusters_df, config["hierarchical_merge_labelling"]["sampling_space"]
+        )
+
+    previous_labels = _load_previous_labels(merge_path, load_reusable_cluster_ids(config, merge_path, LABELLING_STEPS))
 
     cluster_id_columns: list[str] = _filter_id_columns(clusters_df.columns)
+    # 各階層の クラスタID → 行番号 の索引。ラベリングと親子関係の作成で共有する
+    cluster_index = build_cluster_index(clusters_df, cluster_id_columns)
     # ボトムクラスタのラベル・説明とクラスタid付きの各argumentを入力し、各階層のクラスタラベル・説明を生成し、argumentに付けたdfを作成
     merge_result_df = merge_labelling(
         clusters_df=clusters_df,
-        cluster_id_columns=sorted(cluster_id_columns, reverse=True),
+        cluster_id_columns=cluster_id_columns[::-1],
         config=config,
+        previous_labels=previous_labels,
+        cluster_index=cluster_index,
+        points=points,
+        prompt_budget=prompt_budget,
     )
+    if prompt_budget is not None:
+        print(prompt_budget.summary())
     # 上記のdfから各クラスタのlevel, id, label, description, valueを取得してdfを作成
     melted_df = melt_cluster_data(merge_result_df)
     # 上記のdfに親子関係を追加
-    parent_child_df = _build_parent_child_mapping(merge_result_df, cluster_id_columns)
+    parent_child_df = _build_parent_child_mapping(merge_result_df, cluster_id_columns, cluster_index)
     melted_df = melted_df.merge(parent_child_df, on=["level", "id"], how="left")
-    density_df = calculate_cluster_density(melted_df, config)
+    density_df = calculate_cluster_density(
+        melted_df,
+        merge_result_df,
+        method=config["hierarchical_merge_labelling"]["density_method"],
+        k=config["hierarchical_merge_labelling"]["density_k"],
+    )
     density_df.to_csv(merge_path, index=False)
+    save_label_fingerprint(config, merge_path, LABELLING_STEPS)
 
 
-def _build_parent_child_mapping(df: pd.DataFrame, cluster_id_columns: list[str]):
+def _build_parent_child_mapping(
+    df: pd.DataFrame,
+    cluster_id_columns: list[str],
+    cluster_index: ClusterIndex | None = None,
+):
     """クラスタ間の親子関係をマッピングする
 
     Args:
         df: クラスタリング結果のDataFrame
         cluster_id_columns: クラスタIDのカラム名のリスト
+        cluster_index: build_cluster_index で作った索引（省略時はここで作る）
 
     Returns:
         親子関係のマッピング情報を含むDataFrame
     """
+    cluster_index = cluster_index or build_cluster_index(df, cluster_id_columns)
     results = []
     top_cluster_column = cluster_id_columns[0]
     top_cluster_values = df[top_cluster_column].unique()
@@ -96,15 +149,15 @@ def _build_parent_child_mapping(df: pd.DataFrame, cluster_id_columns: list[str])
     for idx in range(len(cluster_id_columns) - 1):
         current_column = cluster_id_columns[idx]
         children_column = cluster_id_columns[idx + 1]
-        current_level = current_column.replace("-id", "").replace("cluster-level-", "")
+        current_level = _column_level(current_column)
         # 現在のレベルのクラスタid
         current_cluster_values = df[current_column].unique()
         for current_id in current_cluster_values:
-            children_ids = df.loc[df[current_column] == current_id, children_column].unique()
+            children_ids = df[children_column].iloc[cluster_index[current_column][current_id]].unique()
             for child_id in children_ids:
                 results.append(
                     {
-                        "level": int(current_level) + 1,
+                        "level": current_level + 1,
                         "id": child_id,
                         "parent": current_id,
                     }
@@ -119,9 +172,16 @@ def _filter_id_columns(columns: list[str]) -> list[str]:
         columns: 全カラム名のリスト
 
     Returns:
-        クラスタIDのカラム名のリスト
+        クラスタIDのカラム名のリスト（上位の階層から順に）
     """
-    return [col for col in columns if col.startswith("cluster-level-") and col.endswith("-id")]
+    id_columns = [col for col in columns if col.startswith("cluster-level-") and col.endswith("-id")]
+    # 文字列の順序では cluster-level-10-id が level-1 と level-2 の間に並ぶため、階層の番号で並べる
+    return sorted(id_columns, key=_column_level)
+
+
+def _column_level(id_column: str) -> int:
+    """cluster-level-n-id の n"""
+    return int(id_column.replace("cluster-level-", "").replace("-id", ""))
 
 
 def melt_cluster_data(df: pd.DataFrame) -> pd.DataFrame:
@@ -137,7 +197,7 @@ def melt_cluster_data(df: pd.DataFrame) -> pd.DataFrame:
         行形式に変換されたDataFrame
     """
     id_columns: list[str] = _filter_id_columns(df.columns)
-    levels: set[int] = {int(col.replace("cluster-level-", "").replace("-id", "")) for col in id_columns}
+    levels: set[int] = {_column_level(col) for col in id_columns}
     all_rows: list[dict] = []
 
     # levelごとに各クラスタの出現件数を集計・縦持ちにする
@@ -164,146 +224,324 @@ def melt_cluster_data(df: pd.DataFrame) -> pd.DataFrame:
     return pd.DataFrame(all_rows)
 
 
-def merge_labelling(clusters_df: pd.DataFrame, cluster_id_columns: list[str], config) -> pd.DataFrame:
+def _load_previous_labels(path: str, reusable_ids: set[str]) -> dict[str, ClusterValues]:
+    """前回の結果から、reusable_ids に含まれるクラスタのラベルと説明を取り出す"""
+    if not reusable_ids or not os.path.exists(path):
+        return {}
+    previous_df = pd.read_csv(path, usecols=["id", "label", "description"])
+    # 前回ラベリングに失敗したクラスタはラベリングし直す
+    previous_df = previous_df[previous_df["id"].isin(reusable_ids) & (previous_df["label"] != ERROR_LABEL)]
+    return {
+        row["id"]: ClusterValues(label=row["label"], description=row["description"])
+        for _, row in previous_df.iterrows()
+    }
+
+
+def merge_labelling(
+    clusters_df: pd.DataFrame,
+    cluster_id_columns: list[str],
+    config,
+    previous_labels: dict[str, ClusterValues] | None = None,
+    cluster_index: ClusterIndex | None = None,
+    points: np.ndarray | None = None,
+    prompt_budget: PromptBudget | None = None,
+) -> pd.DataFrame:
     """階層的なクラスタのマージラベリングを実行する
 
+    各クラスタは、子クラスタ（1つ下の階層）のラベリングが全て終わった時点でLLMに送る。
+    階層の区切りを待たないため、LLMへの同時リクエスト数は最後まで workers に保たれる。
+    子クラスタのラベル・説明が1種類だけのクラスタと previous_labels に含まれるクラスタは、
+    LLMに送らずにその場で確定する。
+    pack_size が2以上の場合は、送れるようになったクラスタを最大 pack_size 件ずつ1リクエストにまとめる。
+
     Args:
         clusters_df: クラスタリング結果のDataFrame
-        cluster_id_columns: クラスタIDのカラム名のリスト
+        cluster_id_columns: クラスタIDのカラム名のリスト（最下層から順に）
         config: 設定情報を含む辞書
+        previous_labels: そのまま使う前回のラベルと説明（含まれるクラスタはLLMに送らない）
+        cluster_index: build_cluster_index で作った索引（省略時はここで作る）
+        points: clusters_df の各行の座標（sampling_method が random 以外の場合に必要）
+        prompt_budget: プロンプトをトークン数の上限に収める場合に指定する
 
     Returns:
-        マージラベリング結果を含むDataFrame
+        マージラベリング結果を含むDataFrame（行の順序は clusters_df と同じ）
     """
-    for idx in tqdm(range(len(cluster_id_columns) - 1)):
-        previous_columns = ClusterColumns.from_id_column(cluster_id_columns[idx])
-        current_columns = ClusterColumns.from_id_column(cluster_id_columns[idx + 1])
-
-        process_fn = partial(
-            process_merge_labelling,
-            result_df=clusters_df,
-            current_columns=current_columns,
-            previous_columns=previous_columns,
-            config=config,
+    previous_labels = previous_labels or {}
+    cluster_index = cluster_index or build_cluster_index(clusters_df, cluster_id_columns)
+    dependencies = build_label_dependencies(clusters_df, cluster_id_columns)
+    # 全クラスタのプロンプトに載せる意見を、LLMに送る前に階層毎にまとめて選んでおく
+    merge_config = config["hierarchical_merge_labelling"]
+    sampled_rows = {
+        column: sample_cluster_rows(
+            cluster_index[column], merge_config["sampling_num"], merge_config["sampling_method"], points
+        )
+        for column in cluster_id_columns[1:]
+    }
+    # 最下層のクラスタは初期ラベリングの結果をそのまま使う
+    bottom_columns = ClusterColumns.from_id_column(cluster_id_columns[0])
+    bottom_labels = (
+        clusters_df[[bottom_columns.id, bottom_columns.label, bottom_columns.description]]
+        .drop_duplicates(bottom_columns.id)
+        .itertuples(index=False)
+    )
+    bottom_values = {
+        (bottom_columns.id, cluster_id): ClusterValues(label=label, description=description)
+        for cluster_id, label, description in bottom_labels
+    }
+
+    def children_values(node: tuple[str, str], results: dict) -> list[ClusterValues]:
+        # ラベル・説明が同じ子クラスタは1つにまとめる
+        return list(dict.fromkeys(results[child] for child in dependencies[node]))
+
+    def resolve(node: tuple[str, str], results: dict) -> ClusterValues | None:
+        _, cluster_id = node
+        if cluster_id in previous_labels:
+            return previous_labels[cluster_id]
+        values = children_values(node, results)
+        return values[0] if len(values) == 1 else None
+
+    async def label_cluster(node: tuple[str, str], results: dict) -> ClusterValues:
+        column, cluster_id = node
+        return await process_merge_labelling(
+            cluster_id,
+            children_values(node, results),
+            clusters_df,
+            sampled_rows[column][cluster_id],
+            config,
+            prompt_budget,
         )
 
-        current_cluster_ids = sorted(clusters_df[current_columns.id].unique())
-        with ThreadPoolExecutor(max_workers=config["hierarchical_merge_labelling"]["workers"]) as executor:
-            responses = list(
-                tqdm(
-                    executor.map(process_fn, current_cluster_ids),
-                    total=len(current_cluster_ids),
-                )
-            )
+    pack_size = merge_config["pack_size"]
+    report = PackingReport("Packed merge labelling")
 
-        current_result_df = pd.DataFrame(responses)
-        clusters_df = clusters_df.merge(current_result_df, on=[current_columns.id])
+    async def label_pack(nodes: list[tuple[str, str]], results: dict) -> dict[tuple[str, str], ClusterValues]:
+        targets = {
+            cluster_id: (children_values((column, cluster_id), results), sampled_rows[column][cluster_id])
+            for column, cluster_id in nodes
+        }
+        values = await process_packed_merge_labelling(targets, clusters_df, config, report, prompt_budget)
+        return {node: values[node[1]] for node in nodes}
+
+    labels: dict[tuple[str, str], ClusterValues] = {}
+    for node, result in tqdm(
+        run_graph_concurrently(
+            label_pack if pack_size > 1 else label_cluster,
+            dependencies,
+            max_in_flight=merge_config["workers"],
+            resolve=resolve,
+            completed=bottom_values,
+            batch_size=pack_size,
+        ),
+        total=len(dependencies),
+        desc="Merge labelling",
+    ):
+        if isinstance(result, Exception):
+            raise result
+        labels[node] = result
+    if pack_size > 1:
+        print(report.summary())
+
+    # 索引の行番号が使えるように、mergeではなくmapで列を追加して行の順序を保つ
+    for column in cluster_id_columns[1:]:
+        current_columns = ClusterColumns.from_id_column(column)
+        current_labels = {cluster_id: labels[(column, cluster_id)] for cluster_id in cluster_index[column]}
+        current_ids = clusters_df[column]
+        clusters_df = clusters_df.assign(
+            **{
+                current_columns.label: current_ids.map({k: v.label for k, v in current_labels.items()}),
+                current_columns.description: current_ids.map({k: v.description for k, v in current_labels.items()}),
+            }
+        )
     return clusters_df
 
 
-def process_merge_labelling(
+def build_label_dependencies(
+    clusters_df: pd.DataFrame,
+    cluster_id_columns: list[str],
+) -> dict[tuple[str, str], list[tuple[str, str]]]:
+    """最下層以外の (ID列名, クラスタID) → 子クラスタの (ID列名, クラスタID) のリスト を作る
+
+    子クラスタの順序は clusters_df に最初に現れた順。
+    """
+    dependencies = {}
+    for children_column, column in zip(cluster_id_columns, cluster_id_columns[1:], strict=False):
+        pairs = clusters_df[[column, children_column]].drop_duplicates()
+        for cluster_id, child in zip(pairs[column], pairs[children_column], strict=True):
+            dependencies.setdefault((column, cluster_id), []).append((children_column, child))
+    return dependencies
+
+
+async def process_merge_labelling(
     target_cluster_id: str,
+    previous_values: list[ClusterValues],
     result_df: pd.DataFrame,
-    current_columns: ClusterColumns,
-    previous_columns: ClusterColumns,
+    sampled_rows: np.ndarray,
     config,
-):
+    prompt_budget: PromptBudget | None = None,
+) -> ClusterValues:
     """個別のクラスタに対してマージラベリングを実行する
 
     Args:
         target_cluster_id: 処理対象のクラスタID
+        previous_values: 子クラスタ（前のレベル）のラベルと説明
         result_df: クラスタリング結果のDataFrame
-        current_columns: 現在のレベルのカラム情報
-        previous_columns: 前のレベルのカラム情報
+        sampled_rows: プロンプトに載せる意見の行番号（sample_cluster_rows で選んだもの）
         config: 設定情報を含む辞書
+        prompt_budget: 指定した場合、子クラスタのラベルと説明は全て載せ、残りのトークン数に収まるだけ意見を載せる
 
     Returns:
-        マージラベリング結果を含む辞書
+        マージラベリング結果のラベルと説明
     """
-
-    def filter_previous_values(df: pd.DataFrame, previous_columns: ClusterColumns) -> list[ClusterValues]:
-        """前のレベルのクラスタ情報を取得する"""
-        previous_records = df[df[current_columns.id] == target_cluster_id][
-            [previous_columns.label, previous_columns.description]
-        ].drop_duplicates()
-        previous_values = [
-            ClusterValues(
-                label=row[previous_columns.label],
-                description=row[previous_columns.description],
-            )
-            for _, row in previous_records.iterrows()
-        ]
-        return previous_values
-
-    previous_values = filter_previous_values(result_df, previous_columns)
-    if len(previous_values) == 1:
-        return {
-            current_columns.id: target_cluster_id,
-            current_columns.label: previous_values[0].label,
-            current_columns.description: previous_values[0].description,
-        }
-    elif len(previous_values) == 0:
+    if len(previous_values) == 0:
         raise ValueError(f"クラスタ {target_cluster_id} には前のレベルのクラスタが存在しません。")
 
-    current_cluster_data = result_df[result_df[current_columns.id] == target_cluster_id]
-    sampling_num = min(
-        config["hierarchical_merge_labelling"]["sampling_num"],
-        len(current_cluster_data),
+    prompt = config["hierarchical_merge_labelling"]["prompt"]
+    messages = labelling_messages(
+        prompt, _merge_labelling_input(previous_values, result_df, sampled_rows, prompt, prompt_budget)
     )
-    sampled_data = current_cluster_data.sample(sampling_num)
-    sampled_argument_text = "\n".join(sampled_data["argument"].values)
-    cluster_text = "\n".join([value.to_prompt_text() for value in previous_values])
-    messages = [
-        {"role": "system", "content": config["hierarchical_merge_labelling"]["prompt"]},
-        {
-            "role": "user",
-            "content": "クラスタラベル\n" + cluster_text + "\n" + "クラスタの意見\n" + sampled_argument_text,
-        },
-    ]
+    if prompt_budget is not None:
+        prompt_budget.record(target_cluster_id, messages)
+    return await _request_cluster_values(messages, config["hierarchical_merge_labelling"]["model"])
+
+
+async def process_packed_merge_labelling(
+    targets: dict[str, tuple[list[ClusterValues], np.ndarray]],
+    result_df: pd.DataFrame,
+    config,
+    report: PackingReport,
+    prompt_budget: PromptBudget | None = None,
+) -> dict[str, ClusterValues]:
+    """複数のクラスタを1リクエストでマージラベリングする
+
+    応答に含まれない・形式が違うクラスタは、1件ずつのリクエストでラベリングし直す。
+
+    Args:
+        targets: クラスタID → (子クラスタのラベルと説明, プロンプトに載せる意見の行番号)
+        result_df: クラスタリング結果のDataFrame
+        config: 設定情報を含む辞書
+        report: リクエスト数とトークン数を集計する PackingReport
+        prompt_budget: 指定した場合、各クラスタの入力を1件ずつ送る場合と同じく token_budget に収め、
+            まとめたリクエストと1件ずつのラベリングし直しの利用率を記録する
+
+    Returns:
+        クラスタID → マージラベリング結果のラベルと説明
+    """
+    prompt = config["hierarchical_merge_labelling"]["prompt"]
+    model = config["hierarchical_merge_labelling"]["model"]
+    inputs = {
+        cluster_id: _merge_labelling_input(previous_values, result_df, sampled_rows, prompt, prompt_budget)
+        for cluster_id, (previous_values, sampled_rows) in targets.items()
+    }
+    single_messages = {cluster_id: labelling_messages(prompt, input) for cluster_id, input in inputs.items()}
+    messages = packed_labelling_messages(prompt, inputs)
+    if prompt_budget is not None:
+        prompt_budget.record(",".join(inputs), messages, n_prompts=len(inputs))
+    report.add_packed(messages, list(single_messages.values()))
     try:
-        response = request_to_chat_llm(
+        response = await request_to_chat_llm_async(messages=messages, model=model, is_json=True)
+        labels = parse_packed_labels(response, list(inputs))
+    except Exception as e:
+        logging.warning(f"Packed merge labelling for clusters {list(inputs)} failed with error: {e!r}")
+        labels = {}
+    if len(labels) < len(inputs):
+        # 一部のクラスタをパースできなかった応答はキャッシュに残さず、次回の実行で送り直す
+        evict_chat_response(messages, model, is_json=True)
+
+    results = {}
+    for cluster_id in inputs:
+        if cluster_id in labels:
+            results[cluster_id] = ClusterValues(**labels[cluster_id])
+            continue
+        logging.warning(f"Cluster {cluster_id} is missing from the packed response, labelling it individually")
+        report.add_retry(single_messages[cluster_id])
+        if prompt_budget is not None:
+            prompt_budget.record(cluster_id, single_messages[cluster_id])
+        results[cluster_id] = await _request_cluster_values(single_messages[cluster_id], model)
+    return results
+
+
+def _merge_labelling_input(
+    previous_values: list[ClusterValues],
+    result_df: pd.DataFrame,
+    sampled_rows: np.ndarray,
+    prompt: str,
+    prompt_budget: PromptBudget | None,
+) -> str:
+    arguments = result_df["argument"].iloc[sampled_rows].tolist()
+    cluster_lines = [value.to_prompt_text() for value in previous_values]
+    if prompt_budget is not None:
+        headers = [prompt, "クラスタラベル\n", "クラスタの意見\n"]
+        cluster_lines = prompt_budget.pack(cluster_lines, reserved=headers, min_items=len(cluster_lines))
+        arguments = prompt_budget.pack(arguments, reserved=headers + cluster_lines, min_items=0)
+    sampled_argument_text = "\n".join(arguments)
+    cluster_text = "\n".join(cluster_lines)
+    return "クラスタラベル\n" + cluster_text + "\n" + "クラスタの意見\n" + sampled_argument_text
+
+
+async def _request_cluster_values(messages: list[dict], model: str) -> ClusterValues:
+    try:
+        response = await request_to_chat_llm_async(
             messages=messages,
-            model=config["hierarchical_merge_labelling"]["model"],
+            model=model,
             is_json=True,
         )
         response_json = json.loads(response)
-        return {
-            current_columns.id: target_cluster_id,
-            current_columns.label: response_json.get("label", "エラーでラベル名が取得できませんでした"),
-            current_columns.description: response_json.get("description", "エラーで解説が取得できませんでした"),
-        }
+        if "label" not in response_json or "description" not in response_json:
+            # ラベルか説明が欠けた応答はキャッシュに残さず、次回の実行で送り直す
+            evict_chat_response(messages, model, is_json=True)
+        return ClusterValues(
+            label=response_json.get("label", ERROR_LABEL),
+            description=response_json.get("description", ERROR_DESCRIPTION),
+        )
     except Exception as e:
         print(f"エラーが発生しました: {e}")
-        return {
-            current_columns.id: target_cluster_id,
-            current_columns.label: "エラーでラベル名が取得できませんでした",
-            current_columns.description: "エラーで解説が取得できませんでした",
-        }
+        evict_chat_response(messages, model, is_json=True)
+        return ClusterValues(
+            label=ERROR_LABEL,
+            description=ERROR_DESCRIPTION,
+        )
 
 
-def calculate_cluster_density(melted_df: pd.DataFrame, config: dict):
-    """クラスタ内の密度計算"""
-    hierarchical_cluster_df = pd.read_csv(f"outputs/{config['output_dir']}/hierarchical_clusters.csv")
+def calculate_cluster_density(
+    melted_df: pd.DataFrame,
+    clusters_df: pd.DataFrame,
+    method: str = "mean_distance",
+    k: int = DENSITY_KNN_K,
+):
+    """クラスタ内の密度計算
+
+    階層毎に1回、全意見のクラスタ番号を添字にした集計（np.bincount）で各クラスタの密度を求める。
 
-    densities = []
-    for level, c_id in zip(melted_df["level"], melted_df["id"], strict=False):
-        cluster_embeds = hierarchical_cluster_df[hierarchical_cluster_df[f"cluster-level-{level}-id"] == c_id][
-            ["x", "y"]
-        ].values
-        density = calculate_density(cluster_embeds)
-        densities.append(density)
+    Args:
+        melted_df: melt_cluster_data の結果（level, id 列を持つ）
+        clusters_df: 各意見の x, y と cluster-level-n-id 列を持つDataFrame
+        method: 密度の定義
+            - mean_distance: クラスタの重心からの平均距離の逆数
+            - knn: 各意見から k 番目に近い意見（クラスタに依らない）までの距離のクラスタ内平均の逆数
+        k: method="knn" で使う近傍数
+    """
+    if method not in DENSITY_METHODS:
+        raise ValueError(f"Unknown density_method: {method}, available methods: {DENSITY_METHODS}")
+    points = clusters_df[["x", "y"]].to_numpy(dtype=np.float64)
+    if method == "knn":
+        # 2次元のためKD木で全意見の近傍を1回だけ求め、全ての階層で使う（自分自身を含むため k + 1 件）
+        n_neighbors = min(k + 1, len(points))
+        knn_distances = NearestNeighbors(n_neighbors=n_neighbors).fit(points).kneighbors(points)[0][:, -1]
+
+    densities = {}
+    for level in melted_df["level"].unique():
+        codes, cluster_ids = pd.factorize(clusters_df[f"cluster-level-{level}-id"])
+        counts = np.bincount(codes)
+        if method == "knn":
+            distances = knn_distances
+        else:
+            centers = np.stack([np.bincount(codes, weights=points[:, d]) for d in range(2)], axis=1) / counts[:, None]
+            distances = np.linalg.norm(points - centers[codes], axis=1)
+        avg_distances = np.bincount(codes, weights=distances) / counts
+        densities.update(zip(((level, cluster_id) for cluster_id in cluster_ids), 1 / (avg_distances + 1e-10)))
 
     # 密度のランクを計算
-    melted_df["density"] = densities
+    melted_df["density"] = [densities[key] for key in zip(melted_df["level"], melted_df["id"], strict=True)]
     melted_df["density_rank"] = melted_df.groupby("level")["density"].rank(ascending=False, method="first")
     melted_df["density_rank_percentile"] = melted_df.groupby("level")["density_rank"].transform(lambda x: x / len(x))
     return melted_df
-
-
-def calculate_density(embeds: np.ndarray):
-    """平均距離に基づいて密度を計算"""
-    center = np.mean(embeds, axis=0)
-    distances = np.linalg.norm(embeds - center, axis=1)
-    avg_distance = np.mean(distances)
-    density = 1 / (avg_distance + 1e-10)
-    return density
\ No newline at end of file
@@ -1,8 +1,11 @@
 """Create summaries for the clusters."""
 
+import logging
+
 import pandas as pd
 
 from services.llm import request_to_chat_llm
+from services.prompt_budget import prompt_budget_from_config
 
 
 def hierarchical_overview(config):
@@ -22,12 +25,23 @@ def hierarchical_overview(config):
     descriptions = target_records["description"].to_list()
     target_records.set_index("id", inplace=True)
 
-    input = ""
-    for i, _ in enumerate(ids):
-        input += f"# Cluster {i}/{len(ids)}: {labels[i]}\n\n"
-        input += descriptions[i] + "\n\n"
+    cluster_texts = [f"# Cluster {i}/{len(ids)}: {labels[i]}\n\n{descriptions[i]}\n\n" for i in range(len(ids))]
+    # token_budget を指定した場合、先頭のクラスタから上限に収まるだけ載せる
+    prompt_budget = prompt_budget_from_config("Overview", config["hierarchical_overview"])
+    if prompt_budget is not None:
+        packed_texts = prompt_budget.pack(cluster_texts, reserved=[prompt])
+        if len(packed_texts) < len(cluster_texts):
+            logging.warning(
+                f"Overview: {len(cluster_texts) - len(packed_texts)} of {len(cluster_texts)} clusters "
+                "do not fit in token_budget and are left out of the prompt"
+            )
+        cluster_texts = packed_texts
+    input = "".join(cluster_texts)
 
     messages = [{"role": "user", "content": prompt}, {"role": "user", "content": input}]
+    if prompt_budget is not None:
+        prompt_budget.record("prompt", messages)
+        print(prompt_budget.summary())
     response = request_to_chat_llm(messages=messages, model=model)
 
     with open(path, "w", encoding='utf-8') as file:
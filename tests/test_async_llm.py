@@ -0,0 +1,89 @@
+import asyncio
+
+from services.async_llm import run_graph_concurrently
+
+# a ← b ← d, a ← c ← d（d は b と c の両方に依存する）, e は独立
+DEPENDENCIES = {"a": [], "b": ["a"], "c": ["a"], "d": ["b", "c"], "e": []}
+
+
+def _recording_func(events, delay=0.01, fail=()):
+    in_flight = {"now": 0, "max": 0}
+
+    async def func(node, results):
+        in_flight["now"] += 1
+        in_flight["max"] = max(in_flight["max"], in_flight["now"])
+        events.append(("start", node))
+        await asyncio.sleep(delay)
+        in_flight["now"] -= 1
+        events.append(("end", node))
+        if node in fail:
+            raise ValueError(node)
+        return node + "".join(results[dependency] for dependency in DEPENDENCIES[node])
+
+    return func, in_flight
+
+
+def test_nodes_start_after_their_dependencies():
+    events = []
+    func, in_flight = _recording_func(events)
+    results = dict(run_graph_concurrently(func, DEPENDENCIES, max_in_flight=2))
+    assert results == {"a": "a", "b": "ba", "c": "ca", "d": "dbaca", "e": "e"}
+    for node, node_dependencies in DEPENDENCIES.items():
+        for dependency in node_dependencies:
+            assert events.index(("end", dependency)) < events.index(("start", node))
+    assert in_flight["max"] == 2
+
+
+def test_completed_and_resolved_nodes_are_not_run():
+    events = []
+    func, _ = _recording_func(events)
+    # completed のノードは依存先としてだけ現れる
+    dependencies = {node: node_dependencies for node, node_dependencies in DEPENDENCIES.items() if node != "a"}
+    results = list(
+        run_graph_concurrently(
+            func,
+            dependencies,
+            max_in_flight=4,
+            resolve=lambda node, results: "resolved" if node == "c" else None,
+            completed={"a": "A"},
+        )
+    )
+    assert dict(results) == {"b": "bA", "c": "resolved", "d": "dbAresolved", "e": "e"}
+    assert {node for kind, node in events if kind == "start"} == {"b", "d", "e"}
+
+
+def test_func_error_is_returned_and_dependants_are_skipped():
+    events = []
+    func, _ = _recording_func(events, fail={"b"})
+    results = dict(run_graph_concurrently(func, DEPENDENCIES, max_in_flight=2))
+    assert isinstance(results["b"], ValueError)
+    assert "d" not in results
+    assert results["c"] == "ca" and results["e"] == "e"
+
+
+def test_resolve_error_is_returned_as_node_result():
+    def resolve(node, results):
+        if node == "c":
+            raise KeyError("broken resolve")
+        return None
+
+    func, _ = _recording_func([])
+    results = dict(run_graph_concurrently(func, DEPENDENCIES, max_in_flight=2, resolve=resolve))
+    assert isinstance(results["c"], KeyError)
+    assert "d" not in results
+    assert results["b"] == "ba"
+
+
+def test_batches_group_ready_nodes():
+    batches = []
+
+    async def func(nodes, results):
+        batches.append(sorted(nodes))
+        await asyncio.sleep(0.01)
+        # 辞書に含まれないノードは KeyError になる
+        return {node: node.upper() for node in nodes if node != "e"}
+
+    results = dict(run_graph_concurrently(func, DEPENDENCIES, max_in_flight=1, batch_size=2))
+    assert batches == [["a", "e"], ["b", "c"], ["d"]]
+    assert {node: value for node, value in results.items() if node != "e"} == {"a": "A", "b": "B", "c": "C", "d": "D"}
+    assert isinstance(results["e"], KeyError)
@@ -0,0 +1,97 @@
+import json
+import os
+
+import pytest
+
+from services.batch_llm import BatchRequest, CannedResponder, LocalBatchBackend, get_batch_backend, run_batch
+
+
+class Interrupted(Exception):
+    pass
+
+
+def _requests(contents):
+    return [
+        BatchRequest(custom_id=str(i), messages=[{"role": "user", "content": content}], model="model")
+        for i, content in enumerate(contents)
+    ]
+
+
+def _interrupt(batch_id):
+    raise Interrupted
+
+
+def _echo(messages, model, is_json):
+    if messages[-1]["content"] == "fail":
+        raise RuntimeError("failed")
+    return messages[-1]["content"].upper()
+
+
+def test_run_batch_returns_responses_and_failures(tmp_path):
+    backend = LocalBatchBackend(str(tmp_path / "batches"), responder=_echo)
+    work_path = str(tmp_path / "batch.jsonl")
+    responses = run_batch(_requests(["a", "fail", "b"]), backend, work_path, poll_interval=0)
+    assert responses == {"0": "A", "1": None, "2": "B"}
+    assert not os.path.exists(work_path)
+    assert not os.path.exists(work_path + ".state.json")
+
+
+def test_run_batch_resumes_submitted_batch(tmp_path, monkeypatch):
+    directory = str(tmp_path / "batches")
+    work_path = str(tmp_path / "batch.jsonl")
+    backend = LocalBatchBackend(directory, responder=_echo)
+
+    # 投入後、完了を待っている間に中断する
+    monkeypatch.setattr(backend, "status", _interrupt)
+    with pytest.raises(Interrupted):
+        run_batch(_requests(["a", "b"]), backend, work_path, poll_interval=0)
+    with open(work_path + ".state.json", encoding="utf-8") as f:
+        batch_id = json.load(f)["batch_id"]
+
+    resumed = LocalBatchBackend(directory, responder=_echo)
+    submitted = []
+    monkeypatch.setattr(resumed, "submit", lambda path: submitted.append(path) or "unexpected")
+    responses = run_batch(_requests(["a", "b"]), resumed, work_path, poll_interval=0)
+    assert submitted == []
+    assert responses == {"0": "A", "1": "B"}
+    assert os.path.exists(os.path.join(directory, batch_id, "output.jsonl"))
+    assert not os.path.exists(work_path + ".state.json")
+
+
+def test_run_batch_submits_again_when_requests_change(tmp_path, monkeypatch):
+    directory = str(tmp_path / "batches")
+    work_path = str(tmp_path / "batch.jsonl")
+    backend = LocalBatchBackend(directory, responder=_echo)
+    monkeypatch.setattr(backend, "status", _interrupt)
+    with pytest.raises(Interrupted):
+        run_batch(_requests(["a"]), backend, work_path, poll_interval=0)
+
+    responses = run_batch(_requests(["c"]), LocalBatchBackend(directory, responder=_echo), work_path, poll_interval=0)
+    assert responses == {"0": "C"}
+    assert len(os.listdir(directory)) == 2
+
+
+def test_canned_responder_from_config(tmp_path):
+    path = tmp_path / "responses.jsonl"
+    lines = [
+        {"match": "bicycle", "response": '["more parking"]'},
+        {"response": "[]"},
+    ]
+    path.write_text("\n".join(json.dumps(line) for line in lines) + "\n", encoding="utf-8")
+    backend = get_batch_backend("local", str(path))
+    assert isinstance(backend, LocalBatchBackend)
+    assert not backend.caches_responses
+    backend.directory = str(tmp_path / "batches")
+    responses = run_batch(
+        _requests(["not enough bicycle parking", "nothing"]), backend, str(tmp_path / "batch.jsonl"), poll_interval=0
+    )
+    assert responses == {"0": '["more parking"]', "1": "[]"}
+
+
+def test_canned_responder_without_default_fails_request(tmp_path):
+    path = tmp_path / "responses.jsonl"
+    path.write_text(json.dumps({"match": "x", "response": "1"}) + "\n", encoding="utf-8")
+    with pytest.raises(LookupError):
+        CannedResponder(str(path))([{"role": "user", "content": "y"}], "model", False)
+    with pytest.raises(ValueError):
+        get_batch_backend("openai", str(path))
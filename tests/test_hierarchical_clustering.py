@@ -0,0 +1,143 @@
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.cluster.hierarchy as sch
+
+from services.journal import file_fingerprint
+from services.packed_labelling import ERROR_DESCRIPTION, ERROR_LABEL
+from steps.hierarchical_clustering import (
+    CLUSTER_DRIFT_FILENAME,
+    assign_to_clusters,
+    cut_hierarchy,
+    fit_hierarchical_clusters,
+    generate_cluster_count_list,
+    load_reusable_cluster_ids,
+    save_label_fingerprint,
+    select_cluster_nums,
+)
+from steps.hierarchical_initial_labelling import _load_previous_labels
+
+STEPS = ["hierarchical_initial_labelling"]
+LABEL_PATH = "outputs/job/hierarchical_initial_labels.csv"
+
+
+@pytest.fixture
+def incremental_config(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "outputs" / "job").mkdir(parents=True)
+    pd.DataFrame({"level": [1, 1], "id": ["1_0", "1_1"], "relabel": [False, True]}).to_csv(
+        f"outputs/job/{CLUSTER_DRIFT_FILENAME}", index=False
+    )
+    return {
+        "output_dir": "job",
+        "hierarchical_clustering": {"incremental": True},
+        "hierarchical_initial_labelling": {"prompt": "p", "model": "m", "workers": 1, "source_code": "a"},
+    }
+
+
+def test_reuses_clusters_under_threshold_with_same_settings(incremental_config):
+    save_label_fingerprint(incremental_config, LABEL_PATH, STEPS)
+    # workers とステップのコードはラベルに影響しない
+    incremental_config["hierarchical_initial_labelling"].update(workers=8, source_code="b")
+    assert load_reusable_cluster_ids(incremental_config, LABEL_PATH, STEPS) == {"1_0"}
+
+
+@pytest.mark.parametrize("key, value", [("prompt", "q"), ("model", "n"), ("pack_size", 4), ("token_budget", 100)])
+def test_changed_settings_relabel_all(incremental_config, key, value):
+    save_label_fingerprint(incremental_config, LABEL_PATH, STEPS)
+    incremental_config["hierarchical_initial_labelling"][key] = value
+    assert load_reusable_cluster_ids(incremental_config, LABEL_PATH, STEPS) == set()
+
+
+@pytest.mark.parametrize("option", [{"force": True}, {"only": "hierarchical_initial_labelling"}])
+def test_forced_step_relabels_all(incremental_config, option):
+    save_label_fingerprint(incremental_config, LABEL_PATH, STEPS)
+    incremental_config.update(option)
+    assert load_reusable_cluster_ids(incremental_config, LABEL_PATH, STEPS) == set()
+
+
+def test_missing_fingerprint_or_not_incremental_relabels_all(incremental_config):
+    assert load_reusable_cluster_ids(incremental_config, LABEL_PATH, STEPS) == set()
+    save_label_fingerprint(incremental_config, LABEL_PATH, STEPS)
+    incremental_config["hierarchical_clustering"]["incremental"] = False
+    assert load_reusable_cluster_ids(incremental_config, LABEL_PATH, STEPS) == set()
+
+
+def test_error_labels_are_not_reused(incremental_config):
+    pd.DataFrame(
+        {
+            "cluster-level-1-id": ["1_0", "1_1"],
+            "cluster-level-1-label": ["ok", ERROR_LABEL],
+            "cluster-level-1-description": ["desc", ERROR_DESCRIPTION],
+        }
+    ).to_csv(LABEL_PATH, index=False)
+    assert _load_previous_labels(LABEL_PATH, "cluster-level-1-id", {"1_0", "1_1"}) == [
+        {"cluster_id": "1_0", "label": "ok", "description": "desc"}
+    ]
+
+
+def test_input_fingerprint_follows_content(tmp_path):
+    path = tmp_path / "input.csv"
+    path.write_text("comment-id,comment-body\n1,a\n", encoding="utf-8")
+    before = file_fingerprint(str(path))
+    assert file_fingerprint(str(path)) == before
+    path.write_text("comment-id,comment-body\n1,a\n2,b\n", encoding="utf-8")
+    assert file_fingerprint(str(path)) != before
+
+
+@pytest.fixture
+def blobs():
+    rng = np.random.default_rng(0)
+    centers = rng.uniform(-20, 20, size=(12, 2))
+    return (centers[rng.integers(0, len(centers), 600)] + rng.normal(scale=0.5, size=(600, 2))).astype(np.float32)
+
+
+def test_cut_hierarchy_nests_levels():
+    rng = np.random.default_rng(1)
+    centers = rng.normal(size=(16, 2))
+    kmeans_labels = rng.integers(0, 16, 500)
+    linkage = sch.linkage(centers, method="ward")
+    results = cut_hierarchy(linkage, kmeans_labels, [2, 4, 16])
+
+    assert list(results) == [2, 4, 16]
+    assert results[16] is kmeans_labels
+    for coarse, fine in [(2, 4), (4, 16)]:
+        assert len(np.unique(results[coarse])) == coarse
+        # 細かい階層の各クラスタは、粗い階層のちょうど1つのクラスタに含まれる
+        pairs = pd.DataFrame({"coarse": results[coarse], "fine": results[fine]}).drop_duplicates()
+        assert pairs["fine"].is_unique
+
+
+def test_assign_to_clusters_reproduces_fitted_levels(blobs):
+    results, centers, linkage = fit_hierarchical_clusters(blobs, [3, 6, 12])
+    assigned = assign_to_clusters(blobs, centers, linkage, [3, 6, 12])
+    for cluster_num in [3, 6, 12]:
+        np.testing.assert_array_equal(assigned[cluster_num], results[cluster_num])
+    empty = assign_to_clusters(np.zeros((0, 2), dtype=np.float32), centers, linkage, [3, 6, 12])
+    assert all(len(labels) == 0 for labels in empty.values())
+
+
+def _scores(k, rank, elbow):
+    return pd.DataFrame({"k": k, "rank": rank, "elbow": elbow})
+
+
+def test_select_cluster_nums_uses_best_as_finest_and_coarser_elbow_as_top():
+    scores_df = _scores([2, 4, 8, 16, 32], rank=[5, 4, 3, 1, 2], elbow=[0.1, 0.5, 0.3, 0.0, 0.0])
+    assert select_cluster_nums(scores_df) == generate_cluster_count_list(4, 16) == [4, 8, 16]
+
+
+def test_select_cluster_nums_falls_back_to_finer_candidates():
+    scores_df = _scores([2, 3, 6, 12], rank=[1, 2, 3, 4], elbow=[0.0, 0.2, 0.6, 0.1])
+    assert select_cluster_nums(scores_df) == generate_cluster_count_list(2, 6) == [2, 4, 6]
+
+
+def test_select_cluster_nums_single_candidate():
+    assert select_cluster_nums(_scores([5], rank=[1], elbow=[0.0])) == [5]
+
+
+def test_fit_hierarchical_clusters_does_not_reorder_callers_list(blobs):
+    cluster_nums = [12, 3, 6]
+    results, _, _ = fit_hierarchical_clusters(blobs, cluster_nums)
+    assert cluster_nums == [12, 3, 6]
+    assert sorted(results) == [3, 6, 12]
+    assert len(np.unique(results[12])) == 12
@@ -0,0 +1,44 @@
+import asyncio
+import json
+
+import numpy as np
+import pandas as pd
+
+import steps.hierarchical_initial_labelling as initial_labelling
+from services.packed_labelling import PACKED_LABELLING_INSTRUCTION, PackingReport
+from services.prompt_budget import PromptBudget
+
+
+def test_packed_labelling_retries_missing_clusters_and_records_sent_requests(monkeypatch):
+    sent = []
+
+    async def fake_request(messages, model, is_json):
+        sent.append(messages)
+        if PACKED_LABELLING_INSTRUCTION in messages[0]["content"]:
+            # まとめたリクエストの応答から 1_1 が欠けている
+            return json.dumps({"1_0": {"label": "a", "description": "b"}})
+        return json.dumps({"label": "single", "description": "retried"})
+
+    monkeypatch.setattr(initial_labelling, "request_to_chat_llm_async", fake_request)
+    budget = PromptBudget("test", token_budget=1000, max_item_tokens=None)
+    recorded = []
+    monkeypatch.setattr(budget, "record", lambda key, messages, n_prompts=1: recorded.append((key, messages, n_prompts)))
+    df = pd.DataFrame({"argument": ["x", "y", "z"]})
+    sampled_rows = {"1_0": np.array([0, 1]), "1_1": np.array([2])}
+
+    results = asyncio.run(
+        initial_labelling.process_packed_initial_labelling(
+            ["1_0", "1_1"], df, "prompt", "model", sampled_rows, PackingReport("test"), budget
+        )
+    )
+
+    assert results == [
+        {"cluster_id": "1_0", "label": "a", "description": "b"},
+        {"cluster_id": "1_1", "label": "single", "description": "retried"},
+    ]
+    # 利用率は実際に送ったリクエスト（まとめたリクエストと、1件ずつのラベリングし直し）毎に記録する
+    assert recorded == [
+        ("1_0,1_1", sent[0], 2),
+        ("1_1", sent[1], 1),
+    ]
+    assert sent[1][1]["content"] == "z"
@@ -0,0 +1,30 @@
+import pandas as pd
+
+from steps.hierarchical_merge_labelling import _build_parent_child_mapping, _filter_id_columns
+
+
+def _twelve_level_clusters():
+    # 階層 n のクラスタは 2 件ずつの意見をまとめ、階層が1つ上がる毎に2つのクラスタを1つにまとめる
+    n_args = 2**12
+    data = {}
+    for level in range(1, 13):
+        size = 2 ** (13 - level)
+        data[f"cluster-level-{level}-id"] = [f"{level}_{i // size}" for i in range(n_args)]
+        data[f"cluster-level-{level}-label"] = ""
+    return pd.DataFrame(data)
+
+
+def test_filter_id_columns_orders_levels_numerically():
+    columns = ["arg-id", "cluster-level-10-id", "cluster-level-2-id", "cluster-level-1-id", "cluster-level-1-label"]
+    assert _filter_id_columns(columns) == ["cluster-level-1-id", "cluster-level-2-id", "cluster-level-10-id"]
+
+
+def test_parent_child_mapping_with_more_than_nine_levels():
+    df = _twelve_level_clusters()
+    mapping = _build_parent_child_mapping(df, _filter_id_columns(df.columns))
+    assert len(mapping) == sum(2 ** (level - 1) for level in range(1, 13))
+    children = mapping[mapping["level"] > 1]
+    # 親は常に1つ上の階層のクラスタ
+    parent_levels = children["parent"].str.split("_").str[0].astype(int)
+    assert (parent_levels == children["level"] - 1).all()
+    assert (children["id"].str.split("_").str[0].astype(int) == children["level"]).all()
@@ -0,0 +1,57 @@
+import pandas as pd
+
+from services.input_reader import (
+    count_input_rows,
+    iter_unique_comments,
+    read_comments_by_id,
+    read_unique_comments,
+)
+
+USECOLS = ["comment-id", "comment-body"]
+
+
+def _write_csv(tmp_path, rows, columns=("comment-id", "comment-body")):
+    path = tmp_path / "input.csv"
+    pd.DataFrame(rows, columns=list(columns)).to_csv(path, index=False)
+    return str(path)
+
+
+def test_read_unique_comments_drops_blank_and_duplicate_bodies(tmp_path):
+    path = _write_csv(tmp_path, [(1, "a"), (2, " "), (3, "b"), (4, "a"), (5, None), (6, "c")])
+    comments = read_unique_comments(path, USECOLS)
+    assert comments["comment-id"].tolist() == ["1", "3", "6"]
+    assert comments["comment-body"].tolist() == ["a", "b", "c"]
+
+
+def test_read_unique_comments_stops_at_limit(tmp_path):
+    path = _write_csv(tmp_path, [(1, "a"), (2, "a"), (3, "b"), (4, "c"), (5, "d")])
+    assert read_unique_comments(path, USECOLS, limit=3)["comment-id"].tolist() == ["1", "3", "4"]
+    assert read_unique_comments(path, USECOLS, limit=0).empty
+
+
+def test_iter_unique_comments_dedups_across_chunks(tmp_path):
+    path = _write_csv(tmp_path, [(1, "a"), (2, "b"), (3, "a"), (4, "c"), (5, "b"), (6, "d")])
+    chunks = list(iter_unique_comments(path, USECOLS, limit=3, chunksize=2))
+    assert [chunk["comment-id"].tolist() for chunk in chunks] == [["1", "2"], ["4"]]
+
+
+def test_ids_stay_strings_when_a_chunk_has_missing_ids(tmp_path):
+    # 型推論では、空のIDを含むチャンクの comment-id が float になり "1.0" のような値になる
+    path = tmp_path / "input.csv"
+    path.write_text("comment-id,comment-body\n1,a\n,b\n3,c\n4,d\n", encoding="utf-8")
+    chunks = list(iter_unique_comments(str(path), USECOLS, chunksize=2))
+    assert chunks[0]["comment-id"].tolist()[0] == "1"
+    assert pd.concat(chunks)["comment-id"].dropna().tolist() == ["1", "3", "4"]
+
+
+def test_header_only_input(tmp_path):
+    path = _write_csv(tmp_path, [])
+    assert count_input_rows(path) == 0
+    assert read_unique_comments(path, USECOLS).columns.tolist() == USECOLS
+    assert read_comments_by_id(path, {"1"}, USECOLS).columns.tolist() == USECOLS
+
+
+def test_read_comments_by_id_compares_ids_as_strings(tmp_path):
+    path = _write_csv(tmp_path, [(1, "a", "x"), (2, "b", "y"), (10, "c", "z")], ("comment-id", "comment-body", "area"))
+    comments = read_comments_by_id(path, {"1", "10"}, ["comment-id", "area"])
+    assert comments.to_dict("list") == {"comment-id": ["1", "10"], "area": ["x", "z"]}
@@ -0,0 +1,59 @@
+import json
+
+from services.journal import ResultsJournal, fingerprint
+
+
+def _write(journal, entries):
+    journal.open({})
+    for key, value in entries.items():
+        journal.append(key, value)
+    journal.close()
+
+
+def test_load_resumes_completed_entries(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    _write(ResultsJournal(path, fingerprint("prompt", "model")), {"a": ["x"], "b": []})
+
+    journal = ResultsJournal(path, fingerprint("prompt", "model"))
+    entries = journal.load()
+    assert entries == {"a": ["x"], "b": []}
+    # 再開時は追記し、既存の内容を残す
+    journal.open(entries)
+    journal.append("c", ["y"])
+    journal.close()
+    assert ResultsJournal(path, fingerprint("prompt", "model")).load() == {"a": ["x"], "b": [], "c": ["y"]}
+
+
+def test_fingerprint_mismatch_discards_journal(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    _write(ResultsJournal(path, fingerprint("prompt", "model")), {"a": ["x"]})
+
+    journal = ResultsJournal(path, fingerprint("other prompt", "model"))
+    entries = journal.load()
+    assert entries == {}
+    # 無効だったジャーナルは新しいフィンガープリントで作り直す
+    journal.open(entries)
+    journal.append("b", ["y"])
+    journal.close()
+    with open(path, encoding="utf-8") as f:
+        assert json.loads(f.readline()) == {"fingerprint": fingerprint("other prompt", "model")}
+    assert ResultsJournal(path, fingerprint("other prompt", "model")).load() == {"b": ["y"]}
+    assert ResultsJournal(path, fingerprint("prompt", "model")).load() == {}
+
+
+def test_load_skips_truncated_last_line(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    _write(ResultsJournal(path, fingerprint("prompt")), {"a": 1})
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"key": "b", "val')
+    assert ResultsJournal(path, fingerprint("prompt")).load() == {"a": 1}
+
+
+def test_remove_deletes_file(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    journal = ResultsJournal(str(path), fingerprint("prompt"))
+    _write(journal, {"a": 1})
+    journal.remove()
+    assert not path.exists()
+    assert journal.load() == {}
+
@@ -0,0 +1,78 @@
+import itertools
+
+import pytest
+
+from services import llm
+from services.llm import LLMResponseCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """last_access が呼び出し順に増えるよう、time.time() を1秒ずつ進む時計にする"""
+    ticks = itertools.count(1)
+    monkeypatch.setattr(llm.time, "time", lambda: float(next(ticks)))
+
+
+def _key(i):
+    return LLMResponseCache.make_key("gemini", "model", [{"role": "user", "content": str(i)}], False, 0, None)
+
+
+def test_get_counts_hits_and_misses(tmp_path, clock):
+    cache = LLMResponseCache(str(tmp_path / "cache.sqlite3"))
+    assert cache.get(_key(0)) is None
+    cache.set(_key(0), "response")
+    assert cache.get(_key(0)) == "response"
+    assert cache.get(_key(1)) is None
+    assert cache.stats() == {"hits": 1, "misses": 2, "size": 1}
+
+
+def test_make_key_depends_on_every_field():
+    messages = [{"role": "user", "content": "a"}]
+    base = LLMResponseCache.make_key("gemini", "model", messages, False, 0, None)
+    assert base == LLMResponseCache.make_key("gemini", "model", [dict(messages[0])], False, 0, None)
+    assert base != LLMResponseCache.make_key("azure", "model", messages, False, 0, None)
+    assert base != LLMResponseCache.make_key("gemini", "other", messages, False, 0, None)
+    assert base != LLMResponseCache.make_key("gemini", "model", messages, True, 0, None)
+    assert base != LLMResponseCache.make_key("gemini", "model", messages, False, 0, 0)
+
+
+def test_set_evicts_least_recently_used(tmp_path, clock):
+    cache = LLMResponseCache(str(tmp_path / "cache.sqlite3"), max_entries=3)
+    for i in range(3):
+        cache.set(_key(i), str(i))
+    # 0 を参照すると、最も古いのは 1, 2 になる
+    assert cache.get(_key(0)) == "0"
+    cache.set(_key(3), "3")
+    # 上限を超えたので、超えた1件と上限の1%（最低1件）の2件を古い順に削除する
+    assert cache.stats()["size"] == 2
+    assert cache.get(_key(1)) is None
+    assert cache.get(_key(2)) is None
+    assert cache.get(_key(0)) == "0"
+    assert cache.get(_key(3)) == "3"
+
+
+def test_size_survives_reopen_and_delete(tmp_path, clock):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = LLMResponseCache(path)
+    cache.set(_key(0), "0")
+    cache.set(_key(0), "ignored")
+    cache.set(_key(1), "1")
+    reopened = LLMResponseCache(path)
+    assert reopened.stats()["size"] == 2
+    assert reopened.get(_key(0)) == "0"
+    reopened.delete(_key(0))
+    reopened.delete(_key(0))
+    assert reopened.stats()["size"] == 1
+    assert reopened.get(_key(0)) is None
+
+
+def test_evict_chat_response_removes_cached_response(tmp_path, monkeypatch):
+    monkeypatch.setenv("USE_AZURE", "false")
+    monkeypatch.setattr(llm, "_llm_cache", LLMResponseCache(str(tmp_path / "cache.sqlite3")))
+    messages = [{"role": "user", "content": "a"}]
+    cached, cache_key = llm.get_cached_chat_response(messages, "model", True)
+    assert cached is None
+    llm.store_chat_response(cache_key, "not json")
+    assert llm.get_cached_chat_response(messages, "model", True)[0] == "not json"
+    llm.evict_chat_response(messages, "model", True)
+    assert llm.get_cached_chat_response(messages, "model", True)[0] is None
@@ -0,0 +1,38 @@
+import threading
+
+import pytest
+
+from services import llm
+
+
+@pytest.fixture(autouse=True)
+def clients(monkeypatch):
+    monkeypatch.setattr(llm, "_clients", {})
+    monkeypatch.setattr(llm, "_connection_stats", {})
+
+
+def _get_client_in_thread(*args, **kwargs):
+    # ロックの取り直しでデッドロックしてもテストが止まらないよう、デーモンスレッドで時間制限付きで呼ぶ
+    result = []
+    thread = threading.Thread(target=lambda: result.append(llm.get_client(*args, **kwargs)), daemon=True)
+    thread.start()
+    thread.join(timeout=30)
+    assert result, "get_client did not return (deadlock?)"
+    return result[0]
+
+
+def test_genai_client_is_created_once():
+    client = _get_client_in_thread("genai", None, "dummy-key")
+    assert client is _get_client_in_thread("genai", None, "dummy-key")
+    assert client is not _get_client_in_thread("genai", None, "other-key")
+
+
+def test_openai_clients_are_shared_per_key():
+    client = _get_client_in_thread("openai", "https://example.invalid/v1", "dummy-key")
+    assert client is _get_client_in_thread("openai", "https://example.invalid/v1", "dummy-key")
+    async_client = _get_client_in_thread("openai", "https://example.invalid/v1", "dummy-key", is_async=True)
+    assert async_client is not client
+    assert set(llm.get_connection_stats()) == {
+        "openai https://example.invalid/v1",
+        "openai async https://example.invalid/v1",
+    }
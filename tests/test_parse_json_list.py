@@ -0,0 +1,64 @@
+import pytest
+
+from services.parse_json_list import parse_packed_labels, parse_packed_response
+
+
+def test_parse_packed_response_all_tags():
+    assert parse_packed_response('{"C0": ["a", " b "], "C1": []}', ["C0", "C1"]) == {"C0": ["a", "b"], "C1": []}
+
+
+def test_parse_packed_response_missing_tag_is_left_out():
+    assert parse_packed_response('{"C0": ["a"]}', ["C0", "C1"]) == {"C0": ["a"]}
+
+
+def test_parse_packed_response_ignores_extra_tags():
+    assert parse_packed_response('{"C0": ["a"], "C1": ["b"], "C9": ["z"]}', ["C0", "C1"]) == {
+        "C0": ["a"],
+        "C1": ["b"],
+    }
+
+
+def test_parse_packed_response_rejects_malformed_values():
+    response = '{"C0": "single", "C1": 3, "C2": ["a", 1], "C3": ["", " c "]}'
+    assert parse_packed_response(response, ["C0", "C1", "C2", "C3"]) == {"C0": ["single"], "C3": ["c"]}
+
+
+def test_parse_packed_response_finds_object_in_text():
+    assert parse_packed_response('説明\n```json\n{"C0": ["a"]}\n```\n以上', ["C0"]) == {"C0": ["a"]}
+
+
+@pytest.mark.parametrize("response", ["no json", "[1, 2]", '{"C0": ["a"'])
+def test_parse_packed_response_unparsable(response):
+    assert parse_packed_response(response, ["C0"]) == {}
+
+
+def test_parse_packed_labels_all_clusters():
+    response = '{"1_0": {"label": " a ", "description": " b "}, "1_1": {"label": "c", "description": "d"}}'
+    assert parse_packed_labels(response, ["1_0", "1_1"]) == {
+        "1_0": {"label": "a", "description": "b"},
+        "1_1": {"label": "c", "description": "d"},
+    }
+
+
+def test_parse_packed_labels_missing_and_extra_clusters():
+    response = '{"1_0": {"label": "a", "description": "b"}, "9_9": {"label": "x", "description": "y"}}'
+    assert parse_packed_labels(response, ["1_0", "1_1"]) == {"1_0": {"label": "a", "description": "b"}}
+
+
+@pytest.mark.parametrize(
+    "values",
+    [
+        '"a"',
+        '{"label": "a"}',
+        '{"description": "b"}',
+        '{"label": " ", "description": "b"}',
+        '{"label": 1, "description": "b"}',
+        '{"label": "a", "description": null}',
+    ],
+)
+def test_parse_packed_labels_rejects_incomplete_values(values):
+    assert parse_packed_labels(f'{{"1_0": {values}}}', ["1_0"]) == {}
+
+
+def test_parse_packed_labels_unparsable():
+    assert parse_packed_labels("ラベルを作成できませんでした", ["1_0"]) == {}